@@ -1,13 +1,15 @@
 from . import baselines, deep_iv, delivr, dfiv, quantile_iv
 from .core import (MREstimator, MREstimatorWithUncertainty,
-                   RescaledMREstimator, load_estimator)
+                   RescaledMREstimator, configure_inference, load_estimator)
 from .ensemble import EnsembleMREstimator
 
 
 MODELS = {
     "quantile_iv": {
         "estimate": quantile_iv.estimate,
-        "load": quantile_iv.load
+        "load": quantile_iv.load,
+        # Can fit several outcomes jointly (a list of outcome columns).
+        "multiple_outcomes": True
     },
     "doubly_ranked": {
         "estimate": baselines.doubly_ranked.estimate,
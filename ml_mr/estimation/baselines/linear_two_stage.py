@@ -8,14 +8,15 @@ from linearmodels.iv.results import IVResults
 import torch
 
 from ..core import MREstimator
-from ...utils.data import IVDataset
+from ...utils.data import IVDataset, _iter_blocks
 
 
 class TwoSLSEstimator(MREstimator):
     def __init__(self, const_beta, exposure_beta, exposure_se, meta):
         super().__init__(meta, None)
-        self.const_beta = torch.tensor(const_beta).reshape(-1, 1)
-        self.exposure_beta = torch.tensor(exposure_beta).reshape(-1, 1)
+        # One column per outcome.
+        self.const_beta = torch.tensor(const_beta).reshape(1, -1)
+        self.exposure_beta = torch.tensor(exposure_beta).reshape(1, -1)
         self.exposure_se = exposure_se
 
     def iv_reg_function(self, x: torch.Tensor, covars=None) -> torch.Tensor:
@@ -42,25 +43,21 @@ def fit_2sls(
     if not os.path.isdir(output_dir):
         os.makedirs(output_dir)
 
-    df, cols = dataset.to_dataframe()
-
-    iv_results = twosls(
-        df,
-        y_col=cols["outcome"],
-        x_col=cols["exposure"],
-        z_cols=cols["ivs"],
-        covar_cols=cols["covariables"],
-        full=True
-    )
-
-    assert isinstance(iv_results, IVResults)
-    betas = iv_results.params
-
-    estimates = {
-        "const_beta": betas["const"],
-        "exposure_beta": betas[cols["exposure"]].to_list(),
-        "exposure_se": iv_results.std_errors[cols["exposure"]].to_list()
-    }
+    # Parameters are ordered as const, covariables, exposure with one column
+    # per outcome.
+    betas, std_errors = streaming_twosls(dataset)
+    if betas.dim() == 1:
+        estimates = {
+            "const_beta": betas[0].item(),
+            "exposure_beta": betas[-1:].tolist(),
+            "exposure_se": std_errors[-1:].tolist()
+        }
+    else:
+        estimates = {
+            "const_beta": betas[0].tolist(),
+            "exposure_beta": betas[-1].tolist(),
+            "exposure_se": std_errors[-1].tolist()
+        }
 
     with open(os.path.join(output_dir, "2sls_fit.json"), "wt") as f:
         json.dump(estimates, f)
@@ -71,6 +68,92 @@ def fit_2sls(
     return TwoSLSEstimator(**estimates, meta=meta)
 
 
+def streaming_twosls(
+    dataset: IVDataset,
+    block_size: int = 100_000
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """2SLS with heteroskedasticity-robust standard errors.
+
+    The dataset is read in blocks and only the cross-products of the
+    instruments with the exposure and outcome are accumulated, so the data
+    is never copied as a whole. This matches IV2SLS(...).fit(cov_type="robust")
+    from linearmodels. The exogenous variables are a constant and the
+    covariables.
+
+    If the samples have a weight (e.g. a SampleWeightedDataset), the fit is
+    weighted like IV2SLS(..., weights=w). Every outcome is fitted separately.
+
+    Returns the parameters and their standard errors ordered as const,
+    covariables and exposure, as matrices with one column per outcome when
+    there are many outcomes.
+
+    """
+    def design(x, y, ivs, covars, *weights):
+        # Z contains the exogenous variables and the instruments, X the
+        # exogenous variables and the exposure.
+        const = torch.ones((ivs.size(0), 1), dtype=torch.float64)
+        exog = torch.hstack([const, covars.to(torch.float64)])
+        z = torch.hstack([exog, ivs.to(torch.float64)])
+        x = torch.hstack([exog, x.to(torch.float64).reshape(-1, 1)])
+        y = y.to(torch.float64).reshape(ivs.size(0), -1)
+
+        if not weights:
+            return z, x, y, None
+
+        w = weights[0].to(torch.float64)
+        if w.dim() != 1:
+            raise ValueError(
+                "2SLS supports a single weight per sample, not replicate "
+                f"weights (got weights of shape {tuple(w.shape)})."
+            )
+
+        return z, x, y, w.reshape(-1, 1)
+
+    zz: Optional[torch.Tensor] = None
+    zx: Optional[torch.Tensor] = None
+    zy: Optional[torch.Tensor] = None
+    for block in _iter_blocks(dataset, block_size):
+        z, x, y, w = design(*block)
+        zw = z if w is None else z * w
+
+        if zz is None:
+            zz, zx, zy = zw.T @ z, zw.T @ x, zw.T @ y
+        else:
+            zz += zw.T @ z
+            zx += zw.T @ x  # type: ignore
+            zy += zw.T @ y  # type: ignore
+
+    assert zz is not None and zx is not None and zy is not None
+
+    # First stage coefficients and second stage normal equations.
+    pi = torch.linalg.solve(zz, zx)
+    xhat_xhat = zx.T @ pi
+    betas = torch.linalg.solve(xhat_xhat, pi.T @ zy)
+
+    # Second pass for the heteroskedasticity-robust covariance using the
+    # structural residuals, with one meat matrix per outcome.
+    n_outcomes = betas.size(1)
+    meat = torch.zeros((n_outcomes, *zz.shape), dtype=torch.float64)
+    for block in _iter_blocks(dataset, block_size):
+        z, x, y, w = design(*block)
+        resid = y - x @ betas
+        if w is not None:
+            resid = resid * w
+
+        for k in range(n_outcomes):
+            z_eps = z * resid[:, [k]]
+            meat[k] += z_eps.T @ z_eps
+
+    bread = torch.linalg.inv(xhat_xhat)
+    cov = bread @ (pi.T @ meat @ pi) @ bread
+    std_errors = torch.sqrt(torch.diagonal(cov, dim1=1, dim2=2)).T
+
+    if n_outcomes == 1:
+        return betas.reshape(-1), std_errors.reshape(-1)
+
+    return betas, std_errors
+
+
 def twosls(
     df: pd.DataFrame,
     y_col: str,
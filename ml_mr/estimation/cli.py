@@ -8,6 +8,9 @@ This is mostly a dispatch into the implemented algorithms.
 import sys
 import argparse
 
+from ..utils.threads import add_thread_arguments, apply_thread_arguments
+from ..utils.training import add_training_arguments, apply_training_arguments
+
 from .quantile_iv import (
     configure_argparse as quantile_iv_configure_argparse,
     main as quantile_iv_main
@@ -55,7 +58,15 @@ def main():
     delivr_parser = algorithms.add_parser("delivr")
     delivr_configure_argparse(delivr_parser)
 
+    for algorithm_parser in (quantile_iv_parser, deep_iv_parser, dfiv_parser,
+                             delivr_parser):
+        add_thread_arguments(algorithm_parser)
+        add_training_arguments(algorithm_parser)
+
     args = parser.parse_args(sys.argv[2:])
+    apply_thread_arguments(args)
+    apply_training_arguments(args)
+
     if args.algorithm == "quantile_iv":
         quantile_iv_main(args)
     elif args.algorithm == "deep_iv":
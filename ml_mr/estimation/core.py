@@ -8,6 +8,10 @@ import torch
 
 from scipy.interpolate import interp1d
 
+from ..utils.data import to_compute_dtype
+from ..utils.nn import MLP, Bfloat16Autocast, compile_mlp
+from ..utils.training import resolve_precision
+
 
 INTERPOLATION = ["linear", "quadratic", "cubic"]
 Interpolation = Literal["linear", "quadratic", "cubic"]
@@ -17,7 +21,17 @@ InterpolationCallable = Callable[[torch.Tensor], torch.Tensor]
 MREstimatorType = TypeVar("MREstimatorType", bound="MREstimator")
 
 
-def load_estimator(dirname: str):
+def load_estimator(
+    dirname: str,
+    compile_inference: Optional[bool] = None,
+    precision: Optional[str] = None
+):
+    """Loads a fitted estimator from its output directory.
+
+    The estimator is prepared for evaluation by configure_inference with the
+    compile_inference and precision options.
+
+    """
     with open(os.path.join(dirname, "meta.json"), "rt") as f:
         meta = json.load(f)
 
@@ -25,7 +39,38 @@ def load_estimator(dirname: str):
     module = importlib.import_module(f".{model}", package=__package__)
     loader = getattr(module, "load")
 
-    return loader(dirname)
+    estimator = loader(dirname)
+    configure_inference(estimator, dirname, compile_inference, precision)
+
+    return estimator
+
+
+def configure_inference(
+    estimator: "MREstimator",
+    dirname: str,
+    compile_inference: Optional[bool] = None,
+    precision: Optional[str] = None
+) -> None:
+    """Prepares a loaded estimator for evaluation.
+
+    If compile_inference is set, the networks are compiled for faster
+    evaluation (see MREstimator.compile_inference) and the compiled versions
+    are cached in the estimator's directory. It defaults to the
+    ML_MR_COMPILE_INFERENCE environment variable.
+
+    With precision="bf16" (or ML_MR_PRECISION=bf16), the networks that are
+    not compiled are evaluated with bfloat16 autocast (see
+    MREstimator.enable_mixed_precision).
+
+    """
+    if compile_inference is None:
+        compile_inference = os.environ.get("ML_MR_COMPILE_INFERENCE") == "1"
+
+    if compile_inference:
+        estimator.compile_inference(cache_dir=dirname)
+
+    if resolve_precision(precision) == "bf16":
+        estimator.enable_mixed_precision()
 
 
 class MREstimator(object):
@@ -39,6 +84,9 @@ class MREstimator(object):
             self.covars = None
             return
 
+        # Covariables may be saved in a compact storage dtype.
+        covars = to_compute_dtype(covars)
+
         # Sample covariates if needed.
         if num_samples <= covars.shape[0]:
             idx = torch.multinomial(
@@ -52,7 +100,42 @@ class MREstimator(object):
         self.meta = meta
 
     def set_covars(self, covars: torch.Tensor) -> None:
-        self.covars = covars
+        self.covars = to_compute_dtype(covars)
+
+    def compile_inference(self, cache_dir: Optional[str] = None) -> None:
+        """Replaces the layers of the MLP networks by compiled versions.
+
+        The BatchNorm layers are folded into the Linear layers and the stacks
+        are compiled with TorchScript (see compile_mlp). This is only for
+        evaluation, the networks can't be trained or saved afterwards. If a
+        cache directory is given, the compiled networks are saved next to
+        their checkpoints (e.g. outcome_network.ckpt) and reused.
+
+        """
+        for name, network in vars(self).items():
+            if not isinstance(network, MLP) or \
+                    not isinstance(network.mlp, torch.nn.Sequential):
+                continue
+
+            if cache_dir is None:
+                checkpoint, cache = None, None
+            else:
+                checkpoint = os.path.join(cache_dir, f"{name}.ckpt")
+                cache = os.path.join(cache_dir, f"{name}.compiled.pt")
+
+            network.mlp = compile_mlp(network.mlp, cache, checkpoint)
+
+    def enable_mixed_precision(self) -> None:
+        """Evaluates the MLP networks with bfloat16 autocast.
+
+        The outputs of the networks are cast back to float32. This is only
+        for evaluation and networks that were compiled are left as is.
+
+        """
+        for network in vars(self).values():
+            if isinstance(network, MLP) and \
+                    isinstance(network.mlp, torch.nn.Sequential):
+                network.mlp = Bfloat16Autocast(network.mlp)
 
     def iv_reg_function(
         self,
@@ -210,6 +293,12 @@ class RescaledMREstimator(MREstimator):
         # Mimic properties.
         self.covars = getattr(self.parent, "covars", None)
 
+    def compile_inference(self, cache_dir: Optional[str] = None) -> None:
+        self.parent.compile_inference(cache_dir)
+
+    def enable_mixed_precision(self) -> None:
+        self.parent.enable_mixed_precision()
+
     def x_to_z(self, x):
         # z = x * scale + shift
         return (x * self.scale) + self.shift
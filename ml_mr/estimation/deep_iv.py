@@ -1,8 +1,10 @@
 
 import argparse
+import functools
 import json
 import os
 import pickle
+import shutil
 from typing import Dict, Iterable, List, Literal, Optional, Tuple, Type
 
 import matplotlib.pyplot as plt
@@ -18,7 +20,13 @@ from ..utils.data import (IVDataset, IVDatasetWithGenotypes,
 from ..utils.models import (MLP, GaussianNet, MixtureDensityNetwork,
                             OutcomeMLPBase, RidgeDensity)
 from ..utils.nn import DensityModel
-from ..utils.training import train_model
+from ..utils.perf import PerfReport, TrainingStats
+from ..utils.stage1_store import (Stage1Store, add_stage1_store_arguments,
+                                  fetch_or_train, stage1_key)
+from ..utils.training import (add_init_from_arguments,
+                              load_checkpoint, load_compatible_weights,
+                              split_generator,
+                              train_model)
 from .core import MREstimator
 
 # Supported models for the exposure network.
@@ -48,6 +56,7 @@ DEFAULTS = {
     "outcome_weight_decay": 1e-4,
     "exposure_add_input_batchnorm": False,
     "outcome_add_input_batchnorm": False,
+    "exposure_optimizer": "adam",
     "accelerator": "gpu" if (
         torch.cuda.is_available() and torch.cuda.device_count() > 0
     ) else "cpu",
@@ -185,7 +194,8 @@ class DeepIVEstimator(MREstimator):
             dir_name, meta["exposure_network_type"]
         ).to(cpu)
 
-        outcome_network = OutcomeMLP.load_from_checkpoint(
+        outcome_network = load_checkpoint(
+            OutcomeMLP,
             os.path.join(dir_name, "outcome_network.ckpt"),
             exposure_network=exposure_network
         ).to(cpu)
@@ -216,17 +226,29 @@ def main(args: argparse.Namespace) -> None:
     if args.exposure_network_type != "mixture_density_net":
         args.n_gaussians = None
 
+    perf = PerfReport()
+    perf.begin("data_load")
     dataset = IVDatasetWithGenotypes.from_argparse_namespace(args)
 
     # Automatically add the model hyperparameters.
     kwargs = {k: v for k, v in vars(args).items() if k in DEFAULTS.keys()}
     del kwargs["outcome_type"]
 
+    if args.outcome_optimizer != "adam":
+        # The outcome loss uses samples from the exposure model, so it is
+        # not deterministic and not suitable for L-BFGS.
+        info("The Deep IV outcome model is always trained with adam.")
+
     fit_deep_iv(
         dataset=dataset,
         fast=args.fast,
         wandb_project=args.wandb_project,
         binary_outcome=args.outcome_type == "binary",
+        init_from=args.init_from,
+        init_freeze_stage1=args.init_freeze_stage1,
+        split_seed=args.split_seed,
+        stage1_store=args.stage1_store,
+        perf=perf,
         **kwargs,
     )
 
@@ -245,8 +267,11 @@ def train_exposure_model(
     max_epochs: int,
     n_gaussians: int = 5,
     accelerator: Optional[str] = None,
-    wandb_project: Optional[str] = None
-) -> Optional[float]:
+    wandb_project: Optional[str] = None,
+    init_checkpoint: Optional[str] = None,
+    optimizer: str = "adam",
+    stats: Optional[TrainingStats] = None
+) -> Tuple[DensityModel, Optional[float]]:
     info("Training exposure model.")
 
     if exposure_network_type == "mixture_density_net":
@@ -285,9 +310,12 @@ def train_exposure_model(
         with open(os.path.join(output_dir, "exposure_network.pkl"), "wb") as f:
             pickle.dump(model, f)
 
-        return None
+        return model, None
+
+    if init_checkpoint is not None:
+        load_compatible_weights(model, init_checkpoint)
 
-    return train_model(
+    return model, train_model(
         SupervisedLearningWrapper(train_dataset),  # type: ignore
         SupervisedLearningWrapper(val_dataset),  # type: ignore
         model,
@@ -297,7 +325,9 @@ def train_exposure_model(
         batch_size=batch_size,
         max_epochs=max_epochs,
         accelerator=accelerator,
-        wandb_project=wandb_project
+        wandb_project=wandb_project,
+        optimizer=optimizer,
+        stats=stats
     )
 
 
@@ -314,8 +344,10 @@ def train_outcome_model(
     max_epochs: int,
     accelerator: Optional[str] = None,
     binary_outcome: bool = False,
-    wandb_project: Optional[str] = None
-) -> float:
+    wandb_project: Optional[str] = None,
+    init_checkpoint: Optional[str] = None,
+    stats: Optional[TrainingStats] = None
+) -> Tuple[OutcomeMLP, float]:
     info("Training outcome model.")
     n_covars = train_dataset[0][3].numel()
     model = OutcomeMLP(
@@ -328,7 +360,12 @@ def train_outcome_model(
         add_input_layer_batchnorm=add_input_batchnorm,
     )
 
-    return train_model(
+    if init_checkpoint is not None:
+        load_compatible_weights(
+            model, init_checkpoint, ignore_prefixes=("exposure_network.", )
+        )
+
+    return model, train_model(
         train_dataset,
         val_dataset,
         model,
@@ -338,7 +375,8 @@ def train_outcome_model(
         batch_size=batch_size,
         max_epochs=max_epochs,
         accelerator=accelerator,
-        wandb_project=wandb_project
+        wandb_project=wandb_project,
+        stats=stats
     )
 
 
@@ -352,8 +390,9 @@ def _load_exposure_model_from_dir(
             return pickle.load(f)
 
     filename = os.path.join(dirname, "exposure_network.ckpt")
-    exposure_network = NET_TO_CLASS[exposure_network_type]\
-        .load_from_checkpoint(filename).eval()  # type: ignore
+    exposure_network = load_checkpoint(
+        NET_TO_CLASS[exposure_network_type], filename  # type: ignore
+    ).eval()
 
     exposure_network.freeze()
     return exposure_network
@@ -373,6 +412,7 @@ def fit_deep_iv(
     exposure_batch_size: int = DEFAULTS["exposure_batch_size"],  # type: ignore
     exposure_max_epochs: int = DEFAULTS["exposure_max_epochs"],  # type: ignore
     exposure_add_input_batchnorm: bool = DEFAULTS["exposure_add_input_batchnorm"],  # type: ignore # noqa: E501
+    exposure_optimizer: str = DEFAULTS["exposure_optimizer"],  # type: ignore
     outcome_hidden: List[int] = DEFAULTS["outcome_hidden"],  # type: ignore
     outcome_learning_rate: float = DEFAULTS["outcome_learning_rate"],  # type: ignore # noqa: E501
     outcome_weight_decay: float = DEFAULTS["outcome_weight_decay"],  # type: ignore # noqa: E501
@@ -380,8 +420,18 @@ def fit_deep_iv(
     outcome_max_epochs: int = DEFAULTS["outcome_max_epochs"],  # type: ignore
     outcome_add_input_batchnorm: bool = DEFAULTS["outcome_add_input_batchnorm"],  # type: ignore # noqa: E501
     accelerator: str = DEFAULTS["accelerator"],  # type: ignore
-    wandb_project: Optional[str] = None
+    wandb_project: Optional[str] = None,
+    init_from: Optional[str] = None,
+    init_freeze_stage1: bool = False,
+    split_seed: Optional[int] = None,
+    stage1_store: Optional[str] = None,
+    perf: Optional[PerfReport] = None
 ) -> DeepIVEstimator:
+    if perf is None:
+        perf = PerfReport()
+
+    perf.begin("split")
+
     # Create output directory if needed.
     if not os.path.isdir(output_dir):
         os.makedirs(output_dir)
@@ -392,38 +442,99 @@ def fit_deep_iv(
     meta.update(dataset.exposure_descriptive_statistics())
     meta["covariable_labels"] = dataset.covariable_labels
     del meta["dataset"]  # We don't serialize the dataset.
+    del meta["perf"]
 
     covars = dataset.save_covariables(output_dir)
+    dataset.save_instrument_compressor(output_dir)
 
     # Split here into train and val.
     train_dataset, val_dataset = random_split(
-        dataset, [1 - validation_proportion, validation_proportion]
+        dataset, [1 - validation_proportion, validation_proportion],
+        generator=split_generator(split_seed)
     )
 
-    exposure_val_loss = train_exposure_model(
-        exposure_network_type=exposure_network_type,
-        train_dataset=train_dataset,
-        val_dataset=val_dataset,
-        input_size=dataset.n_exog(),
-        output_dir=output_dir,
-        hidden=exposure_hidden,
-        learning_rate=exposure_learning_rate,
-        weight_decay=exposure_weight_decay,
-        batch_size=exposure_batch_size,
-        add_input_batchnorm=exposure_add_input_batchnorm,
-        max_epochs=exposure_max_epochs,
-        n_gaussians=n_gaussians,
-        accelerator=accelerator,
-        wandb_project=wandb_project
+    perf.begin("stage1")
+
+    exposure_filename = (
+        "exposure_network.pkl" if exposure_network_type == "ridge"
+        else "exposure_network.ckpt"
     )
 
+    # Exposure models trained from scratch can be reused by other fits.
+    store = None
+    if init_from is None:
+        store = Stage1Store.from_option(stage1_store)
+
+    store_key = None
+    if store is not None:
+        store_key = stage1_key(train_dataset, val_dataset, split_seed, {
+            "model": "deep_iv",
+            "exposure_network_type": exposure_network_type,
+            "n_gaussians": n_gaussians,
+            "hidden": exposure_hidden,
+            "learning_rate": exposure_learning_rate,
+            "weight_decay": exposure_weight_decay,
+            "batch_size": exposure_batch_size,
+            "max_epochs": exposure_max_epochs,
+            "add_input_batchnorm": exposure_add_input_batchnorm,
+            "optimizer": exposure_optimizer,
+        })
+        meta["stage1_key"] = store_key
+
+    if init_from is not None and init_freeze_stage1:
+        info(f"Using the exposure model from '{init_from}'.")
+        shutil.copyfile(
+            os.path.join(init_from, exposure_filename),
+            os.path.join(output_dir, exposure_filename)
+        )
+        exposure_network = _load_exposure_model_from_dir(
+            output_dir, exposure_network_type
+        )
+        with open(os.path.join(init_from, "meta.json"), "rt") as f:
+            exposure_val_loss = json.load(f).get("exposure_val_loss")
+
+    else:
+        exposure_network, exposure_val_loss = fetch_or_train(
+            store,
+            store_key,
+            output_dir,
+            [exposure_filename],
+            train=functools.partial(
+                train_exposure_model,
+                exposure_network_type=exposure_network_type,
+                train_dataset=train_dataset,
+                val_dataset=val_dataset,
+                input_size=dataset.n_exog(),
+                output_dir=output_dir,
+                hidden=exposure_hidden,
+                learning_rate=exposure_learning_rate,
+                weight_decay=exposure_weight_decay,
+                batch_size=exposure_batch_size,
+                add_input_batchnorm=exposure_add_input_batchnorm,
+                max_epochs=exposure_max_epochs,
+                n_gaussians=n_gaussians,
+                accelerator=accelerator,
+                wandb_project=wandb_project,
+                init_checkpoint=(
+                    None if init_from is None
+                    else os.path.join(init_from, "exposure_network.ckpt")
+                ),
+                optimizer=exposure_optimizer,
+                stats=perf.training_stats("exposure_network")
+            ),
+            load=functools.partial(
+                _load_exposure_model_from_dir,
+                output_dir, exposure_network_type
+            )
+        )
+
     meta["exposure_val_loss"] = exposure_val_loss
 
-    exposure_network = _load_exposure_model_from_dir(
-        output_dir, exposure_network_type
-    )
+    exposure_network = exposure_network.to(torch.device("cpu")).eval()
+    exposure_network.freeze()
 
-    outcome_val_loss = train_outcome_model(
+    perf.begin("stage2")
+    outcome_network, outcome_val_loss = train_outcome_model(
         train_dataset=train_dataset,
         val_dataset=val_dataset,
         exposure_network=exposure_network,
@@ -436,31 +547,34 @@ def fit_deep_iv(
         max_epochs=outcome_max_epochs,
         accelerator=accelerator,
         binary_outcome=binary_outcome,
-        wandb_project=wandb_project
+        wandb_project=wandb_project,
+        init_checkpoint=(
+            None if init_from is None
+            else os.path.join(init_from, "outcome_network.ckpt")
+        ),
+        stats=perf.training_stats("outcome_network")
     )
 
     meta["outcome_val_loss"] = outcome_val_loss
 
-    outcome_network = OutcomeMLP.load_from_checkpoint(
-        os.path.join(output_dir, "outcome_network.ckpt"),
-        exposure_network=exposure_network,
-    ).eval()  # type: ignore
-
+    outcome_network = outcome_network.to(torch.device("cpu")).eval()
     outcome_network.freeze()
 
     estimator = DeepIVEstimator(
         exposure_network, outcome_network, meta, covars
     )
 
-    with open(os.path.join(output_dir, "meta.json"), "wt") as f:
-        json.dump(meta, f)
-
+    perf.begin("artifacts")
     if not fast:
         save_estimator_statistics(
             estimator, covars, domain=meta["domain"],
             output_prefix=os.path.join(output_dir, "causal_estimates"),
         )
 
+    meta["perf"] = perf.to_dict()
+    with open(os.path.join(output_dir, "meta.json"), "wt") as f:
+        json.dump(meta, f)
+
     if wandb_project is not None:
         import wandb
         _, run_name = parse_project_and_run_name(wandb_project)
@@ -554,6 +668,9 @@ def configure_argparse(parser) -> None:
              "allowed."
     )
 
+    add_init_from_arguments(parser)
+    add_stage1_store_arguments(parser)
+
     MLP.add_mlp_arguments(
         parser,
         "exposure-",
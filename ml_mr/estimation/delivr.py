@@ -11,19 +11,26 @@ Biostatistics, January. https://doi.org/10.1093/biostatistics/kxac051.
 import argparse
 import json
 import os
-from typing import Iterable, List, Optional
+from typing import Iterable, List, Optional, Tuple
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.utils.data import Dataset, random_split
 
+from ..logging import info
 from ..utils import (_cat, default_validate_args, initialize_meta,
                      parse_project_and_run_name)
 from ..utils.data import FullBatchDataLoader, IVDataset, IVDatasetWithGenotypes
 from ..utils.linear import ridge_regression
 from ..utils.models import MLP
-from ..utils.training import resample_dataset, train_model
+from ..utils.nn import split_sample_weights, weighted_loss
+from ..utils.perf import PerfReport, TrainingStats
+from ..utils.training import (RESAMPLE_MODES, add_init_from_arguments,
+                              load_checkpoint, load_compatible_weights,
+                              resample_dataset,
+                              resample_replicates, save_lightning_checkpoint,
+                              split_generator, train_model, train_replicates)
 from .core import MREstimator
 
 DEFAULTS = {
@@ -33,6 +40,7 @@ DEFAULTS = {
     "output_dir": "delivr_estimate",
     "learning_rate": 5e-3,
     "weight_decay": 1e-4,
+    "optimizer": "adam",
     "validation_proportion": 0.2,
     "outcome_type": "continuous",
     "accelerator": "gpu" if (
@@ -44,24 +52,85 @@ DEFAULTS = {
 def fit_lin_exposure_model(dataset: Dataset) -> torch.Tensor:
     dl = FullBatchDataLoader(dataset)
 
-    x, _, ivs, covars = next(iter(dl))
+    (x, _, ivs, covars), weights = split_sample_weights(next(iter(dl)), 4)
 
-    return ridge_regression(_cat(ivs, covars), x, alpha=0)
+    return _weighted_least_squares(_cat(ivs, covars), x, weights)
+
+
+def fit_lin_exposure_models(dataset: Dataset) -> List[torch.Tensor]:
+    """Linear first stage of every bootstrap replicate.
+
+    The dataset has one column of sample weights per replicate (see
+    resample_replicates).
+
+    """
+    dl = FullBatchDataLoader(dataset)
+
+    (x, _, ivs, covars), weights = split_sample_weights(next(iter(dl)), 4)
+    z = _cat(ivs, covars)
+
+    return [
+        _weighted_least_squares(z, x, weights[:, b])
+        for b in range(weights.size(1))
+    ]
+
+
+def _weighted_least_squares(
+    z: torch.Tensor,
+    x: torch.Tensor,
+    weights: Optional[torch.Tensor]
+) -> torch.Tensor:
+    if weights is not None:
+        # Weighted least squares by rescaling the rows.
+        w = torch.sqrt(weights).reshape(-1, 1)
+        z, x = z * w, x * w
+
+    return ridge_regression(z, x, alpha=0)
 
 
 def main(args: argparse.Namespace) -> None:
     default_validate_args(args)
+
+    perf = PerfReport()
+    perf.begin("data_load")
     dataset = IVDatasetWithGenotypes.from_argparse_namespace(args)
 
     # Automatically add the model hyperparameters.
     kwargs = {k: v for k, v in vars(args).items() if k in DEFAULTS.keys()}
     del kwargs["outcome_type"]
 
+    if args.n_replicates is not None:
+        if args.wandb_project is not None:
+            raise ValueError(
+                "Bootstrap replicates can't be logged to wandb."
+            )
+
+        fit_delivr_replicates(
+            dataset=dataset,
+            n_replicates=args.n_replicates,
+            binary_outcome=args.outcome_type == "binary",
+            resample_mode=(
+                "multinomial" if args.resample_mode == "multinomial"
+                else "poisson"
+            ),
+            init_from=args.init_from,
+            init_freeze_stage1=args.init_freeze_stage1,
+            split_seed=args.split_seed,
+            perf=perf,
+            **kwargs,
+        )
+        return
+
     fit_delivr(
         dataset=dataset,
         wandb_project=args.wandb_project,
         binary_outcome=args.outcome_type == "binary",
         resample=args.resample,
+        resample_mode=args.resample_mode,
+        init_from=args.init_from,
+        init_freeze_stage1=args.init_freeze_stage1,
+        split_seed=args.split_seed,
+        perf=perf,
         **kwargs,
     )
 
@@ -70,6 +139,7 @@ def fit_delivr(
     dataset: IVDataset,
     stage2_dataset: Optional[IVDataset] = None,  # type: ignore
     resample: bool = False,
+    resample_mode: str = "rows",
     output_dir: str = DEFAULTS["output_dir"],  # type: ignore
     validation_proportion: float = DEFAULTS["validation_proportion"],  # type: ignore # noqa: E501
     binary_outcome: bool = False,
@@ -78,13 +148,25 @@ def fit_delivr(
     weight_decay: float = DEFAULTS["weight_decay"],  # type: ignore
     batch_size: int = DEFAULTS["batch_size"],  # type: ignore
     max_epochs: int = DEFAULTS["max_epochs"],  # type: ignore
+    optimizer: str = DEFAULTS["optimizer"],  # type: ignore
     accelerator: str = DEFAULTS["accelerator"],  # type: ignore
-    wandb_project: Optional[str] = None
+    wandb_project: Optional[str] = None,
+    init_from: Optional[str] = None,
+    init_freeze_stage1: bool = False,
+    split_seed: Optional[int] = None,
+    perf: Optional[PerfReport] = None
 ):
+    if perf is None:
+        perf = PerfReport()
+
+    perf.begin("split")
+
     if resample:
-        dataset = resample_dataset(dataset)  # type: ignore
+        dataset = resample_dataset(dataset, resample_mode)  # type: ignore
         if stage2_dataset is not None:
-            stage2_dataset = resample_dataset(stage2_dataset)  # type: ignore
+            stage2_dataset = resample_dataset(  # type: ignore
+                stage2_dataset, resample_mode
+            )
 
     # Create output directory if needed.
     if not os.path.isdir(output_dir):
@@ -98,28 +180,42 @@ def fit_delivr(
     meta["covariable_labels"] = dataset.covariable_labels
     del meta["dataset"]
     del meta["stage2_dataset"]
+    del meta["perf"]
 
-    dataset.save_covariables(output_dir)
+    covars = dataset.save_covariables(output_dir)
+    dataset.save_instrument_compressor(output_dir)
 
     # Split here into train and val.
     train_dataset, val_dataset = random_split(
-        dataset, [1 - validation_proportion, validation_proportion]
+        dataset, [1 - validation_proportion, validation_proportion],
+        generator=split_generator(split_seed)
     )
 
     if stage2_dataset is not None:
         assert dataset.covariable_labels == stage2_dataset.covariable_labels
         stg2_train_dataset, stg2_val_dataset = random_split(
-            stage2_dataset, [1 - validation_proportion, validation_proportion]
+            stage2_dataset, [1 - validation_proportion, validation_proportion],
+            generator=split_generator(split_seed)
         )
     else:
         stg2_train_dataset, stg2_val_dataset = (
             train_dataset, val_dataset
         )
 
-    # Use linear first stage on whole training dataset.
-    stg1_betas = fit_lin_exposure_model(train_dataset)
+    perf.begin("stage1")
+
+    if init_from is not None and init_freeze_stage1:
+        # The linear first stage is stored with the outcome model.
+        info(f"Using the first stage coefficients from '{init_from}'.")
+        stg1_betas = load_checkpoint(
+            OutcomeMLP, os.path.join(init_from, "outcome_network.ckpt")
+        ).betas
+    else:
+        # Use linear first stage on whole training dataset.
+        stg1_betas = fit_lin_exposure_model(train_dataset)
 
-    outcome_val_loss = train_outcome_model(
+    perf.begin("stage2")
+    outcome_network, outcome_val_loss = train_outcome_model(
         train_dataset=stg2_train_dataset,
         val_dataset=stg2_val_dataset,
         output_dir=output_dir,
@@ -131,15 +227,24 @@ def fit_delivr(
         max_epochs=max_epochs,
         accelerator=accelerator,
         binary_outcome=binary_outcome,
-        wandb_project=wandb_project
+        wandb_project=wandb_project,
+        init_checkpoint=(
+            None if init_from is None
+            else os.path.join(init_from, "outcome_network.ckpt")
+        ),
+        optimizer=optimizer,
+        stats=perf.training_stats("outcome_network")
     )
 
     meta["outcome_val_loss"] = outcome_val_loss
 
+    meta["perf"] = perf.to_dict()
     with open(os.path.join(output_dir, "meta.json"), "wt") as f:
         json.dump(meta, f)
 
-    estimator = DeLIVREstimator.from_results(output_dir)
+    estimator = DeLIVREstimator(
+        outcome_network.to(torch.device("cpu")).eval(), meta, covars
+    )
 
     if wandb_project is not None:
         import wandb
@@ -155,6 +260,147 @@ def fit_delivr(
     return estimator
 
 
+def fit_delivr_replicates(
+    dataset: IVDataset,
+    n_replicates: int,
+    stage2_dataset: Optional[IVDataset] = None,  # type: ignore
+    resample_mode: str = "poisson",
+    output_dir: str = DEFAULTS["output_dir"],  # type: ignore
+    validation_proportion: float = DEFAULTS["validation_proportion"],  # type: ignore # noqa: E501
+    binary_outcome: bool = False,
+    hidden: List[int] = DEFAULTS["hidden"],  # type: ignore
+    learning_rate: float = DEFAULTS["learning_rate"],  # type: ignore
+    weight_decay: float = DEFAULTS["weight_decay"],  # type: ignore
+    batch_size: int = DEFAULTS["batch_size"],  # type: ignore
+    max_epochs: int = DEFAULTS["max_epochs"],  # type: ignore
+    optimizer: str = DEFAULTS["optimizer"],  # type: ignore
+    accelerator: str = DEFAULTS["accelerator"],  # type: ignore
+    init_from: Optional[str] = None,
+    init_freeze_stage1: bool = False,
+    split_seed: Optional[int] = None,
+    perf: Optional[PerfReport] = None
+) -> List["DeLIVREstimator"]:
+    """Fits bootstrap replicates of the DeLIVR estimator together.
+
+    Every replicate has its own weighted linear first stage and the outcome
+    networks are trained at once (see fit_replicates). The replicates are
+    saved in output_dir/replicate_<i> like regular estimators.
+
+    """
+    if n_replicates < 2:
+        raise ValueError("Need at least two bootstrap replicates.")
+
+    if perf is None:
+        perf = PerfReport()
+
+    perf.begin("split")
+
+    if optimizer != "adam":
+        info("Bootstrap replicates are always trained with adam.")
+
+    meta = dict(locals())
+    meta["model"] = "delivr"
+    meta["resample"] = True
+    meta.update(initialize_meta())
+    meta.update(dataset.exposure_descriptive_statistics())
+    meta["covariable_labels"] = dataset.covariable_labels
+    del meta["dataset"]
+    del meta["stage2_dataset"]
+    del meta["perf"]
+
+    # The train and validation split is shared by the replicates, only the
+    # bootstrap weights differ.
+    train_dataset, val_dataset = random_split(
+        resample_replicates(dataset, n_replicates, resample_mode),
+        [1 - validation_proportion, validation_proportion],
+        generator=split_generator(split_seed)
+    )
+
+    if stage2_dataset is not None:
+        assert dataset.covariable_labels == stage2_dataset.covariable_labels
+        stg2_train_dataset, stg2_val_dataset = random_split(
+            resample_replicates(stage2_dataset, n_replicates, resample_mode),
+            [1 - validation_proportion, validation_proportion],
+            generator=split_generator(split_seed)
+        )
+    else:
+        stg2_train_dataset, stg2_val_dataset = (
+            train_dataset, val_dataset
+        )
+
+    perf.begin("stage1")
+
+    if init_from is not None and init_freeze_stage1:
+        info(f"Using the first stage coefficients from '{init_from}'.")
+        stg1_betas = [load_checkpoint(
+            OutcomeMLP, os.path.join(init_from, "outcome_network.ckpt")
+        ).betas] * n_replicates
+    else:
+        stg1_betas = fit_lin_exposure_models(train_dataset)
+
+    perf.begin("stage2")
+    info(f"Training {n_replicates} outcome models.")
+    n_covars = stg2_train_dataset[0][3].numel()
+    outcome_networks = [
+        OutcomeMLP(
+            input_size=n_covars + 1,
+            betas=betas,
+            hidden=hidden,
+            lr=learning_rate,
+            weight_decay=weight_decay,
+            binary_outcome=binary_outcome,
+        )
+        for betas in stg1_betas
+    ]
+
+    if init_from is not None:
+        for outcome_network in outcome_networks:
+            load_compatible_weights(
+                outcome_network,
+                os.path.join(init_from, "outcome_network.ckpt")
+            )
+
+    outcome_val_losses = train_replicates(
+        stg2_train_dataset,
+        stg2_val_dataset,
+        outcome_networks,  # type: ignore
+        monitored_metric="outcome_val_loss",
+        batch_size=batch_size,
+        max_epochs=max_epochs,
+        accelerator=accelerator
+    )
+
+    perf.begin("artifacts")
+    estimators = []
+    for i in range(n_replicates):
+        replicate_dir = os.path.join(output_dir, f"replicate_{i}")
+        if not os.path.isdir(replicate_dir):
+            os.makedirs(replicate_dir)
+
+        outcome_network = outcome_networks[i].to(torch.device("cpu")).eval()
+        save_lightning_checkpoint(
+            outcome_network,
+            os.path.join(replicate_dir, "outcome_network.ckpt")
+        )
+
+        covars = dataset.save_covariables(replicate_dir)
+        dataset.save_instrument_compressor(replicate_dir)
+
+        replicate_meta = dict(meta)
+        replicate_meta["output_dir"] = replicate_dir
+        replicate_meta["replicate"] = i
+        replicate_meta["outcome_val_loss"] = outcome_val_losses[i]
+        replicate_meta["perf"] = perf.to_dict()
+        with open(os.path.join(replicate_dir, "meta.json"), "wt") as f:
+            json.dump(replicate_meta, f)
+
+        estimators.append(
+            DeLIVREstimator(outcome_network, replicate_meta, covars)
+        )
+
+    return estimators
+
+
 class OutcomeMLP(MLP):
     def __init__(
         self,
@@ -180,7 +426,10 @@ class OutcomeMLP(MLP):
             weight_decay=weight_decay,
             loss=loss
         )
-        self.betas = betas
+        # A buffer so that bootstrap replicates trained together each use
+        # their own first stage. It is not saved in the state dict, the
+        # coefficients are restored from the hyperparameters.
+        self.register_buffer("betas", betas, persistent=False)
 
     def on_fit_start(self) -> None:
         self.betas = self.betas.to(self.device)  # type: ignore
@@ -192,7 +441,7 @@ class OutcomeMLP(MLP):
         return self.mlp(_cat(x, covars))
 
     def _step(self, batch, batch_index, log_prefix):
-        _, y, ivs, covars = batch
+        (_, y, ivs, covars), weights = split_sample_weights(batch, 4)
 
         # Get E[X|Z]
         x_hat = _cat(ivs, covars) @ self.betas
@@ -200,7 +449,7 @@ class OutcomeMLP(MLP):
         # Get h_hat(x_hat)
         y_hat = self.x_to_y(x_hat, covars)
 
-        loss = self.loss(y_hat, y)
+        loss = weighted_loss(self.loss, weights, y_hat, y)
 
         self.log(f"outcome_{log_prefix}_loss", loss)
 
@@ -219,8 +468,11 @@ def train_outcome_model(
         max_epochs: int,
         accelerator: Optional[str] = None,
         binary_outcome: bool = False,
-        wandb_project: Optional[str] = None
-) -> float:
+        wandb_project: Optional[str] = None,
+        init_checkpoint: Optional[str] = None,
+        optimizer: str = "adam",
+        stats: Optional[TrainingStats] = None
+) -> Tuple["OutcomeMLP", float]:
     n_covars = train_dataset[0][3].numel()
     model = OutcomeMLP(
         input_size=n_covars + 1,
@@ -231,7 +483,10 @@ def train_outcome_model(
         binary_outcome=binary_outcome,
     )
 
-    return train_model(
+    if init_checkpoint is not None:
+        load_compatible_weights(model, init_checkpoint)
+
+    return model, train_model(
         train_dataset,
         val_dataset,
         model=model,
@@ -241,7 +496,9 @@ def train_outcome_model(
         batch_size=batch_size,
         max_epochs=max_epochs,
         accelerator=accelerator,
-        wandb_project=wandb_project
+        wandb_project=wandb_project,
+        optimizer=optimizer,
+        stats=stats
     )
 
 
@@ -273,9 +530,8 @@ class DeLIVREstimator(MREstimator):
         except FileNotFoundError:
             covars = None
 
-        outcome_network = OutcomeMLP.load_from_checkpoint(
-            os.path.join(dir_name, "outcome_network.ckpt"),
-            map_location=torch.device("cpu")
+        outcome_network = load_checkpoint(
+            OutcomeMLP, os.path.join(dir_name, "outcome_network.ckpt")
         )
 
         outcome_network.eval()
@@ -292,6 +548,16 @@ def configure_argparse(parser) -> None:
         action="store_true"
     )
 
+    parser.add_argument(
+        "--resample-mode",
+        default="rows",
+        choices=RESAMPLE_MODES,
+        help="How bootstrap samples are represented when --resample is used. "
+        "'rows' duplicates the drawn rows, 'multinomial' uses the number of "
+        "draws as sample weights and 'poisson' draws independent Poisson "
+        "weights.",
+    )
+
     parser.add_argument(
         "--outcome-type",
         default=DEFAULTS["outcome_type"],
@@ -314,6 +580,13 @@ def configure_argparse(parser) -> None:
         default=DEFAULTS["validation_proportion"],
     )
 
+    parser.add_argument(
+        "--split-seed",
+        default=None,
+        type=int,
+        help="Seed of the random train and validation split.",
+    )
+
     parser.add_argument(
         "--wandb-project",
         default=None,
@@ -323,6 +596,18 @@ def configure_argparse(parser) -> None:
              "allowed."
     )
 
+    add_init_from_arguments(parser)
+
+    parser.add_argument(
+        "--n-replicates",
+        default=None,
+        type=int,
+        help="Fit this many bootstrap replicates together in one process. "
+        "Every replicate is saved in output_dir/replicate_<i>. This implies "
+        "--resample and uses the 'poisson' resample mode unless "
+        "'multinomial' is requested.",
+    )
+
     IVDatasetWithGenotypes.add_dataset_arguments(parser)
 
 
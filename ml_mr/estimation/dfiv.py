@@ -45,7 +45,7 @@ estimator = DFIVEstimator.from_results("dfiv_estimate")
 import argparse
 import json
 import os
-from typing import Dict, Iterable, List, Optional, Union
+from typing import Dict, Iterable, List, Optional, Tuple, Union
 
 import pytorch_lightning as pl
 import torch
@@ -59,7 +59,9 @@ from ..utils.conformal import OutcomeResidualPrediction
 from ..utils.data import IVDataset, IVDatasetWithGenotypes
 from ..utils.linear import ridge_fit_predict
 from ..utils.nn import build_mlp
-from ..utils.training import train_model
+from ..utils.perf import PerfReport, TrainingStats
+from ..utils.training import (add_init_from_arguments, load_checkpoint,
+                              load_compatible_weights, train_model)
 from .core import MREstimator, MREstimatorWithUncertainty
 
 
@@ -442,6 +444,8 @@ def get_betas(
 def main(args: argparse.Namespace) -> None:
     default_validate_args(args)
 
+    perf = PerfReport()
+    perf.begin("data_load")
     dataset = IVDatasetWithGenotypes.from_argparse_namespace(args)
 
     # Automatically add the model hyperparameters.
@@ -450,6 +454,9 @@ def main(args: argparse.Namespace) -> None:
     fit_dfiv(
         dataset=dataset,
         wandb_project=args.wandb_project,
+        init_from=args.init_from,
+        init_freeze_stage1=args.init_freeze_stage1,
+        perf=perf,
         **kwargs,
     )
 
@@ -573,6 +580,8 @@ def configure_argparse(parser) -> None:
         default=None
     )
 
+    add_init_from_arguments(parser)
+
 
 def fit_dfiv(
     dataset: IVDataset,  # type: ignore # noqa: E501
@@ -595,8 +604,21 @@ def fit_dfiv(
     batch_size: int = DEFAULTS["batch_size"],   # type: ignore
     max_epochs: int = DEFAULTS["max_epochs"],   # type: ignore
     accelerator: str = DEFAULTS["accelerator"],  # type: ignore
-    wandb_project: Optional[str] = None
+    wandb_project: Optional[str] = None,
+    init_from: Optional[str] = None,
+    init_freeze_stage1: bool = False,
+    perf: Optional[PerfReport] = None
 ):
+    if perf is None:
+        perf = PerfReport()
+
+    perf.begin("split")
+
+    if init_from is not None and init_freeze_stage1:
+        # The instrument network is the first stage, we keep the initial
+        # weights by not updating it.
+        n_updates_stage1 = 0
+
     # Create output directory if needed.
     if not os.path.isdir(output_dir):
         os.makedirs(output_dir)
@@ -607,8 +629,10 @@ def fit_dfiv(
     meta.update(dataset.exposure_descriptive_statistics())
     meta["covariable_labels"] = dataset.covariable_labels
     del meta["dataset"]  # We don't serialize the dataset.
+    del meta["perf"]
 
     covars = dataset.save_covariables(output_dir)
+    dataset.save_instrument_compressor(output_dir)
 
     # Split here into train and val.
     train_dataset, val_dataset = random_split(
@@ -636,6 +660,11 @@ def fit_dfiv(
         covariate_net_learning_rate=covariate_net_learning_rate,
     )
 
+    if init_from is not None:
+        load_compatible_weights(
+            model, os.path.join(init_from, "dfiv_model.ckpt")
+        )
+
     # Cleanup weights if needed.
     try:
         os.remove(
@@ -644,6 +673,8 @@ def fit_dfiv(
     except FileNotFoundError:
         pass
 
+    # The two stages are trained together.
+    perf.begin("train")
     try:
         stage2_val_loss = train_model(
             train_dataset,
@@ -652,18 +683,16 @@ def fit_dfiv(
             "val_loss",
             output_dir,
             "dfiv_model.ckpt",
-            batch_size, max_epochs, accelerator, wandb_project
+            batch_size, max_epochs, accelerator, wandb_project,
+            stats=perf.training_stats("dfiv_model")
         )
         meta["stage2_val_loss"] = stage2_val_loss
     except RuntimeError:
         warn("Stopping at unsolvable configuration.")
         return
 
-    # Load the best model.
-    filename = os.path.join(output_dir, "dfiv_model.ckpt")
-    model = DFIVModel.load_from_checkpoint(filename)
-
-    model.eval()
+    # The model has the best weights after training.
+    model = model.to(torch.device("cpu")).eval()
 
     # Find the optimal coefficients for the linear weights.
     _2sls_results = get_betas(dataset, batch_size, model,
@@ -675,22 +704,18 @@ def fit_dfiv(
         os.path.join(output_dir, "linear_weights.pt")
     )
 
-    wrapped_model, resid_pred_loss = train_conformal_predictor(
+    perf.begin("conformal")
+    conformal_net, resid_pred_loss = train_conformal_predictor(
         train_dataset, val_dataset,
         model, _2sls_results["betas2"],
         alpha=0.1,
-        output_dir=output_dir
+        output_dir=output_dir,
+        stats=perf.training_stats("dfiv_calibration")
     )
 
     meta["resid_pred_loss"] = resid_pred_loss
 
-    conformal_net: OutcomeResidualPrediction = (
-        OutcomeResidualPrediction.load_from_checkpoint(
-            os.path.join(output_dir, "dfiv_calibration.ckpt"),
-            wrapped_model=wrapped_model
-        )
-    )
-
+    conformal_net = conformal_net.to(torch.device("cpu")).eval()
     conformal_net.set_q_hat_from_data(val_dataset)
     assert isinstance(conformal_net.q_hat, torch.Tensor)
     meta["q_hat"] = conformal_net.q_hat.item()
@@ -699,6 +724,7 @@ def fit_dfiv(
         conformal_net, _2sls_results["betas1"], _2sls_results["betas2"]
     )
 
+    meta["perf"] = perf.to_dict()
     with open(os.path.join(output_dir, "meta.json"), "wt") as f:
         json.dump(meta, f)
 
@@ -726,8 +752,9 @@ def train_conformal_predictor(
     model: DFIVModel,
     betas: torch.Tensor,
     alpha: float,
-    output_dir: str
-):
+    output_dir: str,
+    stats: Optional[TrainingStats] = None
+) -> Tuple[OutcomeResidualPrediction, float]:
     # We need to have a forward method that goes from x to y.
     n_exposures = train_dataset[0][0].numel()
     n_covars = train_dataset[0][3].numel()
@@ -748,9 +775,10 @@ def train_conformal_predictor(
         checkpoint_filename="dfiv_calibration.ckpt",
         batch_size=DEFAULTS["batch_size"],  # type: ignore
         max_epochs=100,
+        stats=stats
     )
 
-    return wrap, resid_pred_loss
+    return resid_model, resid_pred_loss
 
 
 def dfiv_x_to_y(
@@ -817,15 +845,16 @@ class DFIVEstimatorWithUncertainty(MREstimatorWithUncertainty, DFIVEstimator):
 
         weights = torch.load(os.path.join(dir_name, "linear_weights.pt"))
 
-        model = DFIVModel.load_from_checkpoint(
-            os.path.join(dir_name, "dfiv_model.ckpt")
+        model = load_checkpoint(
+            DFIVModel, os.path.join(dir_name, "dfiv_model.ckpt")
         )
 
         # Load conformal model if available.
         conformal_filename = os.path.join(dir_name, "dfiv_calibration.ckpt")
         if os.path.isfile(conformal_filename):
             stub = _ConformalStub(model, weights["betas2"])
-            conformal = OutcomeResidualPrediction.load_from_checkpoint(
+            conformal = load_checkpoint(
+                OutcomeResidualPrediction,
                 conformal_filename,
                 wrapped_model=stub
             )
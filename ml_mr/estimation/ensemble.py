@@ -75,6 +75,16 @@ class EnsembleMREstimator(MREstimatorWithUncertainty):
 
         return cls(*estimators)
 
+    def compile_inference(self, cache_dir: Optional[str] = None) -> None:
+        # The estimators are compiled without caching because they don't
+        # share a directory (load_estimator caches them individually).
+        for estimator in self.estimators:
+            estimator.compile_inference()
+
+    def enable_mixed_precision(self) -> None:
+        for estimator in self.estimators:
+            estimator.enable_mixed_precision()
+
     def ate(
         self,
         x0: torch.Tensor,
@@ -4,9 +4,11 @@ distribution.
 """
 
 import argparse
+import functools
 import json
 import os
-from typing import Iterable, List, Optional, Tuple, Any, Union, Type
+import shutil
+from typing import Iterable, List, Optional, Tuple, Union, Type
 
 import matplotlib.pyplot as plt
 import pandas as pd
@@ -22,9 +24,20 @@ from ..utils import (
     initialize_meta
 )
 from ..utils.models import MLP, OutcomeMLPBase
-from ..utils.quantiles import QuantileLossMulti
-from ..utils.training import train_model, resample_dataset
-from ..utils.data import IVDataset, IVDatasetWithGenotypes
+from ..utils.nn import split_sample_weights, weighted_loss
+from ..utils.quantiles import (QUADRATURE_METHODS, QuantileLossMulti,
+                               integrated_quantile_loss, quadrature,
+                               quantile_loss)
+from ..utils.training import (RESAMPLE_MODES, add_init_from_arguments,
+                              load_checkpoint, load_compatible_weights,
+                              resample_dataset,
+                              resample_replicates, save_lightning_checkpoint,
+                              split_generator, train_model, train_replicates)
+from ..utils.data import (BatchIndex, IVDataset, IVDatasetWithGenotypes,
+                          fetch_batch)
+from ..utils.perf import PerfReport, TrainingStats
+from ..utils.stage1_store import (Stage1Store, add_stage1_store_arguments,
+                                  fetch_or_train, stage1_key)
 from ..utils import _cat
 from .core import MREstimator
 
@@ -45,6 +58,8 @@ DEFAULTS = {
     "outcome_weight_decay": 1e-4,
     "exposure_add_input_batchnorm": False,
     "outcome_add_input_batchnorm": False,
+    "exposure_optimizer": "adam",
+    "outcome_optimizer": "adam",
     "accelerator": "gpu" if (
         torch.cuda.is_available() and torch.cuda.device_count() > 0
     ) else "cpu",
@@ -52,16 +67,14 @@ DEFAULTS = {
     "outcome_type": "continuous",
     "output_dir": "quantile_iv_estimate",
     "activation": "GELU",
-<<<<<<< HEAD
-<<<<<<< HEAD
-=======
-    "outcome_dim": 1,
->>>>>>> parent of 4d9e355 (Merge pull request #4 from MahboobehNorouzi95/my_feature_branch)
-=======
->>>>>>> parent of 9a32a6f (Merge pull request #5 from pgx-ml-lab/mv_outcome)
+    "quadrature": "gauss-legendre",
 }
 # fmt: on
 
+# Maximum number of rows of the flattened (sample, quantile) grid evaluated
+# in one pass of the outcome network.
+_GRID_BLOCK_ROWS = 16_384
+
 
 class ExposureQuantileMLP(MLP):
     def __init__(
@@ -105,13 +118,13 @@ class ExposureQuantileMLP(MLP):
         return super().on_fit_start()
 
     def _step(self, batch, batch_index, log_prefix):
-        x, _, ivs, covars = batch
+        (x, _, ivs, covars), weights = split_sample_weights(batch, 4)
 
         x_hat = self.forward(
             torch.hstack([tens for tens in (ivs, covars) if tens.numel() > 0])
         )
 
-        loss = self.loss(x_hat, x)
+        loss = weighted_loss(self.loss, weights, x_hat, x)
         self.log(f"exposure_{log_prefix}_loss", loss)
         return loss
 
@@ -185,13 +198,13 @@ class ExposureNMQN(MLP):
         return mlp_out @ betas.T
 
     def _step(self, batch, batch_index, log_prefix):
-        x, _, ivs, covars = batch
+        (x, _, ivs, covars), weights = split_sample_weights(batch, 4)
 
         qhat = self.forward(
             torch.hstack([tens for tens in (ivs, covars) if tens.numel() > 0])
         )
 
-        qloss = self.loss(qhat, x)
+        qloss = weighted_loss(self.loss, weights, qhat, x)
         pen = self.penalty()
         loss = qloss + self.hparams.pen_lambda * pen
 
@@ -202,7 +215,160 @@ class ExposureNMQN(MLP):
         return loss
 
 
-QIVExposureNetType = Union[ExposureNMQN, ExposureQuantileMLP]
+class ExposureIQN(MLP):
+    def __init__(
+        self,
+        n_quantiles: int,
+        input_size: int,
+        hidden: Iterable[int],
+        lr: float,
+        weight_decay: float = 0,
+        add_input_layer_batchnorm: bool = False,
+        add_hidden_layer_batchnorm: bool = False,
+        activations: Iterable[nn.Module] = [nn.GELU()],
+        quadrature: str = DEFAULTS["quadrature"],  # type: ignore
+        quadrature_seed: int = 0
+    ):
+        """Implicit quantile network for the exposure.
+
+        The quantile level is an input of the network and it is trained at
+        random levels (as in simultaneous quantile regression). The forward
+        pass predicts the quantiles at the n_quantiles nodes of the
+        quadrature rule that is used to integrate over the exposure
+        distribution in stage 2.
+
+        """
+        super().__init__(
+            input_size=input_size + 1,
+            hidden=hidden,
+            out=1,
+            add_input_layer_batchnorm=add_input_layer_batchnorm,
+            add_hidden_layer_batchnorm=add_hidden_layer_batchnorm,
+            activations=activations,
+            lr=lr,
+            weight_decay=weight_decay,
+            loss=quantile_loss,
+            _save_hyperparams=False
+        )
+        self.save_hyperparameters()
+        self.set_quadrature(quadrature, n_quantiles)
+
+    def set_quadrature(self, method: str, n_nodes: int) -> None:
+        """Sets the quantile levels predicted by the forward pass.
+
+        This can be changed after training, e.g. to use fewer nodes.
+
+        """
+        self.quantiles, self.quadrature_weights = quadrature(
+            method, n_nodes, seed=self.hparams.quadrature_seed  # type: ignore
+        )
+
+    def quantile_forward(
+        self,
+        x: torch.Tensor,
+        taus: torch.Tensor
+    ) -> torch.Tensor:
+        """Predicts the quantiles at the levels taus.
+
+        The levels are either a vector shared by all the samples, in which
+        case a (n, n_taus) tensor is returned, or a (n, 1) tensor.
+
+        """
+        taus = taus.to(x)
+        if taus.dim() == 2:
+            return self.mlp(torch.hstack((x, taus)))
+
+        n, n_taus = x.size(0), taus.numel()
+        y_hats = self.mlp(torch.hstack((
+            x.repeat_interleave(n_taus, dim=0),
+            taus.repeat(n).reshape(-1, 1)
+        )))
+
+        return y_hats.reshape(n, n_taus)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.quantile_forward(x, self.quantiles)
+
+    def _step(self, batch, batch_index, log_prefix):
+        (x, _, ivs, covars), weights = split_sample_weights(batch, 4)
+        exog = _cat(ivs, covars)
+
+        if self.training:
+            taus = torch.rand(x.size(0), 1, device=self.device)
+            x_hat = self.quantile_forward(exog, taus)
+            loss = weighted_loss(self.loss, weights, x_hat, x, taus)
+        else:
+            # The validation loss is integrated over the quadrature nodes so
+            # that it does not depend on random levels.
+            loss = weighted_loss(
+                integrated_quantile_loss, weights, self.forward(exog), x,
+                self.quantiles.to(x), self.quadrature_weights.to(x)
+            )
+
+        self.log(f"exposure_{log_prefix}_loss", loss)
+        return loss
+
+
+QIVExposureNetType = Union[ExposureNMQN, ExposureQuantileMLP, ExposureIQN]
+
+
+class ExposureQuantileDataset(Dataset):
+    """Stage 2 dataset with the predicted exposure quantiles.
+
+    The exposure network is frozen during stage 2, so its predictions are
+    computed once for every sample instead of at every epoch. The batches
+    are (exposure quantiles, outcome, covariables) followed by the sample
+    weights if the dataset is weighted.
+
+    If a list of exposure networks is given (bootstrap replicates), the
+    quantiles of every network are stacked along the second dimension, as
+    expected by train_replicates with replicated_fields=(0, -1).
+
+    """
+    def __init__(
+        self,
+        dataset: Dataset,
+        exposure_network: Union[
+            QIVExposureNetType, List[QIVExposureNetType]
+        ],
+        batch_size: int = 10_000
+    ):
+        n = len(dataset)  # type: ignore
+        blocks = []
+        with torch.no_grad():
+            for start in range(0, n, batch_size):
+                indices = torch.arange(start, min(start + batch_size, n))
+                (_, y, ivs, covars), weights = split_sample_weights(
+                    fetch_batch(dataset, indices), 4
+                )
+                exog = _cat(ivs, covars)
+                if isinstance(exposure_network, list):
+                    x_hats = torch.stack(
+                        [network(exog) for network in exposure_network],
+                        dim=1
+                    )
+                else:
+                    x_hats = exposure_network(exog)
+
+                blocks.append(
+                    (x_hats, y, covars) +
+                    ((weights, ) if weights is not None else ())
+                )
+
+        self.tensors = tuple(torch.cat(field) for field in zip(*blocks))
+
+    def __getitem__(self, index: int) -> Tuple[torch.Tensor, ...]:
+        return tuple(tens[index] for tens in self.tensors)
+
+    def get_batch(self, indices: BatchIndex) -> Tuple[torch.Tensor, ...]:
+        idx = torch.as_tensor(indices, dtype=torch.long)
+        return tuple(tens[idx] for tens in self.tensors)
+
+    def as_tensors(self) -> Tuple[torch.Tensor, ...]:
+        return self.tensors
+
+    def __len__(self) -> int:
+        return self.tensors[0].size(0)
 
 
 class OutcomeMLP(OutcomeMLPBase):
@@ -216,17 +382,15 @@ class OutcomeMLP(OutcomeMLPBase):
         binary_outcome: bool = False,
         add_input_layer_batchnorm: bool = False,
         add_hidden_layer_batchnorm: bool = False,
-<<<<<<< HEAD
-<<<<<<< HEAD
-        activations: Iterable[nn.Module] = [nn.GELU()]
-=======
         activations: Iterable[nn.Module] = [nn.GELU()],
-        outcome_dim: int = 1
->>>>>>> parent of 4d9e355 (Merge pull request #4 from MahboobehNorouzi95/my_feature_branch)
-=======
-        activations: Iterable[nn.Module] = [nn.GELU()]
->>>>>>> parent of 9a32a6f (Merge pull request #5 from pgx-ml-lab/mv_outcome)
+        n_outcomes: int = 1
     ):
+        """Outcome network integrated over the exposure quantiles.
+
+        Multiple outcomes are trained jointly with a shared trunk and one
+        output per outcome, the loss is averaged over the outcomes.
+
+        """
         super().__init__(
             exposure_network=exposure_network,
             input_size=input_size,
@@ -236,17 +400,27 @@ class OutcomeMLP(OutcomeMLPBase):
             binary_outcome=binary_outcome,
             add_input_layer_batchnorm=add_input_layer_batchnorm,
             add_hidden_layer_batchnorm=add_hidden_layer_batchnorm,
-<<<<<<< HEAD
-<<<<<<< HEAD
-=======
->>>>>>> parent of 9a32a6f (Merge pull request #5 from pgx-ml-lab/mv_outcome)
-            activations=activations
-=======
             activations=activations,
-            outcome_dim=outcome_dim
->>>>>>> parent of 4d9e355 (Merge pull request #4 from MahboobehNorouzi95/my_feature_branch)
+            n_outcomes=n_outcomes
         )
 
+        # Set when training on an ExposureQuantileDataset.
+        self.cached_exposure_quantiles = False
+
+    def _step(self, batch, batch_index, log_prefix):
+        if not self.cached_exposure_quantiles:
+            return super()._step(batch, batch_index, log_prefix)
+
+        (x_hats, y, covars), weights = split_sample_weights(batch, 3)
+        y_hat = self.integrate_quantiles(
+            self.quantile_grid_forward(x_hats, covars)
+        )
+        loss = weighted_loss(self.loss, weights, y_hat, y)
+
+        self.log(f"outcome_{log_prefix}_loss", loss)
+
+        return loss
+
     def forward(  # type: ignore
         self,
         ivs: torch.Tensor,
@@ -258,25 +432,69 @@ class OutcomeMLP(OutcomeMLPBase):
             assert taus is not None, "Need quantile samples if SQR enabled."
 
         x_hats = self.exposure_network(_cat(ivs, covars))
-        n_q = x_hats.size(1)
-        n = ivs.size(0)
 
-<<<<<<< HEAD
-<<<<<<< HEAD
-        y_hat = torch.zeros((n, 1), device=self.device)  # type: ignore
-=======
-        # Get outcome dimension from the network's output layer
-        outcome_dim = self.mlp[-1].out_features
-        y_hat = torch.zeros((n, outcome_dim), device=self.device)  # type: ignore
->>>>>>> parent of 4d9e355 (Merge pull request #4 from MahboobehNorouzi95/my_feature_branch)
-=======
-        y_hat = torch.zeros((n, 1), device=self.device)  # type: ignore
->>>>>>> parent of 9a32a6f (Merge pull request #5 from pgx-ml-lab/mv_outcome)
+        return self.integrate_quantiles(
+            self.quantile_grid_forward(x_hats, covars)
+        )
+
+    def integrate_quantiles(self, y_hats: torch.Tensor) -> torch.Tensor:
+        """Averages the (n, n_q, k) predictions over the exposure quantiles.
 
-        for j in range(n_q):
-            y_hat += self.mlp(_cat(x_hats[:, [j]], covars)) / n_q
+        The quadrature weights of implicit quantile networks are used if
+        available, otherwise all the quantiles have the same weight. Returns
+        a (n, k) tensor.
 
-        return y_hat
+        """
+        weights = getattr(self.exposure_network, "quadrature_weights", None)
+        if weights is None:
+            return torch.mean(y_hats, dim=1)
+
+        return torch.einsum("nqk,q->nk", y_hats, weights.to(y_hats))
+
+    def quantile_grid_forward(
+        self,
+        x_hats: torch.Tensor,
+        covars: Optional[torch.Tensor]
+    ) -> torch.Tensor:
+        """Evaluates the outcome network at every predicted exposure quantile.
+
+        The (n, n_q) grid of quantiles is flattened so that the network is
+        called once per block of samples instead of once per quantile.
+        Returns a (n, n_q, k) tensor for k outcomes.
+
+        """
+        n, n_q = x_hats.shape
+
+        if self.training and any(
+            isinstance(module, nn.modules.batchnorm._BatchNorm)
+            for module in self.mlp.modules()
+        ):
+            # Batch statistics are computed for each quantile separately.
+            return torch.stack([
+                self.mlp(_cat(x_hats[:, [j]], covars)) for j in range(n_q)
+            ], dim=1)
+
+        # Very large flattened batches are memory bound, so the grid is
+        # evaluated in blocks of samples.
+        block = max(_GRID_BLOCK_ROWS // n_q, 1)
+
+        y_hats = []
+        for start in range(0, n, block):
+            x_block = x_hats[start:(start + block)]
+            inputs = x_block.reshape(-1, 1)
+            if covars is not None and covars.numel() > 0:
+                inputs = torch.hstack((
+                    inputs,
+                    covars[start:(start + block)].repeat_interleave(
+                        n_q, dim=0
+                    )
+                ))
+
+            y_hats.append(
+                self.mlp(inputs).reshape(x_block.size(0), n_q, -1)
+            )
+
+        return torch.vstack(y_hats)
 
 
 class QuantileIVEstimator(MREstimator):
@@ -294,6 +512,10 @@ class QuantileIVEstimator(MREstimator):
     def iv_reg_function(
         self, x: torch.Tensor, covars: Optional[torch.Tensor] = None
     ) -> torch.Tensor:
+        """Returns a (n, k) tensor, with one column per outcome (see
+        meta["outcome_labels"]).
+
+        """
         with torch.no_grad():
             return self.outcome_network.x_to_y(x, covars)
 
@@ -307,20 +529,24 @@ class QuantileIVEstimator(MREstimator):
         except FileNotFoundError:
             covars = None
 
-        exposure_net_cls: Type[pl.LightningModule] = (
-            ExposureNMQN if meta.get("nmqn", False)
-            else ExposureQuantileMLP
+        exposure_net_cls: Type[pl.LightningModule] = _exposure_class(
+            meta.get("nmqn", False), meta.get("iqn", False)
         )
 
-        exposure_network = exposure_net_cls.load_from_checkpoint(
-            os.path.join(dir_name, "exposure_network.ckpt"),
-            map_location=torch.device("cpu")
+        exposure_network = load_checkpoint(
+            exposure_net_cls, os.path.join(dir_name, "exposure_network.ckpt")
         )
 
-        outcome_network = OutcomeMLP.load_from_checkpoint(
+        if isinstance(exposure_network, ExposureIQN):
+            # Use the nodes from stage 2 (the exposure model may be reused).
+            exposure_network.set_quadrature(
+                meta["quadrature"], meta["n_quantiles"]
+            )
+
+        outcome_network = load_checkpoint(
+            OutcomeMLP,
             os.path.join(dir_name, "outcome_network.ckpt"),
-            exposure_network=exposure_network,
-            map_location=torch.device("cpu")
+            exposure_network=exposure_network
         )
 
         outcome_network.eval()  # type: ignore
@@ -332,6 +558,9 @@ def main(args: argparse.Namespace) -> None:
     """Command-line interface entry-point."""
     default_validate_args(args)
 
+    perf = PerfReport()
+    perf.begin("data_load")
+
     # Prepare train and validation datasets.
     # There is theoretically a little bit of leakage here because the histogram
     # or quantiles will be calculated including the validation dataset.
@@ -342,35 +571,90 @@ def main(args: argparse.Namespace) -> None:
     kwargs = {k: v for k, v in vars(args).items() if k in DEFAULTS.keys()}
     del kwargs["outcome_type"]
 
+    if args.n_replicates is not None:
+        if args.wandb_project is not None:
+            raise ValueError(
+                "Bootstrap replicates can't be logged to wandb."
+            )
+
+        if args.stage1_store is not None:
+            info("The first stage store is not used by bootstrap replicates.")
+
+        fit_quantile_iv_replicates(
+            dataset=dataset,
+            n_replicates=args.n_replicates,
+            fast=args.fast,
+            nmqn=args.nmqn,
+            iqn=args.iqn,
+            resample_mode=(
+                "multinomial" if args.resample_mode == "multinomial"
+                else "poisson"
+            ),
+            binary_outcome=args.outcome_type == "binary",
+            init_from=args.init_from,
+            init_freeze_stage1=args.init_freeze_stage1,
+            split_seed=args.split_seed,
+            perf=perf,
+            **kwargs,
+        )
+        return
+
     fit_quantile_iv(
         dataset=dataset,
         fast=args.fast,
         wandb_project=args.wandb_project,
         nmqn=args.nmqn,
+        iqn=args.iqn,
         resample=args.resample,
+        resample_mode=args.resample_mode,
         binary_outcome=args.outcome_type == "binary",
+        init_from=args.init_from,
+        init_freeze_stage1=args.init_freeze_stage1,
+        split_seed=args.split_seed,
+        stage1_store=args.stage1_store,
+        perf=perf,
         **kwargs,
     )
 
 
-def train_exposure_model(
+def _exposure_class(nmqn: bool, iqn: bool) -> Type[QIVExposureNetType]:
+    if iqn:
+        return ExposureIQN
+
+    return ExposureNMQN if nmqn else ExposureQuantileMLP
+
+
+def _outcome_labels(dataset: IVDataset) -> List[str]:
+    """Names of the outcomes, in the order of the outputs of the network."""
+    if dataset.outcome_labels is not None:
+        return dataset.outcome_labels
+
+    n_outcomes = dataset.n_outcomes()
+    if n_outcomes == 1:
+        return ["y"]
+
+    return [f"y_{j + 1}" for j in range(n_outcomes)]
+
+
+def _check_exposure_options(nmqn: bool, iqn: bool, quadrature: str) -> None:
+    if nmqn and iqn:
+        raise ValueError("Can't use both NMQN and IQN exposure models.")
+
+    if quadrature not in QUADRATURE_METHODS:
+        raise ValueError(f"Unknown quadrature '{quadrature}'.")
+
+
+def _build_exposure_model(
     n_quantiles: int,
-    train_dataset: Dataset,
-    val_dataset: Dataset,
     input_size: int,
-    output_dir: str,
     hidden: List[int],
     activation: nn.Module,
     learning_rate: float,
     weight_decay: float,
-    batch_size: int,
     add_input_batchnorm: bool,
-    max_epochs: int,
-    accelerator: Optional[str] = None,
-    wandb_project: Optional[str] = None,
-    nmqn_penalty_lambda: Optional[float] = None
-) -> Tuple[Type[QIVExposureNetType], float]:
-    info("Training exposure model.")
+    nmqn_penalty_lambda: Optional[float] = None,
+    quadrature: Optional[str] = None
+) -> QIVExposureNetType:
     kwargs = {
         "n_quantiles": n_quantiles,
         "input_size": input_size,
@@ -382,15 +666,81 @@ def train_exposure_model(
         "add_hidden_layer_batchnorm": True,
     }
 
+    if quadrature is not None:
+        assert nmqn_penalty_lambda is None
+        return ExposureIQN(**kwargs, quadrature=quadrature)  # type: ignore
+
     if nmqn_penalty_lambda is None:
-        model = ExposureQuantileMLP(**kwargs)  # type: ignore
-    else:
-        model = ExposureNMQN(
-            **kwargs,  # type: ignore
-            pen_lambda=nmqn_penalty_lambda
-        )
+        return ExposureQuantileMLP(**kwargs)  # type: ignore
+
+    return ExposureNMQN(
+        **kwargs,  # type: ignore
+        pen_lambda=nmqn_penalty_lambda
+    )
+
 
-    return type(model), train_model(
+def _build_outcome_model(
+    exposure_network: QIVExposureNetType,
+    n_covars: int,
+    hidden: List[int],
+    activation: nn.Module,
+    learning_rate: float,
+    weight_decay: float,
+    add_input_batchnorm: bool,
+    binary_outcome: bool = False,
+    n_outcomes: int = 1
+) -> OutcomeMLP:
+    return OutcomeMLP(
+        exposure_network=exposure_network,
+        input_size=1 + n_covars,
+        lr=learning_rate,
+        weight_decay=weight_decay,
+        hidden=hidden,
+        add_input_layer_batchnorm=add_input_batchnorm,
+        binary_outcome=binary_outcome,
+        activations=[activation],
+        n_outcomes=n_outcomes
+    )
+
+
+def train_exposure_model(
+    n_quantiles: int,
+    train_dataset: Dataset,
+    val_dataset: Dataset,
+    input_size: int,
+    output_dir: str,
+    hidden: List[int],
+    activation: nn.Module,
+    learning_rate: float,
+    weight_decay: float,
+    batch_size: int,
+    add_input_batchnorm: bool,
+    max_epochs: int,
+    accelerator: Optional[str] = None,
+    wandb_project: Optional[str] = None,
+    nmqn_penalty_lambda: Optional[float] = None,
+    init_checkpoint: Optional[str] = None,
+    optimizer: str = "adam",
+    stats: Optional[TrainingStats] = None,
+    quadrature: Optional[str] = None
+) -> Tuple[QIVExposureNetType, float]:
+    info("Training exposure model.")
+    model = _build_exposure_model(
+        n_quantiles=n_quantiles,
+        input_size=input_size,
+        hidden=hidden,
+        activation=activation,
+        learning_rate=learning_rate,
+        weight_decay=weight_decay,
+        add_input_batchnorm=add_input_batchnorm,
+        nmqn_penalty_lambda=nmqn_penalty_lambda,
+        quadrature=quadrature
+    )
+
+    if init_checkpoint is not None:
+        load_compatible_weights(model, init_checkpoint)
+
+    return model, train_model(
         train_dataset,
         val_dataset,
         model=model,
@@ -400,7 +750,9 @@ def train_exposure_model(
         batch_size=batch_size,
         max_epochs=max_epochs,
         accelerator=accelerator,
-        wandb_project=wandb_project
+        wandb_project=wandb_project,
+        optimizer=optimizer,
+        stats=stats
     )
 
 
@@ -418,52 +770,99 @@ def train_outcome_model(
     max_epochs: int,
     accelerator: Optional[str] = None,
     binary_outcome: bool = False,
-    wandb_project: Optional[str] = None
-) -> Tuple[Any, float]:
+    wandb_project: Optional[str] = None,
+    init_checkpoint: Optional[str] = None,
+    optimizer: str = "adam",
+    stats: Optional[TrainingStats] = None,
+    cache_exposure_quantiles: bool = True
+) -> Tuple[OutcomeMLP, float]:
     info("Training outcome model.")
-    n_covars = train_dataset[0][3].numel()
-
-<<<<<<< HEAD
-<<<<<<< HEAD
-=======
-    # Get outcome dimension from training data
-    outcome_dim = train_dataset[0][1].numel()
-    
->>>>>>> parent of 4d9e355 (Merge pull request #4 from MahboobehNorouzi95/my_feature_branch)
-=======
->>>>>>> parent of 9a32a6f (Merge pull request #5 from pgx-ml-lab/mv_outcome)
-    model = OutcomeMLP(
+    model = _build_outcome_model(
         exposure_network=exposure_network,
-        input_size=1 + n_covars,
-        lr=learning_rate,
-        weight_decay=weight_decay,
+        n_covars=train_dataset[0][3].numel(),
         hidden=hidden,
-        add_input_layer_batchnorm=add_input_batchnorm,
+        activation=activation,
+        learning_rate=learning_rate,
+        weight_decay=weight_decay,
+        add_input_batchnorm=add_input_batchnorm,
         binary_outcome=binary_outcome,
-        activations=[activation],
-<<<<<<< HEAD
-<<<<<<< HEAD
-=======
-        outcome_dim=outcome_dim,
->>>>>>> parent of 4d9e355 (Merge pull request #4 from MahboobehNorouzi95/my_feature_branch)
-=======
->>>>>>> parent of 9a32a6f (Merge pull request #5 from pgx-ml-lab/mv_outcome)
+        n_outcomes=train_dataset[0][1].numel()
     )
 
+    if init_checkpoint is not None:
+        load_compatible_weights(
+            model, init_checkpoint, ignore_prefixes=("exposure_network.", )
+        )
+
     info(f"Loss: {model.loss}")
 
-    return type(model), train_model(
-        train_dataset,
-        val_dataset,
-        model=model,
-        monitored_metric="outcome_val_loss",
-        output_dir=output_dir,
-        checkpoint_filename="outcome_network.ckpt",
-        batch_size=batch_size,
-        max_epochs=max_epochs,
-        accelerator=accelerator,
-        wandb_project=wandb_project,
-    )
+    if cache_exposure_quantiles:
+        train_dataset = ExposureQuantileDataset(
+            train_dataset, exposure_network
+        )
+        val_dataset = ExposureQuantileDataset(val_dataset, exposure_network)
+        model.cached_exposure_quantiles = True
+
+    try:
+        val_loss = train_model(
+            train_dataset,
+            val_dataset,
+            model=model,
+            monitored_metric="outcome_val_loss",
+            output_dir=output_dir,
+            checkpoint_filename="outcome_network.ckpt",
+            batch_size=batch_size,
+            max_epochs=max_epochs,
+            accelerator=accelerator,
+            wandb_project=wandb_project,
+            optimizer=optimizer,
+            stats=stats
+        )
+    finally:
+        model.cached_exposure_quantiles = False
+
+    return model, val_loss
+
+
+def _parse_activation(activation_str: str) -> nn.Module:
+    activation_cls = getattr(nn, activation_str, None)
+    if activation_cls is None:
+        raise ValueError(
+            f"Requested activation: '{activation_str}' is not a class in "
+            f"torch.nn."
+        )
+
+    # Attempt to instantiate. We don't support parametrized activations
+    # with no default values, so this may fail.
+    return activation_cls()
+
+
+def _save_results(
+    estimator: "QuantileIVEstimator",
+    meta: dict,
+    output_dir: str,
+    fast: bool,
+    perf: PerfReport
+) -> None:
+    perf.begin("artifacts")
+    if not fast:
+        save_estimator_statistics(
+            estimator,
+            domain=meta["domain"],
+            output_prefix=os.path.join(output_dir, "causal_estimates"),
+            outcome_labels=meta.get("outcome_labels")
+        )
+
+    meta["perf"] = perf.to_dict()
+
+    with open(os.path.join(output_dir, "meta.json"), "wt") as f:
+        try:
+            json.dump(meta, f)
+        except ValueError as e:
+            print("Error serializing metadata.")
+            print(meta)
+            print(e)
+            raise e
 
 
 def fit_quantile_iv(
@@ -475,8 +874,11 @@ def fit_quantile_iv(
     fast: bool = False,
     binary_outcome: bool = False,
     resample: bool = False,
+    resample_mode: str = "rows",
     nmqn: bool = False,
     nmqn_penalty_lambda: Optional[float] = DEFAULTS["nmqn_penalty_lambda"],  # type: ignore # noqa: E501
+    iqn: bool = False,
+    quadrature: str = DEFAULTS["quadrature"],  # type: ignore
     exposure_hidden: List[int] = DEFAULTS["exposure_hidden"],  # type: ignore
     exposure_learning_rate: float = DEFAULTS["exposure_learning_rate"],  # type: ignore # noqa: E501
     exposure_weight_decay: float = DEFAULTS["exposure_weight_decay"],  # type: ignore # noqa: E501
@@ -489,26 +891,33 @@ def fit_quantile_iv(
     outcome_batch_size: int = DEFAULTS["outcome_batch_size"],  # type: ignore
     outcome_max_epochs: int = DEFAULTS["outcome_max_epochs"],  # type: ignore
     outcome_add_input_batchnorm: bool = DEFAULTS["outcome_add_input_batchnorm"],  # type: ignore # noqa: E501
+    exposure_optimizer: str = DEFAULTS["exposure_optimizer"],  # type: ignore
+    outcome_optimizer: str = DEFAULTS["outcome_optimizer"],  # type: ignore
     activation: str = DEFAULTS["activation"],  # type: ignore
     accelerator: str = DEFAULTS["accelerator"],  # type: ignore
     wandb_project: Optional[str] = None,
+    init_from: Optional[str] = None,
+    init_freeze_stage1: bool = False,
+    split_seed: Optional[int] = None,
+    stage1_store: Optional[str] = None,
+    perf: Optional[PerfReport] = None,
 ) -> QuantileIVEstimator:
+    _check_exposure_options(nmqn, iqn, quadrature)
+
+    if perf is None:
+        perf = PerfReport()
+
+    perf.begin("split")
+
     if resample:
-        dataset = resample_dataset(dataset)  # type: ignore
+        dataset = resample_dataset(dataset, resample_mode)  # type: ignore
         if stage2_dataset is not None:
-            stage2_dataset = resample_dataset(stage2_dataset)  # type: ignore
+            stage2_dataset = resample_dataset(  # type: ignore
+                stage2_dataset, resample_mode
+            )
 
     activation_str = activation
-    activation_cls = getattr(nn, activation_str)
-    if activation_str is None:
-        raise ValueError(
-            f"Requested activation: '{activation_str}' is not a class in "
-            f"torch.nn."
-        )
-    else:
-        # Attempt to instantiate. We don't support parametrized activations
-        # with no default values, so this may fail.
-        activation_inst = activation_cls()
+    activation_inst = _parse_activation(activation_str)
 
     # Create output directory if needed.
     if not os.path.isdir(output_dir):
@@ -520,17 +929,22 @@ def fit_quantile_iv(
     meta.update(initialize_meta())
     meta.update(dataset.exposure_descriptive_statistics())
     meta["covariable_labels"] = dataset.covariable_labels
+    meta["outcome_labels"] = _outcome_labels(
+        dataset if stage2_dataset is None else stage2_dataset
+    )
     meta["activation"] = activation_str  # Serialize str not class.
     del meta["dataset"]  # We don't serialize the dataset.
     del meta["stage2_dataset"]
-    del meta["activation_cls"]
     del meta["activation_inst"]
+    del meta["perf"]
 
     covars = dataset.save_covariables(output_dir)
+    dataset.save_instrument_compressor(output_dir)
 
     # Split here into train and val.
     train_dataset, val_dataset = random_split(
-        dataset, [1 - validation_proportion, validation_proportion]
+        dataset, [1 - validation_proportion, validation_proportion],
+        generator=split_generator(split_seed)
     )
 
     # If there is a separate dataset for stage2, we split it too, otherwise
@@ -538,40 +952,103 @@ def fit_quantile_iv(
     if stage2_dataset is not None:
         assert dataset.covariable_labels == stage2_dataset.covariable_labels
         stg2_train_dataset, stg2_val_dataset = random_split(
-            stage2_dataset, [1 - validation_proportion, validation_proportion]
+            stage2_dataset, [1 - validation_proportion, validation_proportion],
+            generator=split_generator(split_seed)
         )
     else:
         stg2_train_dataset, stg2_val_dataset = (
             train_dataset, val_dataset
         )
 
-    exposure_class, exposure_val_loss = train_exposure_model(
-        n_quantiles=n_quantiles,
-        train_dataset=train_dataset,
-        val_dataset=val_dataset,
-        input_size=dataset.n_exog(),
-        output_dir=output_dir,
-        hidden=exposure_hidden,
-        activation=activation_inst,
-        learning_rate=exposure_learning_rate,
-        weight_decay=exposure_weight_decay,
-        batch_size=exposure_batch_size,
-        add_input_batchnorm=exposure_add_input_batchnorm,
-        max_epochs=exposure_max_epochs,
-        accelerator=accelerator,
-        wandb_project=wandb_project,
-        nmqn_penalty_lambda=nmqn_penalty_lambda if nmqn else None
-    )
+    perf.begin("stage1")
+
+    # Exposure models trained from scratch can be reused by other fits.
+    store = None
+    if init_from is None:
+        store = Stage1Store.from_option(stage1_store)
+
+    store_key = None
+    if store is not None:
+        store_key = stage1_key(train_dataset, val_dataset, split_seed, {
+            "model": "quantile_iv",
+            "n_quantiles": n_quantiles,
+            "nmqn": nmqn,
+            "nmqn_penalty_lambda": nmqn_penalty_lambda if nmqn else None,
+            "iqn": iqn,
+            "quadrature": quadrature if iqn else None,
+            "hidden": exposure_hidden,
+            "learning_rate": exposure_learning_rate,
+            "weight_decay": exposure_weight_decay,
+            "batch_size": exposure_batch_size,
+            "max_epochs": exposure_max_epochs,
+            "add_input_batchnorm": exposure_add_input_batchnorm,
+            "optimizer": exposure_optimizer,
+            "activation": activation_str,
+        })
+        meta["stage1_key"] = store_key
+
+    if init_from is not None and init_freeze_stage1:
+        info(f"Using the exposure model from '{init_from}'.")
+        shutil.copyfile(
+            os.path.join(init_from, "exposure_network.ckpt"),
+            os.path.join(output_dir, "exposure_network.ckpt")
+        )
+        exposure_network = load_checkpoint(  # type: ignore
+            _exposure_class(nmqn, iqn),
+            os.path.join(output_dir, "exposure_network.ckpt")
+        )
+        with open(os.path.join(init_from, "meta.json"), "rt") as f:
+            exposure_val_loss = json.load(f).get("exposure_val_loss")
 
-    meta["exposure_val_loss"] = exposure_val_loss
+    else:
+        exposure_network, exposure_val_loss = fetch_or_train(
+            store,
+            store_key,
+            output_dir,
+            ["exposure_network.ckpt"],
+            train=functools.partial(
+                train_exposure_model,
+                n_quantiles=n_quantiles,
+                train_dataset=train_dataset,
+                val_dataset=val_dataset,
+                input_size=dataset.n_exog(),
+                output_dir=output_dir,
+                hidden=exposure_hidden,
+                activation=activation_inst,
+                learning_rate=exposure_learning_rate,
+                weight_decay=exposure_weight_decay,
+                batch_size=exposure_batch_size,
+                add_input_batchnorm=exposure_add_input_batchnorm,
+                max_epochs=exposure_max_epochs,
+                accelerator=accelerator,
+                wandb_project=wandb_project,
+                nmqn_penalty_lambda=nmqn_penalty_lambda if nmqn else None,
+                init_checkpoint=(
+                    None if init_from is None
+                    else os.path.join(init_from, "exposure_network.ckpt")
+                ),
+                optimizer=exposure_optimizer,
+                stats=perf.training_stats("exposure_network"),
+                quadrature=quadrature if iqn else None
+            ),
+            load=functools.partial(
+                load_checkpoint,
+                _exposure_class(nmqn, iqn),
+                os.path.join(output_dir, "exposure_network.ckpt")
+            )
+        )
 
-    exposure_network = exposure_class.load_from_checkpoint(
-        os.path.join(output_dir, "exposure_network.ckpt"),
-    ).to(torch.device("cpu")).eval()  # type: ignore
+    meta["exposure_val_loss"] = exposure_val_loss
 
+    exposure_network = exposure_network.to(torch.device("cpu")).eval()
     exposure_network.freeze()
 
+    if isinstance(exposure_network, ExposureIQN):
+        # A reused exposure model can be integrated with other nodes.
+        exposure_network.set_quadrature(quadrature, n_quantiles)
+
     if not fast:
+        perf.begin("artifacts")
         plot_exposure_model(
             exposure_network,
             val_dataset,
@@ -580,7 +1057,8 @@ def fit_quantile_iv(
             ),
         )
 
-    outcome_class, outcome_val_loss = train_outcome_model(
+    perf.begin("stage2")
+    outcome_network, outcome_val_loss = train_outcome_model(
         train_dataset=stg2_train_dataset,
         val_dataset=stg2_val_dataset,
         exposure_network=exposure_network,
@@ -594,19 +1072,18 @@ def fit_quantile_iv(
         max_epochs=outcome_max_epochs,
         accelerator=accelerator,
         binary_outcome=binary_outcome,
-        wandb_project=wandb_project
+        wandb_project=wandb_project,
+        init_checkpoint=(
+            None if init_from is None
+            else os.path.join(init_from, "outcome_network.ckpt")
+        ),
+        optimizer=outcome_optimizer,
+        stats=perf.training_stats("outcome_network")
     )
 
     meta["outcome_val_loss"] = outcome_val_loss
 
-    outcome_network = outcome_class.load_from_checkpoint(
-        os.path.join(output_dir, "outcome_network.ckpt"),
-        exposure_network=exposure_network,
-    ).eval().to(torch.device("cpu"))  # type: ignore
-
-    # Training the 2nd stage model copies the exposure net to the GPU.
-    # Here, we ensure they're on the same device.
-    exposure_network.to(outcome_network.device)
+    outcome_network = outcome_network.eval().to(torch.device("cpu"))
 
     estimator = QuantileIVEstimator(
         exposure_network, outcome_network, meta, covars
@@ -614,21 +1091,7 @@ def fit_quantile_iv(
 
     # Save the metadata, estimator statistics and log artifact to WandB if
     # required.
-    with open(os.path.join(output_dir, "meta.json"), "wt") as f:
-        try:
-            json.dump(meta, f)
-        except ValueError as e:
-            print("Error serializing metadata.")
-            print(meta)
-            print(e)
-            raise e
-
-    if not fast:
-        save_estimator_statistics(
-            estimator,
-            domain=meta["domain"],
-            output_prefix=os.path.join(output_dir, "causal_estimates"),
-        )
+    _save_results(estimator, meta, output_dir, fast, perf)
 
     if wandb_project is not None:
         import wandb
@@ -644,6 +1107,238 @@ def fit_quantile_iv(
     return estimator
 
 
+def fit_quantile_iv_replicates(
+    dataset: IVDataset,
+    n_replicates: int,
+    n_quantiles: int = DEFAULTS["n_quantiles"],  # type: ignore
+    stage2_dataset: Optional[IVDataset] = None,  # type: ignore
+    output_dir: str = DEFAULTS["output_dir"],  # type: ignore
+    validation_proportion: float = DEFAULTS["validation_proportion"],  # type: ignore # noqa: E501
+    fast: bool = False,
+    binary_outcome: bool = False,
+    resample_mode: str = "poisson",
+    nmqn: bool = False,
+    nmqn_penalty_lambda: Optional[float] = DEFAULTS["nmqn_penalty_lambda"],  # type: ignore # noqa: E501
+    iqn: bool = False,
+    quadrature: str = DEFAULTS["quadrature"],  # type: ignore
+    exposure_hidden: List[int] = DEFAULTS["exposure_hidden"],  # type: ignore
+    exposure_learning_rate: float = DEFAULTS["exposure_learning_rate"],  # type: ignore # noqa: E501
+    exposure_weight_decay: float = DEFAULTS["exposure_weight_decay"],  # type: ignore # noqa: E501
+    exposure_batch_size: int = DEFAULTS["exposure_batch_size"],  # type: ignore
+    exposure_max_epochs: int = DEFAULTS["exposure_max_epochs"],  # type: ignore
+    exposure_add_input_batchnorm: bool = DEFAULTS["exposure_add_input_batchnorm"],  # type: ignore # noqa: E501
+    outcome_hidden: List[int] = DEFAULTS["outcome_hidden"],  # type: ignore
+    outcome_learning_rate: float = DEFAULTS["outcome_learning_rate"],  # type: ignore # noqa: E501
+    outcome_weight_decay: float = DEFAULTS["outcome_weight_decay"],  # type: ignore # noqa: E501
+    outcome_batch_size: int = DEFAULTS["outcome_batch_size"],  # type: ignore
+    outcome_max_epochs: int = DEFAULTS["outcome_max_epochs"],  # type: ignore
+    outcome_add_input_batchnorm: bool = DEFAULTS["outcome_add_input_batchnorm"],  # type: ignore # noqa: E501
+    exposure_optimizer: str = DEFAULTS["exposure_optimizer"],  # type: ignore
+    outcome_optimizer: str = DEFAULTS["outcome_optimizer"],  # type: ignore
+    activation: str = DEFAULTS["activation"],  # type: ignore
+    accelerator: str = DEFAULTS["accelerator"],  # type: ignore
+    init_from: Optional[str] = None,
+    init_freeze_stage1: bool = False,
+    split_seed: Optional[int] = None,
+    perf: Optional[PerfReport] = None,
+) -> List[QuantileIVEstimator]:
+    """Fits bootstrap replicates of the quantile IV estimator together.
+
+    The replicates are weighted bootstrap samples (see resample_replicates)
+    and their networks are trained at once in this process (see
+    fit_replicates). Every replicate is saved as a regular estimator in
+    output_dir/replicate_<i>, so they can be loaded with load_estimator or
+    ensembled with EnsembleMREstimator.from_glob.
+
+    """
+    if n_replicates < 2:
+        raise ValueError("Need at least two bootstrap replicates.")
+
+    _check_exposure_options(nmqn, iqn, quadrature)
+
+    if perf is None:
+        perf = PerfReport()
+
+    perf.begin("split")
+
+    if exposure_optimizer != "adam" or outcome_optimizer != "adam":
+        info("Bootstrap replicates are always trained with adam.")
+
+    activation_inst = _parse_activation(activation)
+
+    meta = dict(locals())
+    meta["model"] = "quantile_iv"
+    meta["resample"] = True
+    meta.update(initialize_meta())
+    meta.update(dataset.exposure_descriptive_statistics())
+    meta["covariable_labels"] = dataset.covariable_labels
+    meta["outcome_labels"] = _outcome_labels(
+        dataset if stage2_dataset is None else stage2_dataset
+    )
+    del meta["dataset"]
+    del meta["stage2_dataset"]
+    del meta["activation_inst"]
+    del meta["perf"]
+
+    # The train and validation split is shared by the replicates, only the
+    # bootstrap weights differ.
+    train_dataset, val_dataset = random_split(
+        resample_replicates(dataset, n_replicates, resample_mode),
+        [1 - validation_proportion, validation_proportion],
+        generator=split_generator(split_seed)
+    )
+
+    if stage2_dataset is not None:
+        assert dataset.covariable_labels == stage2_dataset.covariable_labels
+        stg2_train_dataset, stg2_val_dataset = random_split(
+            resample_replicates(stage2_dataset, n_replicates, resample_mode),
+            [1 - validation_proportion, validation_proportion],
+            generator=split_generator(split_seed)
+        )
+    else:
+        stg2_train_dataset, stg2_val_dataset = (
+            train_dataset, val_dataset
+        )
+
+    perf.begin("stage1")
+
+    if init_from is not None and init_freeze_stage1:
+        info(f"Using the exposure model from '{init_from}'.")
+        exposure_class = _exposure_class(nmqn, iqn)
+        exposure_networks = [
+            load_checkpoint(  # type: ignore
+                exposure_class,
+                os.path.join(init_from, "exposure_network.ckpt")
+            )
+            for _ in range(n_replicates)
+        ]
+        with open(os.path.join(init_from, "meta.json"), "rt") as f:
+            exposure_val_losses = [
+                json.load(f).get("exposure_val_loss")
+            ] * n_replicates
+
+    else:
+        info(f"Training {n_replicates} exposure models.")
+        exposure_networks = [
+            _build_exposure_model(
+                n_quantiles=n_quantiles,
+                input_size=dataset.n_exog(),
+                hidden=exposure_hidden,
+                activation=activation_inst,
+                learning_rate=exposure_learning_rate,
+                weight_decay=exposure_weight_decay,
+                add_input_batchnorm=exposure_add_input_batchnorm,
+                nmqn_penalty_lambda=nmqn_penalty_lambda if nmqn else None,
+                quadrature=quadrature if iqn else None
+            )
+            for _ in range(n_replicates)
+        ]
+
+        if init_from is not None:
+            for exposure_network in exposure_networks:
+                load_compatible_weights(
+                    exposure_network,
+                    os.path.join(init_from, "exposure_network.ckpt")
+                )
+
+        exposure_val_losses = train_replicates(
+            train_dataset,
+            val_dataset,
+            exposure_networks,  # type: ignore
+            monitored_metric="exposure_val_loss",
+            batch_size=exposure_batch_size,
+            max_epochs=exposure_max_epochs,
+            accelerator=accelerator
+        )
+
+    for exposure_network in exposure_networks:
+        exposure_network.to(torch.device("cpu")).eval()
+        exposure_network.freeze()
+        if isinstance(exposure_network, ExposureIQN):
+            exposure_network.set_quadrature(quadrature, n_quantiles)
+
+    perf.begin("stage2")
+    info(f"Training {n_replicates} outcome models.")
+    outcome_networks = [
+        _build_outcome_model(
+            exposure_network=exposure_network,
+            n_covars=stg2_train_dataset[0][3].numel(),
+            hidden=outcome_hidden,
+            activation=activation_inst,
+            learning_rate=outcome_learning_rate,
+            weight_decay=outcome_weight_decay,
+            add_input_batchnorm=outcome_add_input_batchnorm,
+            binary_outcome=binary_outcome,
+            n_outcomes=stg2_train_dataset[0][1].numel()
+        )
+        for exposure_network in exposure_networks
+    ]
+
+    if init_from is not None:
+        for outcome_network in outcome_networks:
+            load_compatible_weights(
+                outcome_network,
+                os.path.join(init_from, "outcome_network.ckpt"),
+                ignore_prefixes=("exposure_network.", )
+            )
+
+    # The exposure networks are frozen, their quantiles are computed once
+    # with one column per replicate.
+    for outcome_network in outcome_networks:
+        outcome_network.cached_exposure_quantiles = True
+
+    try:
+        outcome_val_losses = train_replicates(
+            ExposureQuantileDataset(stg2_train_dataset, exposure_networks),
+            ExposureQuantileDataset(stg2_val_dataset, exposure_networks),
+            outcome_networks,  # type: ignore
+            monitored_metric="outcome_val_loss",
+            batch_size=outcome_batch_size,
+            max_epochs=outcome_max_epochs,
+            accelerator=accelerator,
+            replicated_fields=(0, -1)
+        )
+    finally:
+        for outcome_network in outcome_networks:
+            outcome_network.cached_exposure_quantiles = False
+
+    perf.begin("artifacts")
+    estimators = []
+    for i in range(n_replicates):
+        replicate_dir = os.path.join(output_dir, f"replicate_{i}")
+        if not os.path.isdir(replicate_dir):
+            os.makedirs(replicate_dir)
+
+        exposure_network = exposure_networks[i].to(torch.device("cpu"))
+        outcome_network = outcome_networks[i].to(torch.device("cpu"))
+
+        save_lightning_checkpoint(
+            exposure_network,
+            os.path.join(replicate_dir, "exposure_network.ckpt")
+        )
+        save_lightning_checkpoint(
+            outcome_network,
+            os.path.join(replicate_dir, "outcome_network.ckpt")
+        )
+
+        covars = dataset.save_covariables(replicate_dir)
+        dataset.save_instrument_compressor(replicate_dir)
+
+        replicate_meta = dict(meta)
+        replicate_meta["output_dir"] = replicate_dir
+        replicate_meta["replicate"] = i
+        replicate_meta["exposure_val_loss"] = exposure_val_losses[i]
+        replicate_meta["outcome_val_loss"] = outcome_val_losses[i]
+
+        estimator = QuantileIVEstimator(
+            exposure_network, outcome_network, replicate_meta, covars
+        )
+        _save_results(estimator, replicate_meta, replicate_dir, fast, perf)
+        estimators.append(estimator)
+
+    return estimators
+
+
 @torch.no_grad()
 def plot_exposure_model(
     exposure_network: QIVExposureNetType,
@@ -652,7 +1347,7 @@ def plot_exposure_model(
 ):
     assert hasattr(val_dataset, "__len__")
     dataloader = DataLoader(val_dataset, batch_size=len(val_dataset))
-    true_x, _, ivs, covariables = next(iter(dataloader))
+    true_x, _, ivs, covariables = next(iter(dataloader))[:4]
 
     input = torch.hstack(
         [tens for tens in (ivs, covariables) if tens.numel() > 0]
@@ -699,18 +1394,27 @@ def save_estimator_statistics(
     estimator: QuantileIVEstimator,
     domain: Tuple[float, float],
     output_prefix: str = "causal_estimates",
+    outcome_labels: Optional[List[str]] = None
 ):
     # Save the causal effect at over the domain.
     xs = torch.linspace(domain[0], domain[1], 500).reshape(-1, 1)
-<<<<<<< HEAD
-<<<<<<< HEAD
-=======
->>>>>>> parent of 9a32a6f (Merge pull request #5 from pgx-ml-lab/mv_outcome)
-    ys = estimator.avg_iv_reg_function(xs).reshape(-1)
-    df = pd.DataFrame({"x": xs.reshape(-1), "y_do_x": ys})
+    ys = estimator.avg_iv_reg_function(xs)
+    df = pd.DataFrame({"x": xs.reshape(-1)})
 
     plt.figure()
-    plt.scatter(df["x"], df["y_do_x"], label="Estimated IV regression", s=3)
+    if ys.size(1) == 1:
+        df["y_do_x"] = ys.reshape(-1)
+        plt.scatter(
+            df["x"], df["y_do_x"], label="Estimated IV regression", s=3
+        )
+    else:
+        # One column per outcome.
+        if outcome_labels is None:
+            outcome_labels = [f"y_{j + 1}" for j in range(ys.size(1))]
+
+        for j, label in enumerate(outcome_labels):
+            df[f"y_do_x_{label}"] = ys[:, j]
+            plt.scatter(df["x"], df[f"y_do_x_{label}"], label=label, s=3)
 
     if "y_do_x_lower" in df.columns:
         # Add the CI on the plot.
@@ -722,46 +1426,6 @@ def save_estimator_statistics(
             zorder=-1,
             label="Prediction interval"
         )
-<<<<<<< HEAD
-=======
-    ys = estimator.avg_iv_reg_function(xs)
-    
-    # Create dataframe with multiple outcome columns if needed
-    df_data = {"x": xs.reshape(-1)}
-    
-    if ys.dim() == 1:
-        # Single outcome
-        df_data["y_do_x"] = ys.reshape(-1)
-    else:
-        # Multiple outcomes
-        for i in range(ys.size(1)):
-            df_data[f"y_do_x_{i+1}"] = ys[:, i]
-    
-    df = pd.DataFrame(df_data)
-
-    plt.figure()
-    
-    if ys.dim() == 1:
-        plt.scatter(df["x"], df["y_do_x"], label="Estimated IV regression", s=3)
-        
-        if "y_do_x_lower" in df.columns:
-            # Add the CI on the plot.
-            plt.fill_between(
-                df["x"],
-                df["y_do_x_lower"],  # type: ignore
-                df["y_do_x_upper"],  # type: ignore
-                color="#dddddd",
-                zorder=-1,
-                label="Prediction interval"
-            )
-    else:
-        # Multiple outcomes - plot each one
-        for i in range(ys.size(1)):
-            plt.scatter(df["x"], df[f"y_do_x_{i+1}"], 
-                       label=f"Outcome {i+1}", s=3)
->>>>>>> parent of 4d9e355 (Merge pull request #4 from MahboobehNorouzi95/my_feature_branch)
-=======
->>>>>>> parent of 9a32a6f (Merge pull request #5 from pgx-ml-lab/mv_outcome)
 
     plt.xlabel("X")
     plt.ylabel("Y")
@@ -782,19 +1446,6 @@ def configure_argparse(parser) -> None:
     )
 
     parser.add_argument("--output-dir", default=DEFAULTS["output_dir"])
-<<<<<<< HEAD
-<<<<<<< HEAD
-=======
-    
-    parser.add_argument(
-        "--outcome-dim",
-        type=int,
-        default=DEFAULTS["outcome_dim"],
-        help="Number of outcome dimensions for multivariable outcomes."
-    )
->>>>>>> parent of 4d9e355 (Merge pull request #4 from MahboobehNorouzi95/my_feature_branch)
-=======
->>>>>>> parent of 9a32a6f (Merge pull request #5 from pgx-ml-lab/mv_outcome)
 
     parser.add_argument(
         "--fast",
@@ -820,6 +1471,23 @@ def configure_argparse(parser) -> None:
         default=DEFAULTS["nmqn_penalty_lambda"]
     )
 
+    parser.add_argument(
+        "--iqn",
+        action="store_true",
+        help="Use an implicit quantile network for the exposure. The "
+        "quantile level is an input of the network and --n-quantiles is "
+        "the number of quadrature nodes used to integrate over the exposure "
+        "distribution in stage 2.",
+    )
+
+    parser.add_argument(
+        "--quadrature",
+        default=DEFAULTS["quadrature"],
+        choices=QUADRATURE_METHODS,
+        help="Quadrature rule over the quantile levels used with --iqn. "
+        "'rqmc' uses scrambled Sobol points (randomized quasi Monte Carlo).",
+    )
+
     parser.add_argument(
         "--validation-proportion",
         type=float,
@@ -839,6 +1507,29 @@ def configure_argparse(parser) -> None:
         action="store_true"
     )
 
+    parser.add_argument(
+        "--resample-mode",
+        default="rows",
+        choices=RESAMPLE_MODES,
+        help="How bootstrap samples are represented when --resample is used. "
+        "'rows' duplicates the drawn rows, 'multinomial' uses the number of "
+        "draws as sample weights and 'poisson' draws independent Poisson "
+        "weights.",
+    )
+
+    add_init_from_arguments(parser)
+    add_stage1_store_arguments(parser)
+
+    parser.add_argument(
+        "--n-replicates",
+        default=None,
+        type=int,
+        help="Fit this many bootstrap replicates together in one process. "
+        "Every replicate is saved in output_dir/replicate_<i>. This implies "
+        "--resample and uses the 'poisson' resample mode unless "
+        "'multinomial' is requested.",
+    )
+
     parser.add_argument(
         "--wandb-project",
         default=None,
@@ -876,7 +1567,9 @@ def configure_argparse(parser) -> None:
         },
     )
 
-    IVDatasetWithGenotypes.add_dataset_arguments(parser)
+    IVDatasetWithGenotypes.add_dataset_arguments(
+        parser, multiple_outcomes=True
+    )
 
 
 # Standard names for estimators.
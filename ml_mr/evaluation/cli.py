@@ -20,9 +20,10 @@ import torch
 from ..estimation.ensemble import EnsembleMREstimator
 
 from ..estimation import (
-    MODELS, MREstimatorWithUncertainty, MREstimator
+    MODELS, MREstimatorWithUncertainty, MREstimator, configure_inference
 )
 from ..logging import warn
+from ..utils.training import PRECISIONS
 from .metrics import (
     mean_coverage,
     mean_prediction_interval_absolute_width,
@@ -119,6 +120,22 @@ def parse_args(argv):
         help="Ensemble the input estimators."
     )
 
+    parser.add_argument(
+        "--compile-inference",
+        action="store_true",
+        default=None,
+        help="Compile the networks for faster evaluation. Defaults to the "
+             "ML_MR_COMPILE_INFERENCE environment variable."
+    )
+
+    parser.add_argument(
+        "--precision",
+        default=None,
+        choices=PRECISIONS,
+        help="Use 'bf16' to evaluate the networks with bfloat16 autocast. "
+             "Defaults to the ML_MR_PRECISION environment variable or '32'."
+    )
+
     args = parser.parse_args(argv)
 
     if args.domain is not None and args.domain_95:
@@ -129,7 +146,11 @@ def parse_args(argv):
     return args
 
 
-def get_estimator(estimator_path: str) -> Optional[Tuple[dict, MREstimator]]:
+def get_estimator(
+    estimator_path: str,
+    compile_inference: Optional[bool] = None,
+    precision: Optional[str] = None
+) -> Optional[Tuple[dict, MREstimator]]:
     # Try to detect model type.
     meta_filename = os.path.join(estimator_path, "meta.json")
     try:
@@ -146,7 +167,12 @@ def get_estimator(estimator_path: str) -> Optional[Tuple[dict, MREstimator]]:
 
     meta["filename"] = estimator_path
 
-    return meta, loader(estimator_path)  # type: ignore
+    estimator = loader(estimator_path)
+    configure_inference(
+        estimator, estimator_path, compile_inference, precision  # type: ignore
+    )
+
+    return meta, estimator  # type: ignore
 
 
 def main():
@@ -201,7 +227,9 @@ def main():
 
     def estimators_generator():
         for input in args.input:
-            cur_estimator = get_estimator(input)
+            cur_estimator = get_estimator(
+                input, args.compile_inference, args.precision
+            )
             if cur_estimator is None:
                 continue
             yield cur_estimator
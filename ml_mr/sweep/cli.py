@@ -1,4 +1,5 @@
 import argparse
+import inspect
 import itertools
 import json
 import math
@@ -9,11 +10,14 @@ import shutil
 import sqlite3
 import sys
 import time
-from typing import Iterator, List, Optional, Union
+from typing import Iterator, List, Optional, Tuple, Union
 
 from ..estimation import MODELS
 from ..logging import debug, info, warn
 from ..utils.data import IVDataset
+from ..utils.threads import (available_cpus, default_threads_per_worker,
+                             set_thread_budget, thread_environment,
+                             worker_cpus)
 from .samplers import (SAMPLERS, DeterministicSampler, Sampler,
                        StochasticSampler)
 
@@ -42,7 +46,8 @@ class SweepConfig:
         model: str,
         sweep_directory: str,
         parameters: List["SweepParameter"],
-        max_runs: int
+        max_runs: int,
+        stage1_store: Optional[str] = None
     ):
         self.dataset_config = dataset_config
         self.stage2_dataset_config = stage2_dataset_config
@@ -50,6 +55,7 @@ class SweepConfig:
         self.sweep_directory = os.path.abspath(sweep_directory)
         self.parameters = parameters
         self.max_runs = max_runs
+        self.stage1_store = stage1_store
 
         # Check if at least one parameter has a stochastic sampler.
         self.stochastic = False
@@ -68,6 +74,8 @@ class SweepConfig:
 
         print("[sweep_config]")
         print(f"=> Max number of runs: '{self.max_runs}'")
+        if self.stage1_store is not None:
+            print(f"=> Stage 1 store: '{self.stage1_store}'")
         print()
 
         print("[parameters]")
@@ -93,6 +101,20 @@ def parse_args(argv):
         default=max(os.cpu_count() - 2, 1)
     )
 
+    parser.add_argument(
+        "--threads-per-worker",
+        type=int,
+        default=None,
+        help="Number of CPU threads for each worker. By default, the "
+             "available CPUs are split evenly between the workers."
+    )
+
+    parser.add_argument(
+        "--pin-workers",
+        action="store_true",
+        help="Pin every worker to its own block of CPUs."
+    )
+
     parser.add_argument(
         "--create-db-only",
         action="store_true"
@@ -134,6 +156,13 @@ def parse_config(filename: str) -> SweepConfig:
             f"Unknown model '{model}'. Accepted values: {list(MODELS.keys())}"
         )
 
+    for key in ("dataset", "stage2_dataset"):
+        _check_n_outcomes(model, config.get(key))
+
+    stage1_store = _parse_stage1_store(
+        model, sweep_conf.get("stage1_store"), sweep_directory
+    )
+
     # Parse the parameters.
     if "parameters" not in config:
         raise ValueError(
@@ -147,10 +176,48 @@ def parse_config(filename: str) -> SweepConfig:
 
     return SweepConfig(
         config["dataset"], config.get("stage2_dataset"),
-        model, sweep_directory, parameters, max_runs
+        model, sweep_directory, parameters, max_runs, stage1_store
     )
 
 
+def _check_n_outcomes(model: str, dataset_conf: Optional[dict]) -> None:
+    """Only some models support a list of outcome columns."""
+    if dataset_conf is None:
+        return
+
+    outcome = dataset_conf.get("outcome")
+    if isinstance(outcome, list) and len(outcome) > 1 and \
+            not MODELS[model].get("multiple_outcomes", False):
+        raise ValueError(
+            f"Model '{model}' can't fit multiple outcomes ({outcome}). Use "
+            f"quantile_iv or one sweep per outcome."
+        )
+
+
+def _parse_stage1_store(
+    model: str,
+    value: Union[None, bool, str],
+    sweep_directory: str
+) -> Optional[str]:
+    """Directory of the stage 1 store shared by the runs, if requested.
+
+    The "stage1_store" key of the sweep configuration is either true (to use
+    a store in the sweep directory) or the path of the store.
+
+    """
+    if value is None or value is False:
+        return None
+
+    fit_func = MODELS[model]["estimate"]
+    if "stage1_store" not in inspect.signature(fit_func).parameters:
+        raise ValueError(f"Model '{model}' doesn't support a stage 1 store.")
+
+    if value is True:
+        return os.path.join(sweep_directory, "stage1_store")
+
+    return os.path.abspath(value)
+
+
 def create_sweep_database(sweep_config: SweepConfig) -> str:
     filename = os.path.abspath(os.path.join(
         sweep_config.sweep_directory,
@@ -183,12 +250,16 @@ def create_sweep_database(sweep_config: SweepConfig) -> str:
     cur.execute(
         "create table meta ("
         "  model text,"
-        "  sweep_directory text"
+        "  sweep_directory text,"
+        "  stage1_store text"
         ");"
     )
     cur.execute(
-        "insert into meta values (?, ?)",
-        (sweep_config.model, sweep_config.sweep_directory)
+        "insert into meta values (?, ?, ?)",
+        (
+            sweep_config.model, sweep_config.sweep_directory,
+            sweep_config.stage1_store
+        )
     )
     con.commit()
 
@@ -215,7 +286,9 @@ def create_sweep_database(sweep_config: SweepConfig) -> str:
         "  done boolean default false,\n"
         "  in_progress boolean default false,\n"
         "  elapsed float,\n"
-        "  failed boolean default false"
+        "  failed boolean default false,\n"
+        "  peak_rss_mb float,\n"
+        "  perf text"
         ");"
     )
 
@@ -285,7 +358,7 @@ def create_sweep_database(sweep_config: SweepConfig) -> str:
     # Create the entries in run status.
     cur.execute(
         "insert into run_status "
-        "  select run_id, false, false, NULL, false "
+        "  select run_id, false, false, NULL, false, NULL, NULL "
         "  from run_parameters;"
     )
     con.commit()
@@ -310,11 +383,57 @@ def _fetchone_as_dict(cur: sqlite3.Cursor, load_blobs: bool = False) -> dict:
     return d
 
 
+def load_sweep_datasets(
+    db_filename: str
+) -> Tuple[IVDataset, Optional[IVDataset]]:
+    """Loads the datasets of a sweep and moves them to shared memory.
+
+    The datasets are loaded once by the parent process and the workers
+    receive handles to the shared tensors instead of parsing their own copy.
+
+    """
+    con = sqlite3.connect(db_filename)
+    cur = con.cursor()
+
+    try:
+        cur.execute("select json_conf from dataset;")
+        dataset_conf = json.loads(cur.fetchone()[0])
+
+        cur.execute("select json_conf from stage2_dataset;")
+        stage2_json_tuple = cur.fetchone()
+        if stage2_json_tuple is not None:
+            stage2_dataset_conf: Optional[dict] =\
+                json.loads(stage2_json_tuple[0])
+        else:
+            stage2_dataset_conf = None
+    finally:
+        con.close()
+
+    dataset = IVDataset.from_json_configuration(dataset_conf)
+    dataset.share_memory_()
+
+    stage2_dataset: Optional[IVDataset] = None
+    if stage2_dataset_conf is not None:
+        stage2_dataset = IVDataset.from_json_configuration(
+            stage2_dataset_conf
+        )
+        stage2_dataset.share_memory_()
+
+    return dataset, stage2_dataset
+
+
 def worker(
     db_filename: str,
     db_lock,  # multiprocessing.Lock. Left untyped for compatibility.
-    stop_flag
+    stop_flag,
+    dataset: IVDataset,
+    stage2_dataset: Optional[IVDataset] = None,
+    n_threads: Optional[int] = None,
+    cpus: Optional[List[int]] = None
 ):
+    if n_threads is not None:
+        set_thread_budget(n_threads, cpus)
+
     con = sqlite3.connect(db_filename)
     cur = con.cursor()
 
@@ -329,26 +448,11 @@ def worker(
     try:
         cur.execute("select * from meta;")
         meta = _fetchone_as_dict(cur)
-
-        cur.execute("select json_conf from dataset;")
-        dataset_conf = json.loads(cur.fetchone()[0])
-
-        cur.execute("select json_conf from stage2_dataset;")
-        stage2_json_tuple = cur.fetchone()
-        if stage2_json_tuple is not None:
-            stage2_dataset_conf: Optional[dict] =\
-                json.loads(stage2_json_tuple[0])
-        else:
-            stage2_dataset_conf = None
     finally:
         db_lock.release()
 
-    dataset = IVDataset.from_json_configuration(dataset_conf)
-    stage2_dataset: Optional[IVDataset] = (
-        IVDataset.from_json_configuration(stage2_dataset_conf)
-        if stage2_dataset_conf is not None else None
-    )
     fit_func = MODELS[meta["model"]]["estimate"]
+    fit_defaults = _stage1_store_defaults(meta.get("stage1_store"))
 
     while True:
         if stop_flag.value:
@@ -398,6 +502,7 @@ def worker(
         os.chdir(dir_name)
         failed = "false"
         delta_t: Union[str, float] = "null"
+        perf = None
         try:
             t0 = time.time()
 
@@ -410,10 +515,11 @@ def worker(
                 dataset=dataset,
                 output_dir=f"estimate_run_{run_id}",
                 accelerator="cpu",
-                **task
+                **{**fit_defaults, **task}
             )
             t1 = time.time()
             delta_t = t1 - t0
+            perf = _load_run_perf(f"estimate_run_{run_id}")
         except Exception as e:  # noqa: E722
             print(e)
             failed = "true"
@@ -430,28 +536,100 @@ def worker(
                 f"    in_progress=false, "
                 f"    done=true, "
                 f"    elapsed={delta_t}, "
-                f"    failed={failed} "
-                f"where run_id=?", (run_id, )
+                f"    failed={failed}, "
+                f"    peak_rss_mb=?, "
+                f"    perf=? "
+                f"where run_id=?",
+                (
+                    None if perf is None else perf.get("peak_rss_mb"),
+                    None if perf is None else json.dumps(perf),
+                    run_id
+                )
             )
             con.commit()
         finally:
             db_lock.release()
 
 
-def execute_runs(sweep_db_filename: str, n_workers: int):
+def _stage1_store_defaults(stage1_store: Optional[str]) -> dict:
+    """Shares the first stage models between the runs of a sweep.
+
+    This is only done if the sweep configuration enables the store. The runs
+    then use the same train and validation split so that runs that only
+    differ in their second stage reuse the same exposure model. The split
+    seed can still be given as a sweep parameter.
+
+    """
+    if stage1_store is None:
+        return {}
+
+    return {"stage1_store": stage1_store, "split_seed": 0}
+
+
+def _load_run_perf(output_dir: str) -> Optional[dict]:
+    """Reads the timings saved by the fit function in meta.json."""
+    try:
+        with open(os.path.join(output_dir, "meta.json"), "rt") as f:
+            return json.load(f).get("perf")
+    except (OSError, ValueError):
+        return None
+
+
+def _add_perf_columns(db_filename: str) -> None:
+    """Adds the timing columns to databases created by older versions."""
+    con = sqlite3.connect(db_filename)
+    cur = con.cursor()
+    cur.execute("select name from pragma_table_info('run_status')")
+    columns = {tu[0] for tu in cur.fetchall()}
+
+    for column, db_type in (("peak_rss_mb", "float"), ("perf", "text")):
+        if column not in columns:
+            cur.execute(
+                f"alter table run_status add column {column} {db_type}"
+            )
+
+    con.commit()
+    con.close()
+
+
+def execute_runs(
+    sweep_db_filename: str,
+    n_workers: int,
+    threads_per_worker: Optional[int] = None,
+    pin_workers: bool = False
+):
+    cpus = available_cpus()
+    if threads_per_worker is None:
+        threads_per_worker = default_threads_per_worker(n_workers, len(cpus))
+
+    info(
+        f"Starting {n_workers} workers with {threads_per_worker} threads "
+        f"each ({len(cpus)} CPUs available)."
+    )
+
     proc_ctx = multiprocessing.get_context("spawn")
     processes = []
 
     db_lock = proc_ctx.Lock()
     stop_flag = proc_ctx.Value("B", 0)
 
-    for _ in range(n_workers):
-        proc = proc_ctx.Process(
-            target=worker,
-            args=[sweep_db_filename, db_lock, stop_flag]
-        )
-        proc.start()
-        processes.append(proc)
+    # The tensors are in shared memory, so the workers get handles to the
+    # same data when the datasets are pickled.
+    dataset, stage2_dataset = load_sweep_datasets(sweep_db_filename)
+
+    # The spawned workers inherit the environment, so the numerical
+    # libraries are limited from the moment they are loaded.
+    with thread_environment(threads_per_worker):
+        for i in range(n_workers):
+            proc = proc_ctx.Process(
+                target=worker,
+                args=[sweep_db_filename, db_lock, stop_flag, dataset,
+                      stage2_dataset, threads_per_worker,
+                      worker_cpus(cpus, i, threads_per_worker)
+                      if pin_workers else None]
+            )
+            proc.start()
+            processes.append(proc)
 
     try:
         for proc in processes:
@@ -479,7 +657,12 @@ def execute_runs(sweep_db_filename: str, n_workers: int):
     debug("Done all!")
 
 
-def resume_sweep(db_filename: str, n_workers: int):
+def resume_sweep(
+    db_filename: str,
+    n_workers: int,
+    threads_per_worker: Optional[int] = None,
+    pin_workers: bool = False
+):
     info("Resuming sweep from database.")
 
     con = sqlite3.connect(db_filename)
@@ -504,7 +687,11 @@ def resume_sweep(db_filename: str, n_workers: int):
     con.commit()
     con.close()
 
-    return execute_runs(db_filename, n_workers)
+    _add_perf_columns(db_filename)
+
+    return execute_runs(
+        db_filename, n_workers, threads_per_worker, pin_workers
+    )
 
 
 def main():
@@ -519,7 +706,10 @@ def main():
                     "--create-db-only."
                 )
 
-            return resume_sweep(args.configuration, args.n_workers)
+            return resume_sweep(
+                args.configuration, args.n_workers, args.threads_per_worker,
+                args.pin_workers
+            )
 
     # Create and run sweep from configuration.
     conf = parse_config(args.configuration)
@@ -529,4 +719,6 @@ def main():
     if args.create_db_only:
         return
 
-    execute_runs(database, args.n_workers)
+    execute_runs(
+        database, args.n_workers, args.threads_per_worker, args.pin_workers
+    )
@@ -1,3 +1,5 @@
+import pandas as pd
+import pytest
 import torch
 from numpy.testing import assert_array_equal
 
@@ -89,3 +91,218 @@ def test_avg_iv_reg_fct_unc_lowmem(mr_estimator_covar_itx_with_unc):
     )
 
     assert torch.all(y_cv == expected)
+
+
+def test_streaming_twosls_matches_linearmodels():
+    import numpy as np
+    import pandas as pd
+    from ...utils.data import IVDataset
+    from ...estimation.baselines.linear_two_stage import (streaming_twosls,
+                                                          twosls)
+
+    rng = np.random.default_rng(0)
+    n = 2000
+    z = rng.normal(size=(n, 2))
+    c = rng.normal(size=n)
+    u = rng.normal(size=n)
+    x = z @ [0.5, 0.2] + u + rng.normal(size=n)
+    y = 0.3 * x + c + u + rng.normal(size=n) * (1 + np.abs(x))
+    df = pd.DataFrame({"x": x, "y": y, "z1": z[:, 0], "z2": z[:, 1], "c": c})
+
+    dataset = IVDataset.from_dataframe(df, "x", "y", ["z1", "z2"], ["c"])
+    betas, std_errors = streaming_twosls(dataset, block_size=300)
+
+    expected = twosls(df, "y", "x", ["z1", "z2"], ["c"], full=True)
+    np.testing.assert_allclose(
+        betas.numpy(), expected.params[["const", "c", "x"]], rtol=1e-4
+    )
+    np.testing.assert_allclose(
+        std_errors.numpy(), expected.std_errors[["const", "c", "x"]],
+        rtol=1e-4
+    )
+
+
+def test_streaming_twosls_weights_and_outcomes(tmp_path):
+    import numpy as np
+    import pandas as pd
+    import pytest
+    from linearmodels.iv.model import IV2SLS
+    from ...utils.data import IVDataset, SampleWeightedDataset
+    from ...estimation.baselines.linear_two_stage import (streaming_twosls,
+                                                          fit_2sls,
+                                                          TwoSLSEstimator)
+
+    rng = np.random.default_rng(0)
+    n = 2000
+    z = rng.normal(size=(n, 2))
+    u = rng.normal(size=n)
+    x = z @ [0.5, 0.2] + u + rng.normal(size=n)
+    df = pd.DataFrame({
+        "x": x, "z1": z[:, 0], "z2": z[:, 1],
+        "y1": 0.3 * x + u + rng.normal(size=n) * (1 + np.abs(x)),
+        "y2": -0.2 * x + u + rng.normal(size=n),
+        "w": rng.exponential(size=n), "const": 1.0
+    })
+    dataset = IVDataset.from_dataframe(df, "x", ["y1", "y2"], ["z1", "z2"])
+    weighted = SampleWeightedDataset(
+        dataset, torch.arange(n), torch.from_numpy(df["w"].values)
+    )
+
+    for data, weights in ((dataset, None), (weighted, df["w"])):
+        betas, std_errors = streaming_twosls(data, block_size=300)
+        assert betas.shape == std_errors.shape == (2, 2)
+
+        for k, y_col in enumerate(["y1", "y2"]):
+            expected = IV2SLS(
+                df[y_col], df[["const"]], df["x"], df[["z1", "z2"]],
+                weights=weights
+            ).fit(cov_type="robust")
+            np.testing.assert_allclose(
+                betas[:, k].numpy(), expected.params, rtol=1e-4
+            )
+            np.testing.assert_allclose(
+                std_errors[:, k].numpy(), expected.std_errors, rtol=1e-4
+            )
+
+    # One exposure effect per outcome.
+    fit_2sls(dataset, str(tmp_path))
+    estimator = TwoSLSEstimator.from_results(str(tmp_path))
+    y_hat = estimator.iv_reg_function(torch.tensor([[0.0], [1.0]]))
+    torch.testing.assert_close(
+        y_hat[1] - y_hat[0],
+        streaming_twosls(dataset)[0][-1].to(torch.float32)
+    )
+
+    # Replicate weights are rejected.
+    replicates = SampleWeightedDataset(
+        dataset, torch.arange(n), torch.ones(n, 3)
+    )
+    with pytest.raises(ValueError, match="replicate weights"):
+        streaming_twosls(replicates)
+
+
+def test_delivr_replicates_match_separate_fits(tmp_path):
+    from torch.utils.data import Subset
+    from ...estimation import load_estimator
+    from ...estimation.delivr import (OutcomeMLP, fit_delivr_replicates,
+                                      fit_lin_exposure_models)
+    from ...utils.data import IVDataset, SampleWeightedDataset
+    from ...utils.training import train_model, train_replicates
+
+    torch.manual_seed(0)
+    n = 300
+    z = torch.randn(n, 2)
+    c = torch.randn(n, 1)
+    u = torch.randn(n, 1)
+    x = z @ torch.tensor([[1.0], [-0.5]]) + u
+    y = torch.sin(x) + u + 0.1 * torch.randn(n, 1)
+    dataset = IVDataset(x, y, z, c)
+    weights = torch.poisson(torch.ones(n, 2))
+    idx = torch.arange(n)
+
+    stacked = SampleWeightedDataset(dataset, idx, weights)
+    train, val = Subset(stacked, idx[:240]), Subset(stacked, idx[240:])
+    betas = fit_lin_exposure_models(train)
+    assert not torch.allclose(betas[0], betas[1])
+
+    def outcome_network(betas):
+        torch.manual_seed(0)
+        return OutcomeMLP(2, betas, hidden=[8], lr=1e-2, weight_decay=0)
+
+    # Every replicate uses its own first stage.
+    replicates = [outcome_network(b) for b in betas]
+    torch.manual_seed(1)
+    scores = train_replicates(
+        train, val, replicates, "outcome_val_loss", batch_size=64,
+        max_epochs=5
+    )
+
+    for i in range(2):
+        single = SampleWeightedDataset(dataset, idx, weights[:, i])
+        separate = outcome_network(betas[i])
+        torch.manual_seed(1)
+        score = train_model(
+            Subset(single, idx[:240]), Subset(single, idx[240:]), separate,
+            "outcome_val_loss", str(tmp_path), f"outcome_{i}", batch_size=64,
+            max_epochs=5, engine="native"
+        )
+        assert abs(score - scores[i]) < 1e-4
+
+    estimators = fit_delivr_replicates(
+        dataset, 2, output_dir=str(tmp_path / "fit"), hidden=[8],
+        max_epochs=2, accelerator="cpu", split_seed=0
+    )
+    xs = torch.linspace(-1, 1, 5).reshape(-1, 1)
+    loaded = load_estimator(str(tmp_path / "fit" / "replicate_1"))
+    assert loaded.meta["split_seed"] == 0
+    torch.testing.assert_close(
+        loaded.outcome_network.betas, estimators[1].outcome_network.betas
+    )
+    torch.testing.assert_close(
+        loaded.avg_iv_reg_function(xs), estimators[1].avg_iv_reg_function(xs)
+    )
+
+
+@pytest.mark.parametrize("algorithm,options,stage1", [
+    ("quantile_iv", [
+        "--n-quantiles", "3", "--exposure-hidden", "8",
+        "--outcome-hidden", "8", "--exposure-max-epochs", "2",
+        "--outcome-max-epochs", "2", "--split-seed", "0"
+    ], "exposure_network"),
+    ("deep_iv", [
+        "--n-gaussians", "2", "--exposure-hidden", "8",
+        "--outcome-hidden", "8", "--exposure-max-epochs", "2",
+        "--outcome-max-epochs", "2", "--split-seed", "0"
+    ], "exposure_network"),
+    ("dfiv", [
+        "--n-instrument-features", "4", "--n-exposure-features", "4",
+        "--max-epochs", "2"
+    ], "z_net"),
+])
+def test_init_from(tmp_path, monkeypatch, algorithm, options, stage1):
+    import os
+    import sys
+    from ...estimation import load_estimator
+    from ...estimation.cli import main
+    from ...estimation.dfiv import DFIVModel
+    from ...utils import training
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(training, "_training_defaults", {
+        "engine": None, "precision": None
+    })
+    filename = str(tmp_path / "data.csv")
+    torch.manual_seed(0)
+    z = torch.randn(300, 2)
+    u = torch.randn(300)
+    x = z @ torch.tensor([1.0, -0.5]) + u
+    pd.DataFrame({
+        "z1": z[:, 0], "z2": z[:, 1], "x": x, "y": x + u + torch.randn(300)
+    }).to_csv(filename, index=False)
+
+    def fit(output_dir, *init_options):
+        monkeypatch.setattr(sys, "argv", [
+            "ml-mr", "estimation", algorithm, "--data", filename,
+            "--sep", ",", "--instruments", "z1", "z2", "--exposure", "x",
+            "--outcome", "y", "--accelerator", "cpu",
+            "--training-engine", "native", "--output-dir", output_dir,
+            *options, *init_options
+        ])
+        main()
+        if algorithm == "dfiv":
+            return training.load_checkpoint(
+                DFIVModel, os.path.join(output_dir, "dfiv_model.ckpt")
+            )
+
+        return load_estimator(output_dir)
+
+    first = fit("first")
+    fit("warm", "--init-from", "first")
+    frozen = fit("frozen", "--init-from", "first", "--init-freeze-stage1")
+
+    # The frozen first stage is the one of the initial fit.
+    for a, b in zip(
+        getattr(first, stage1).parameters(),
+        getattr(frozen, stage1).parameters()
+    ):
+        assert torch.equal(a, b)
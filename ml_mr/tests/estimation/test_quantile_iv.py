@@ -0,0 +1,216 @@
+import pandas as pd
+import pytest
+import torch
+import torch.nn as nn
+
+from ...estimation import load_estimator, quantile_iv
+from ...estimation.quantile_iv import (ExposureQuantileDataset,
+                                       _build_exposure_model,
+                                       _build_outcome_model, fit_quantile_iv,
+                                       fit_quantile_iv_replicates)
+from ...utils.data import IVDataset, fetch_batch
+from ...utils.quantiles import quadrature
+from ...utils.training import resample_dataset
+
+
+@pytest.fixture
+def small_fit_kwargs(tmp_path, monkeypatch):
+    # Fast settings, the tests check the plumbing and not the estimates.
+    monkeypatch.setenv("ML_MR_TRAINING_ENGINE", "native")
+    monkeypatch.chdir(tmp_path)
+    return {
+        "n_quantiles": 3,
+        "exposure_hidden": [8, 8],
+        "outcome_hidden": [8],
+        "exposure_max_epochs": 2,
+        "outcome_max_epochs": 2,
+        "exposure_batch_size": 64,
+        "outcome_batch_size": 64,
+        "accelerator": "cpu",
+        "split_seed": 0,
+    }
+
+
+def _simulated_data(n: int = 300, n_outcomes: int = 1) -> pd.DataFrame:
+    torch.manual_seed(0)
+    z = torch.randn(n, 2)
+    u = torch.randn(n)
+    x = z @ torch.tensor([1.0, -0.5]) + u
+    df = pd.DataFrame({
+        "z1": z[:, 0], "z2": z[:, 1], "c": torch.randn(n), "x": x
+    })
+    for j in range(n_outcomes):
+        df[f"y{j + 1}"] = (j + 1) * x + u + torch.randn(n)
+
+    return df
+
+
+def test_fit_multiple_outcomes(tmp_path, small_fit_kwargs):
+    df = _simulated_data(n_outcomes=3)
+    dataset = IVDataset.from_dataframe(
+        df, "x", ["y1", "y2", "y3"], ["z1", "z2"], ["c"]
+    )
+    output_dir = str(tmp_path / "fit")
+
+    estimator = fit_quantile_iv(
+        dataset, output_dir=output_dir, **small_fit_kwargs
+    )
+
+    xs = torch.linspace(-1, 1, 5).reshape(-1, 1)
+    assert estimator.iv_reg_function(xs, torch.zeros(5, 1)).shape == (5, 3)
+    assert estimator.avg_iv_reg_function(xs).shape == (5, 3)
+
+    estimates = pd.read_csv(tmp_path / "fit" / "causal_estimates.csv")
+    assert list(estimates.columns) == [
+        "x", "y_do_x_y1", "y_do_x_y2", "y_do_x_y3"
+    ]
+
+    loaded = load_estimator(output_dir)
+    assert loaded.meta["outcome_labels"] == ["y1", "y2", "y3"]
+    torch.testing.assert_close(
+        loaded.avg_iv_reg_function(xs, dataset.covariables),
+        estimator.avg_iv_reg_function(xs, dataset.covariables)
+    )
+
+
+def test_fit_replicates(tmp_path, small_fit_kwargs):
+    df = _simulated_data()
+    dataset = IVDataset.from_dataframe(df, "x", "y1", ["z1", "z2"], ["c"])
+    output_dir = str(tmp_path / "fit")
+
+    estimators = fit_quantile_iv_replicates(
+        dataset, 2, output_dir=output_dir, fast=True, **small_fit_kwargs
+    )
+
+    # The outcome models were trained on the exposure quantiles of their own
+    # replicate, the cached quantiles are stacked in that order.
+    networks = [est.exposure_network for est in estimators]
+    stacked = ExposureQuantileDataset(dataset, networks)
+    for i, network in enumerate(networks):
+        single = ExposureQuantileDataset(dataset, network)
+        torch.testing.assert_close(stacked.tensors[0][:, i], single.tensors[0])
+
+    xs = torch.linspace(-1, 1, 5).reshape(-1, 1)
+    loaded = load_estimator(str(tmp_path / "fit" / "replicate_1"))
+    assert loaded.meta["replicate"] == 1
+    torch.testing.assert_close(
+        loaded.avg_iv_reg_function(xs, dataset.covariables),
+        estimators[1].avg_iv_reg_function(xs, dataset.covariables)
+    )
+
+
+def test_quantile_grid_forward(monkeypatch):
+    # Small blocks to also cover the split of the grid.
+    monkeypatch.setattr(quantile_iv, "_GRID_BLOCK_ROWS", 32)
+
+    torch.manual_seed(0)
+    exposure_net = _build_exposure_model(
+        7, 4, [8], nn.GELU(), 1e-3, 0, False
+    )
+    ivs, covars = torch.randn(50, 2), torch.randn(50, 2)
+
+    for batchnorm, n_outcomes in ((False, 1), (True, 1), (False, 3)):
+        outcome_net = _build_outcome_model(
+            exposure_net, 2, [16, 8], nn.GELU(), 1e-3, 0, batchnorm,
+            n_outcomes=n_outcomes
+        )
+        for training in (True, False):
+            outcome_net.train(training)
+            x_hats = exposure_net(torch.hstack((ivs, covars)))
+            expected = torch.stack([
+                outcome_net.mlp(torch.hstack((x_hats[:, [j]], covars)))
+                for j in range(7)
+            ], dim=1)
+            grid = outcome_net.quantile_grid_forward(x_hats, covars)
+            assert grid.shape == (50, 7, n_outcomes)
+            assert torch.allclose(grid, expected, atol=1e-6)
+            assert torch.allclose(
+                outcome_net(ivs, covars), expected.mean(dim=1), atol=1e-6
+            )
+
+
+def test_exposure_quantile_dataset():
+    torch.manual_seed(0)
+    dataset = resample_dataset(
+        IVDataset.from_dataframe(
+            _simulated_data(), "x", "y1", ["z1", "z2"], ["c"]
+        ),
+        "poisson"
+    )
+    n_covars = dataset[0][3].numel()
+    exposure_net = _build_exposure_model(
+        5, dataset.n_exog(), [8], nn.GELU(), 1e-3, 0, False
+    ).eval()
+    exposure_net.freeze()
+    outcome_net = _build_outcome_model(
+        exposure_net, n_covars, [8], nn.GELU(), 1e-3, 0, False
+    )
+    outcome_net.log = lambda *args, **kwargs: None
+
+    cached = ExposureQuantileDataset(dataset, exposure_net, batch_size=7)
+    assert len(cached) == len(dataset)
+
+    indices = torch.arange(3, 15)
+    expected = outcome_net._step(fetch_batch(dataset, indices), 0, "train")
+    outcome_net.cached_exposure_quantiles = True
+    loss = outcome_net._step(fetch_batch(cached, indices), 0, "train")
+    assert torch.allclose(loss, expected)
+
+
+@pytest.mark.parametrize("method", ["midpoint", "gauss-legendre", "rqmc"])
+def test_quadrature(method):
+    nodes, weights = quadrature(method, 64)
+    assert torch.all((nodes > 0) & (nodes < 1))
+    assert weights.sum().item() == pytest.approx(1)
+
+    # Variance of the standard normal from its quantile function.
+    variance = (weights * torch.special.ndtri(nodes) ** 2).sum().item()
+    assert variance == pytest.approx(1, abs=0.1)
+
+    exposure_net = _build_exposure_model(
+        8, 3, [8], nn.GELU(), 1e-3, 0, False, quadrature=method
+    ).eval()
+    x = torch.randn(10, 3)
+    x_hats = exposure_net(x)
+    assert x_hats.shape == (10, 8)
+    assert torch.allclose(
+        x_hats[:, [2]],
+        exposure_net.quantile_forward(
+            x, exposure_net.quantiles[2].repeat(10, 1)
+        ),
+        atol=1e-6
+    )
+
+
+def test_stage1_store_reuses_exposure_network(
+    tmp_path, small_fit_kwargs, monkeypatch
+):
+    df = _simulated_data()
+    dataset = IVDataset.from_dataframe(df, "x", "y1", ["z1", "z2"], ["c"])
+    store = str(tmp_path / "store")
+
+    first = fit_quantile_iv(
+        dataset, output_dir=str(tmp_path / "fit_1"), stage1_store=store,
+        fast=True, **small_fit_kwargs
+    )
+
+    # Same first stage with another outcome model, the exposure network is
+    # loaded from the store.
+    def train_exposure_model(*args, **kwargs):
+        raise AssertionError("The exposure network was trained again.")
+
+    monkeypatch.setattr(
+        quantile_iv, "train_exposure_model", train_exposure_model
+    )
+    second = fit_quantile_iv(
+        dataset, output_dir=str(tmp_path / "fit_2"), stage1_store=store,
+        fast=True, **{**small_fit_kwargs, "outcome_hidden": [4]}
+    )
+
+    assert second.meta["stage1_key"] == first.meta["stage1_key"]
+    assert second.meta["exposure_val_loss"] == first.meta["exposure_val_loss"]
+    for a, b in zip(
+        first.exposure_network.parameters(),
+        second.exposure_network.parameters()
+    ):
+        assert torch.equal(a, b)
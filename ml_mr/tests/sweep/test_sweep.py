@@ -0,0 +1,118 @@
+import json
+import os
+import sqlite3
+
+import pandas as pd
+import pytest
+import torch
+
+from ...sweep import cli
+from ...sweep.cli import (_stage1_store_defaults, create_sweep_database,
+                          parse_config, resume_sweep)
+
+
+def _write_config(tmp_path, model="quantile_iv", parameters=(), **sweep):
+    config = {
+        "sweep": {
+            "max_runs": 2,
+            "sweep_directory": str(tmp_path / "sweep"),
+            "model": model,
+            **sweep
+        },
+        "dataset": {
+            "filename": str(tmp_path / "data.csv"),
+            "sep": ",",
+            "exposure": "x",
+            "outcome": "y",
+            "instruments": ["z1", "z2"]
+        },
+        "parameters": [
+            {"name": "outcome_weight_decay", "sampler": "list",
+             "values": [0, 1e-2]},
+            *parameters
+        ]
+    }
+    filename = str(tmp_path / "sweep.json")
+    with open(filename, "wt") as f:
+        json.dump(config, f)
+
+    return filename
+
+
+def _meta(database):
+    con = sqlite3.connect(database)
+    con.row_factory = sqlite3.Row
+    meta = dict(con.execute("select * from meta").fetchone())
+    con.close()
+    return meta
+
+
+def test_stage1_store_is_opt_in(tmp_path):
+    # By default, the runs keep their own random splits and no store.
+    conf = parse_config(_write_config(tmp_path))
+    assert conf.stage1_store is None
+    assert _meta(create_sweep_database(conf))["stage1_store"] is None
+    assert _stage1_store_defaults(None) == {}
+
+    conf = parse_config(_write_config(tmp_path, stage1_store=True))
+    assert conf.stage1_store == str(tmp_path / "sweep" / "stage1_store")
+    assert _stage1_store_defaults(conf.stage1_store) == {
+        "stage1_store": conf.stage1_store, "split_seed": 0
+    }
+
+    with pytest.raises(ValueError):
+        parse_config(_write_config(tmp_path, "delivr", stage1_store=True))
+
+
+def test_sweep_two_workers(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("ML_MR_TRAINING_ENGINE", "native")
+    monkeypatch.delenv("ML_MR_CACHE_DIR", raising=False)
+
+    data_filename = str(tmp_path / "data.csv")
+    torch.manual_seed(0)
+    z = torch.randn(200, 2)
+    x = z @ torch.tensor([1.0, -0.5]) + torch.randn(200)
+    pd.DataFrame({
+        "z1": z[:, 0], "z2": z[:, 1], "x": x, "y": x + torch.randn(200)
+    }).to_csv(data_filename, index=False)
+
+    fast = [
+        {"name": name, "sampler": "list", "values": [value]}
+        for name, value in (("n_quantiles", 3), ("exposure_max_epochs", 2),
+                            ("outcome_max_epochs", 2))
+    ]
+    database = create_sweep_database(parse_config(
+        _write_config(tmp_path, parameters=fast)
+    ))
+
+    # A database from before the timing columns were added.
+    con = sqlite3.connect(database)
+    con.execute("alter table run_status drop column perf")
+    con.execute("alter table run_status drop column peak_rss_mb")
+    con.commit()
+    con.close()
+
+    # The workers must use the datasets loaded by the parent, the data file
+    # is gone by the time they start.
+    load_sweep_datasets = cli.load_sweep_datasets
+
+    def load_and_remove(db_filename):
+        datasets = load_sweep_datasets(db_filename)
+        assert datasets[0].ivs.is_shared()
+        os.remove(data_filename)
+        return datasets
+
+    monkeypatch.setattr(cli, "load_sweep_datasets", load_and_remove)
+    resume_sweep(database, n_workers=2, threads_per_worker=1)
+
+    con = sqlite3.connect(database)
+    con.row_factory = sqlite3.Row
+    runs = [dict(row) for row in con.execute("select * from run_status")]
+    con.close()
+
+    assert len(runs) == 2
+    for run in runs:
+        assert run["done"] and not run["failed"]
+        assert run["peak_rss_mb"] > 0
+        assert json.loads(run["perf"])["peak_rss_mb"] == run["peak_rss_mb"]
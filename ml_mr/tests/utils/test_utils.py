@@ -1,8 +1,18 @@
+import os
+from types import SimpleNamespace
+
+import numpy as np
 import torch
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset, random_split
+from torch.utils.data.dataloader import default_collate
 import pandas as pd
+import pytest
 
-from ...utils.training import resample_dataset
+from ...utils.training import resample_dataset, resample_replicates
+from ...utils.stage1_store import Stage1Store, fetch_or_train, stage1_key
+from ...utils.data import (IVDataset, BatchedDataLoader, TensorBatchLoader,
+                          DosageBlockStore, InstrumentCompressor,
+                          compress_instruments, fetch_batch)
 
 from .fixtures import *  # noqa: F401, F403
 
@@ -31,3 +41,731 @@ def test_resample_df(iv_dataset_range):
         FRAMES_EQ = False
 
     assert not FRAMES_EQ
+
+
+def test_resample_weighted(iv_dataset_range):
+    n = len(iv_dataset_range)
+    bs = resample_dataset(iv_dataset_range, mode="multinomial")
+
+    # Every drawn row is kept once and weighted by its number of draws.
+    assert bs.weights.sum() == n
+    assert torch.all(bs.weights > 0)
+
+    train, _ = random_split(bs, [0.8, 0.2])
+    x, _, _, _, w = next(iter(TensorBatchLoader(train, len(train))))
+    x_ref, _, _, _, w_ref = fetch_batch(train, torch.arange(len(train)))
+    assert torch.equal(x, x_ref)
+    assert torch.equal(w, w_ref)
+    assert torch.equal(x.reshape(-1), bs.indices[train.indices].float())
+
+
+def test_resample_weighted_to_dataframe(iv_dataset_range):
+    bs = resample_dataset(iv_dataset_range, mode="multinomial")
+    df, _ = bs.to_dataframe()
+    assert np.array_equal(df["sample_weight"], bs.weights.numpy())
+
+    replicates = resample_replicates(iv_dataset_range, 3)
+    df, _ = replicates.to_dataframe()
+    assert len(df) == len(replicates)
+    for i in range(3):
+        assert np.array_equal(
+            df[f"sample_weight_{i}"], replicates.weights[:, i].numpy()
+        )
+
+
+def test_fetch_batch_subset(iv_dataset_range):
+    train, _ = random_split(iv_dataset_range, [0.8, 0.2])
+    indices = [3, 0, 17, 42]
+
+    expected = default_collate([train[i] for i in indices])
+    batch = fetch_batch(train, indices)
+
+    for tens, expected_tens in zip(batch, expected):
+        assert torch.equal(tens, expected_tens)
+
+
+def test_batched_dataloader(iv_dataset_range):
+    dl = BatchedDataLoader(iv_dataset_range, batch_size=300, shuffle=True)
+
+    batches = list(dl)
+    assert [b[0].size(0) for b in batches] == [300, 300, 300, 100]
+
+    x = torch.vstack([b[0] for b in batches])
+    assert torch.equal(x.reshape(-1).sort().values, torch.arange(1000.0))
+
+
+def test_tensor_batch_loader_composes_indices(iv_dataset_range):
+    bs = resample_dataset(iv_dataset_range)
+    train, _ = random_split(bs, [0.8, 0.2])
+
+    dl = TensorBatchLoader(train, batch_size=len(train))
+    x, y, ivs, covars = next(iter(dl))
+
+    expected = fetch_batch(train, range(len(train)))
+    assert torch.equal(x, expected[0])
+    assert torch.equal(covars, expected[3])
+
+
+def test_tensor_batch_loader_drop_last(iv_dataset_range):
+    dl = TensorBatchLoader(
+        iv_dataset_range, batch_size=300, shuffle=True, drop_last=True
+    )
+
+    assert len(dl) == 3
+    assert [b[0].size(0) for b in dl] == [300, 300, 300]
+
+
+def test_dataset_cache(tmp_path):
+    filename = str(tmp_path / "data.tsv")
+    df = pd.DataFrame({
+        "x": range(10), "y": range(10), "z": range(10), "c": range(10)
+    })
+    df.to_csv(filename, sep="\t", index=False)
+
+    kwargs = {
+        "exposure_col": "x", "outcome_col": "y", "iv_cols": ["z"],
+        "covariable_cols": ["c"], "cache_dir": str(tmp_path / "cache")
+    }
+
+    ds_1 = IVDataset.from_file(filename, **kwargs)
+    ds_2 = IVDataset.from_file(filename, **kwargs)
+    assert torch.equal(ds_1.exposure, ds_2.exposure)
+    assert torch.equal(ds_1.covariables, ds_2.covariables)
+    assert ds_2.covariable_labels == ["c"]
+
+    # Changing the file invalidates the cache.
+    df["x"] = df["x"] + 10
+    df.to_csv(filename, sep="\t", index=False)
+    ds_3 = IVDataset.from_file(filename, **kwargs)
+    assert torch.equal(ds_3.exposure, ds_1.exposure + 10)
+
+
+def test_read_delimited_in_chunks(tmp_path, monkeypatch):
+    from ...utils import data
+
+    filename = str(tmp_path / "data.tsv.gz")
+    df = pd.DataFrame({
+        "x": np.arange(50.0), "y": np.arange(50.0), "z": np.arange(50.0)
+    })
+    df.loc[[3, 20, 21], "z"] = np.nan
+    df.to_csv(filename, sep="\t", index=False)
+
+    # The buffers grow over many chunks and are trimmed at the end.
+    monkeypatch.setattr(data, "_READ_CHUNK_SIZE", 7)
+    dataset = IVDataset.from_file(filename, "x", "y", ["z"])
+
+    expected = torch.tensor(df.dropna()["x"].to_numpy(), dtype=torch.float32)
+    assert torch.equal(dataset.exposure.reshape(-1), expected)
+    assert dataset.ivs.untyped_storage().nbytes() == 47 * 4
+
+
+def test_multiple_outcomes(tmp_path):
+    filename = str(tmp_path / "data.tsv")
+    df = pd.DataFrame({
+        "x": range(10), "y1": range(10), "y2": range(10, 20),
+        "z": range(10)
+    })
+    df.to_csv(filename, sep="\t", index=False)
+
+    kwargs = {
+        "exposure_col": "x", "outcome_col": ["y1", "y2"], "iv_cols": ["z"],
+        "cache_dir": str(tmp_path / "cache")
+    }
+
+    for dataset in (
+        IVDataset.from_dataframe(df, "x", ["y1", "y2"], ["z"]),
+        IVDataset.from_file(filename, **kwargs),
+        IVDataset.from_file(filename, **kwargs),  # From the cache.
+    ):
+        assert dataset.n_outcomes() == 2
+        assert dataset.outcome_labels == ["y1", "y2"]
+        _, y, _, _ = fetch_batch(dataset, [0, 3])
+        assert torch.equal(y, torch.tensor([[0.0, 10.0], [3.0, 13.0]]))
+
+
+def test_share_memory(iv_dataset_range):
+    ivs = iv_dataset_range.ivs.clone()
+    iv_dataset_range.share_memory_()
+
+    assert iv_dataset_range.ivs.is_shared()
+    assert iv_dataset_range.covariables.is_shared()
+    assert torch.equal(iv_dataset_range.ivs, ivs)
+
+
+def test_dosage_block_store():
+    dosage = torch.randint(0, 3, (10, 4)).float()
+    dosage[1, 2] = float("nan")
+    dosage[4, 0] = 0.5
+
+    store = DosageBlockStore(10, 4, block_size=4)
+    assert store.missing_blocks(torch.tensor([0, 9])) == [0, 2]
+
+    for block in range(3):
+        start, end = store.block_range(block)
+        store.set_block(block, dosage[start:end])
+
+    assert store.missing_blocks(torch.arange(10)) == []
+    decoded = store.take(torch.tensor([4, 1, 7]))
+    torch.testing.assert_close(
+        decoded, dosage[[4, 1, 7]], equal_nan=True, atol=1e-2, rtol=0
+    )
+
+
+class _FakeGenotypesBackend(object):
+    def __init__(self, dosage, batched=True):
+        self.dosage = dosage
+        self.batched = batched
+        self.n_reads = 0
+
+    def __getitem__(self, rows):
+        if not self.batched and not isinstance(rows, (int, np.integer)):
+            raise TypeError(rows)
+
+        self.n_reads += 1
+        return torch.from_numpy(self.dosage[rows])
+
+
+class _FakeGeneticDataset(object):
+    def __init__(self, backend, geno_idx, exog_idx=None):
+        if exog_idx is None:
+            exog_idx = np.arange(len(geno_idx))
+
+        self.backend = backend
+        self.exog_idx = exog_idx
+        self.idx = {"geno": geno_idx, "exog": exog_idx}
+        self.exogenous_columns = ["z", "x", "y"]
+        self.exog = torch.randn(len(geno_idx), 3)
+
+    def __len__(self):
+        return len(self.idx["geno"])
+
+    def __getitem__(self, i):
+        return SimpleNamespace(
+            dosage=self.backend[int(self.idx["geno"][i])],
+            exogenous=self.exog[int(self.exog_idx[i])]
+        )
+
+
+def test_dataset_with_genotypes(tmp_path, monkeypatch):
+    from ...utils import data
+
+    monkeypatch.setattr(data, "PT_GENO_AVAIL", True)
+    dosage = np.random.randint(0, 3, (12, 5)).astype(np.float32)
+    geno_idx = np.array([11, 0, 5, 3, 2, 8, 1, 9, 4, 10])
+    filename = str(tmp_path / "dosage.npy")
+
+    def make_dataset(backend, key):
+        return data.IVDatasetWithGenotypes(
+            _FakeGeneticDataset(backend, geno_idx), "x", "y", ["z"], [],
+            dosage_cache_filename=filename, dosage_block_size=4,
+            dosage_cache_key=key
+        )
+
+    for batched in (True, False):
+        backend = _FakeGenotypesBackend(dosage, batched)
+        dataset = make_dataset(backend, f"key_{batched}")
+        _, _, ivs, _ = dataset.get_batch(torch.arange(10))
+        assert torch.equal(ivs[:, :5], torch.from_numpy(dosage[geno_idx]))
+        # One read for the number of variants, then one per block or row.
+        assert backend.n_reads == (1 + 3 if batched else 1 + 10)
+
+    # A later run with the same key reuses the decoded blocks.
+    backend = _FakeGenotypesBackend(dosage)
+    dataset = make_dataset(backend, "key_False")
+    _, _, ivs, _ = dataset.get_batch(torch.arange(10))
+    assert torch.equal(ivs[:, :5], torch.from_numpy(dosage[geno_idx]))
+    assert backend.n_reads == 1
+
+
+def test_dataset_with_genotypes_permuted_rows(monkeypatch):
+    from ...utils import data
+
+    monkeypatch.setattr(data, "PT_GENO_AVAIL", True)
+    dosage = np.random.randint(0, 3, (12, 5)).astype(np.float32)
+    geno_idx = np.array([11, 0, 5, 3, 2, 8, 1, 9, 4, 10])
+    exog_idx = np.random.permutation(10)
+    genetic_dataset = _FakeGeneticDataset(
+        _FakeGenotypesBackend(dosage), geno_idx, exog_idx
+    )
+    samples = [genetic_dataset[i] for i in range(10)]
+    expected_exog = torch.vstack([cur.exogenous for cur in samples])
+    expected_dosage = torch.vstack([cur.dosage for cur in samples])
+
+    # With the exog row mapping, then reading the samples one at a time.
+    for drop_exog_idx in (False, True):
+        if drop_exog_idx:
+            del genetic_dataset.idx["exog"]
+
+        dataset = data.IVDatasetWithGenotypes(
+            genetic_dataset, "x", "y", ["z"], []
+        )
+        rows = torch.tensor([7, 2, 9, 0])
+        x, y, ivs, _ = dataset.get_batch(rows)
+        assert torch.equal(x.flatten(), expected_exog[rows, 1])
+        assert torch.equal(y.flatten(), expected_exog[rows, 2])
+        assert torch.equal(ivs[:, :5], expected_dosage[rows])
+        assert torch.equal(ivs[:, 5], expected_exog[rows, 0])
+        if not drop_exog_idx:
+            assert torch.equal(dataset.exposure.flatten(), expected_exog[:, 1])
+
+
+def test_compress_instruments_pca(tmp_path):
+    torch.manual_seed(0)
+    n, p = 2000, 50
+    ivs = torch.randn(n, 3) @ torch.randn(3, p) + 0.01 * torch.randn(n, p)
+    dataset = IVDataset(torch.randn(n), torch.randn(n), ivs)
+
+    compressed = compress_instruments(
+        dataset, "pca", n_components=3, block_size=300
+    )
+    assert compressed.ivs.shape == (n, 3)
+
+    # The projection spans the leading principal subspace.
+    _, _, v_t = torch.linalg.svd(ivs - ivs.mean(dim=0), full_matrices=False)
+    proj = compressed.instrument_compressor.projection
+    torch.testing.assert_close(
+        proj @ proj.T, v_t[:3].T @ v_t[:3], atol=1e-4, rtol=0
+    )
+
+    compressed.save_instrument_compressor(str(tmp_path))
+    loaded = InstrumentCompressor.load(
+        str(tmp_path / "instrument_compressor.pt")
+    )
+    assert torch.equal(loaded.transform(ivs), compressed.ivs)
+
+
+def test_compress_instruments_score_cross_fit():
+    torch.manual_seed(0)
+    n, p = 300, 200
+    # Instruments that are unrelated to the exposure.
+    ivs = torch.randn(n, p)
+    x = torch.randn(n)
+    dataset = IVDataset(x, x, ivs)
+
+    compressed = compress_instruments(dataset, "score", alpha=1.0)
+    compressor = compressed.instrument_compressor
+
+    def corr(score):
+        return torch.corrcoef(torch.vstack((score.reshape(-1), x)))[0, 1]
+
+    # The full fit overfits the exposure, the cross-fitted scores don't.
+    assert corr(compressor.transform(ivs)) > 0.5
+    assert corr(compressed.ivs) < 0.3
+
+
+def test_compress_instruments_score_matches_ridge():
+    torch.manual_seed(0)
+    n, p = 500, 40
+    ivs = torch.randn(n, p) @ torch.randn(p, p) * 0.3
+    x = ivs[:, :3].sum(dim=1) + torch.randn(n)
+    dataset = IVDataset(x, x, ivs)
+
+    compressor = InstrumentCompressor.fit(
+        dataset, "score", alpha=1.0, block_size=128
+    )
+    z = (ivs - compressor.mean).to(torch.float64)
+
+    def ridge(keep):
+        z_k, x_k = z[keep], x[keep].to(torch.float64)
+        lhs = z_k.T @ z_k + torch.eye(p, dtype=torch.float64)
+        return torch.linalg.solve(lhs, z_k.T @ (x_k - x_k.mean()))
+
+    # The conjugate gradient solutions of the full fit and of a fold.
+    folds, projections = compressor.cross_fit
+    torch.testing.assert_close(
+        compressor.projection.reshape(-1),
+        ridge(torch.ones(n, dtype=torch.bool)).to(torch.float32)
+    )
+    torch.testing.assert_close(
+        projections[2].reshape(-1), ridge(folds != 2).to(torch.float32)
+    )
+
+
+def test_storage_dtypes(iv_dataset_range, tmp_path):
+    iv_dataset_range.set_storage_dtype("ivs", "int16")
+    iv_dataset_range.set_storage_dtype("covariables", torch.bfloat16)
+    assert iv_dataset_range.ivs.dtype == torch.int16
+
+    x, _, ivs, covars = fetch_batch(iv_dataset_range, [0, 5, 255])
+    assert ivs.dtype == covars.dtype == torch.float32
+    assert torch.equal(ivs[:, 0], torch.tensor([0.0, 5.0, 255.0]))
+
+    batch = next(iter(TensorBatchLoader(iv_dataset_range, batch_size=10)))
+    assert all(tens.dtype == torch.float32 for tens in batch)
+
+    iv_dataset_range.save_covariables(str(tmp_path))
+    covars = torch.load(str(tmp_path / "covariables.pt"))
+    assert covars.dtype == torch.bfloat16
+
+    with pytest.raises(ValueError):
+        iv_dataset_range.set_storage_dtype("exposure", "int8")
+
+
+def test_parquet_row_filter(tmp_path):
+    pytest.importorskip("pyarrow")
+    df = pd.DataFrame({
+        "x": range(100), "y": range(100), "z": range(100),
+        "age": [20 + i % 60 for i in range(100)],
+        "unused": ["a"] * 100
+    })
+    filename = str(tmp_path / "data.parquet")
+    df.to_parquet(filename)
+
+    dataset = IVDataset.from_file(
+        filename, "x", "y", ["z"], row_filter=[["age", ">=", 60]]
+    )
+
+    expected = df.loc[df["age"] >= 60, "z"].to_numpy()
+    assert torch.equal(
+        dataset.ivs.reshape(-1), torch.tensor(expected, dtype=torch.float32)
+    )
+
+
+def test_native_training_engine(tmp_path):
+    from ...utils.models import MLP
+    from ...utils.data import SupervisedLearningWrapper
+    from ...utils.training import train_model
+
+    torch.manual_seed(0)
+    z = torch.randn(500, 2)
+    x = z @ torch.tensor([1.0, -0.5]) + 0.1 * torch.randn(500)
+    dataset = SupervisedLearningWrapper(IVDataset(x, x, z))
+    train, val = random_split(dataset, [0.8, 0.2])
+
+    model = MLP(2, [8], lr=1e-2)
+    score = train_model(
+        train, val, model, "val_loss", str(tmp_path), "mlp",
+        batch_size=64, max_epochs=30, engine="native"
+    )
+
+    # The checkpoint holds the best model.
+    checkpoint = torch.load(str(tmp_path / "mlp.ckpt"), weights_only=False)
+    best = MLP(2, [8])
+    best.load_state_dict(checkpoint["state_dict"])
+    best.eval()
+    with torch.no_grad():
+        val_x, val_y = fetch_batch(val, torch.arange(len(val)))
+        loss = torch.nn.functional.mse_loss(best(val_x), val_y)
+
+    assert abs(loss.item() - score) < 1e-5
+    assert score < 0.1
+
+
+def test_training_arguments(tmp_path, monkeypatch):
+    import argparse
+    from ...utils import training
+    from ...utils.models import MLP
+    from ...utils.data import SupervisedLearningWrapper
+
+    parser = argparse.ArgumentParser()
+    training.add_training_arguments(parser)
+    monkeypatch.setattr(training, "_training_defaults", {
+        "engine": None, "precision": None
+    })
+    monkeypatch.setenv("ML_MR_TRAINING_ENGINE", "lightning")
+    monkeypatch.setenv("ML_MR_PRECISION", "bf16")
+
+    def fit_native(*args, **kwargs):
+        raise StopIteration(kwargs["precision"])
+
+    monkeypatch.setattr(training, "fit_native", fit_native)
+    dataset = SupervisedLearningWrapper(
+        IVDataset(torch.randn(20), torch.randn(20), torch.randn(20, 2))
+    )
+
+    # The command line options take precedence over the environment.
+    training.apply_training_arguments(parser.parse_args(
+        ["--training-engine", "native", "--precision", "32"]
+    ))
+    with pytest.raises(StopIteration, match="32"):
+        training.train_model(
+            dataset, dataset, MLP(2, [4]), "val_loss", str(tmp_path), "mlp",
+            batch_size=8, max_epochs=1
+        )
+
+    training.apply_training_arguments(parser.parse_args([]))
+    assert training.resolve_precision() == (
+        "bf16" if training.bf16_supported(torch.device("cpu")) else "32"
+    )
+
+
+@pytest.mark.parametrize("max_epochs,patience", [(5, 20), (40, 2)])
+def test_train_replicates_matches_separate_fits(tmp_path, max_epochs,
+                                                patience):
+    import copy
+    from ...utils.models import MLP
+    from ...utils.data import SampleWeightedDataset, SupervisedLearningWrapper
+    from ...utils.training import train_model, train_replicates
+
+    torch.manual_seed(0)
+    z = torch.randn(300, 2)
+    x = z @ torch.tensor([1.0, -0.5]) + 0.1 * torch.randn(300)
+    dataset = SupervisedLearningWrapper(IVDataset(x, x, z))
+    weights = torch.poisson(torch.ones(300, 3))
+    idx = torch.arange(300)
+
+    model = MLP(2, [8], lr=1e-2, add_hidden_layer_batchnorm=True)
+    replicates = [copy.deepcopy(model) for _ in range(3)]
+
+    # With a short patience, the replicates stop at different epochs and
+    # the others keep training without them.
+    stacked = SampleWeightedDataset(dataset, idx, weights)
+    torch.manual_seed(1)
+    scores = train_replicates(
+        Subset(stacked, idx[:240]), Subset(stacked, idx[240:]), replicates,
+        "val_loss", batch_size=64, max_epochs=max_epochs,
+        early_stopping_patience=patience
+    )
+
+    # Same as training the replicates one at a time.
+    for i, replicate in enumerate(replicates):
+        single = SampleWeightedDataset(dataset, idx, weights[:, i])
+        separate = copy.deepcopy(model)
+        torch.manual_seed(1)
+        score = train_model(
+            Subset(single, idx[:240]), Subset(single, idx[240:]), separate,
+            "val_loss", str(tmp_path), f"mlp_{i}", batch_size=64,
+            max_epochs=max_epochs, early_stopping_patience=patience,
+            engine="native"
+        )
+        checkpoint = torch.load(
+            str(tmp_path / f"mlp_{i}.ckpt"), weights_only=False
+        )
+        separate.load_state_dict(checkpoint["state_dict"])
+
+        assert abs(score - scores[i]) < 1e-4
+        for a, b in zip(separate.parameters(), replicate.parameters()):
+            assert torch.allclose(a, b, atol=1e-4)
+
+
+def test_load_compatible_weights(tmp_path):
+    from ...utils.models import MLP
+    from ...utils.training import (load_compatible_weights,
+                                   save_lightning_checkpoint)
+
+    reference = MLP(3, [8, 4])
+    filename = str(tmp_path / "reference.ckpt")
+    save_lightning_checkpoint(reference, filename)
+
+    # The last layer has a different shape and keeps its initialization.
+    model = MLP(3, [8, 5])
+    last_weight = model.mlp[-1].weight.clone()
+    n_loaded = load_compatible_weights(model, filename)
+
+    assert n_loaded > 0
+    assert torch.equal(model.mlp[0].weight, reference.mlp[0].weight)
+    assert torch.equal(model.mlp[-1].weight, last_weight)
+
+
+def test_compile_mlp_folds_batchnorm(tmp_path):
+    from ...utils.models import MLP
+    from ...utils.nn import compile_mlp
+    from ...utils.training import save_lightning_checkpoint
+
+    torch.manual_seed(0)
+    model = MLP(
+        3, [8, 4], add_input_layer_batchnorm=True,
+        add_hidden_layer_batchnorm=True
+    )
+    with torch.no_grad():
+        for module in model.modules():
+            if isinstance(module, torch.nn.BatchNorm1d):
+                module.running_mean.normal_()
+                module.running_var.uniform_(0.5, 2)
+                module.weight.normal_()
+                module.bias.normal_()
+
+    model.eval()
+    checkpoint = str(tmp_path / "model.ckpt")
+    cache = str(tmp_path / "model.compiled.pt")
+    save_lightning_checkpoint(model, checkpoint)
+
+    compiled = compile_mlp(model.mlp, cache, checkpoint)
+    assert not any(
+        isinstance(module, torch.nn.BatchNorm1d)
+        for module in compiled.modules()
+    )
+
+    x = torch.randn(20, 3)
+    with torch.no_grad():
+        assert torch.allclose(compiled(x), model(x), atol=1e-5)
+
+    # Reloaded from the cache.
+    cached = compile_mlp(model.mlp, cache, checkpoint)
+    assert torch.allclose(cached(x), compiled(x))
+
+
+def test_lbfgs_training(tmp_path, monkeypatch):
+    import os
+    from ...utils import training
+    from ...utils.models import MLP
+    from ...utils.data import SupervisedLearningWrapper
+    from ...utils.training import train_model
+
+    torch.manual_seed(0)
+    z = torch.randn(300, 2)
+    x = z @ torch.tensor([1.0, -0.5]) + 0.1 * torch.randn(300)
+    dataset = SupervisedLearningWrapper(IVDataset(x, x, z))
+    train, val = Subset(dataset, range(240)), Subset(dataset, range(240, 300))
+
+    scores = {}
+    for optimizer in ("adam", "lbfgs", "adam_lbfgs"):
+        torch.manual_seed(1)
+        scores[optimizer] = train_model(
+            train, val, MLP(2, [8], lr=1e-2), "val_loss", str(tmp_path),
+            optimizer, batch_size=64, max_epochs=10, engine="native",
+            optimizer=optimizer
+        )
+        assert os.path.isfile(str(tmp_path / f"{optimizer}.ckpt"))
+
+    # A few full-batch L-BFGS steps do better than a few epochs of adam, and
+    # polishing never makes the adam solution worse.
+    assert scores["lbfgs"] < scores["adam"]
+    assert scores["adam_lbfgs"] <= scores["adam"]
+
+    # L-BFGS has its own step budget and the early stopping patience.
+    calls = []
+    monkeypatch.setattr(
+        training, "fit_lbfgs", lambda **kwargs: calls.append(kwargs) or 0.0
+    )
+    train_model(
+        train, val, MLP(2, [8], lr=1e-2), "val_loss", str(tmp_path),
+        "lbfgs", batch_size=64, max_epochs=1000, engine="native",
+        optimizer="lbfgs", early_stopping_patience=3, lbfgs_max_steps=7
+    )
+    assert calls[0]["max_steps"] == 7
+    assert calls[0]["early_stopping_patience"] == 3
+
+
+def test_bf16_autocast(tmp_path):
+    from ...utils.models import MLP
+    from ...utils.data import SupervisedLearningWrapper
+    from ...utils.linear import ridge_regression
+    from ...utils.nn import Bfloat16Autocast, weighted_loss
+    from ...utils.training import autocast, bf16_supported, train_model
+
+    if not bf16_supported(torch.device("cpu")):
+        pytest.skip("bfloat16 is not supported by the CPU.")
+
+    torch.manual_seed(0)
+    z = torch.randn(300, 2)
+    x = z @ torch.tensor([1.0, -0.5]) + 0.1 * torch.randn(300)
+    dataset = SupervisedLearningWrapper(IVDataset(x, x, z))
+    model = MLP(2, [8], lr=1e-2)
+    score = train_model(
+        Subset(dataset, range(240)), Subset(dataset, range(240, 300)),
+        model, "val_loss", str(tmp_path), "mlp", batch_size=64,
+        max_epochs=5, engine="native", precision="bf16"
+    )
+    assert score < 1
+
+    # The loss and the ridge solves stay in float32.
+    with autocast("bf16", torch.device("cpu")):
+        assert model.mlp(z).dtype == torch.bfloat16
+        loss = weighted_loss(model.loss, None, model.mlp(z), x[:, None])
+        assert loss.dtype == torch.float32
+        assert ridge_regression(z, x.reshape(-1, 1), 1).dtype == \
+            torch.float32
+
+    with torch.no_grad():
+        y_hat = Bfloat16Autocast(model.mlp)(z)
+        assert y_hat.dtype == torch.float32
+        assert torch.allclose(y_hat, model.mlp(z), atol=0.1)
+
+
+def test_thread_budget():
+    import os
+    from ...utils.threads import (default_threads_per_worker, parse_cpu_list,
+                                  thread_environment, worker_cpus)
+
+    assert parse_cpu_list("0-3,8, 10-11") == [0, 1, 2, 3, 8, 10, 11]
+    assert default_threads_per_worker(3, 16) == 5
+    assert default_threads_per_worker(32, 16) == 1
+    assert worker_cpus([0, 1, 2, 3], 1, 2) == [2, 3]
+    assert worker_cpus([0, 1, 2, 3], 2, 3) == [0, 2, 3]
+
+    previous = os.environ.get("OMP_NUM_THREADS")
+    with thread_environment(2):
+        assert os.environ["OMP_NUM_THREADS"] == "2"
+    assert os.environ.get("OMP_NUM_THREADS") == previous
+
+
+def test_perf_report(tmp_path):
+    from ...utils.models import MLP
+    from ...utils.data import SupervisedLearningWrapper
+    from ...utils.perf import PerfReport
+    from ...utils.training import train_model
+
+    torch.manual_seed(0)
+    z = torch.randn(300, 2)
+    x = z @ torch.tensor([1.0, -0.5])
+    dataset = SupervisedLearningWrapper(IVDataset(x, x, z))
+
+    perf = PerfReport()
+    for engine in ("native", "lightning"):
+        perf.begin("train")
+        train_model(
+            Subset(dataset, range(240)), Subset(dataset, range(240, 300)),
+            MLP(2, [8]), "val_loss", str(tmp_path), engine, batch_size=64,
+            max_epochs=3, accelerator="cpu", engine=engine,
+            stats=perf.training_stats(engine),
+            default_root_dir=str(tmp_path)
+        )
+
+    # The peak memory covers this report, not the whole process.
+    block = torch.ones(50_000_000)  # 200 MB
+    perf.rss.sample()
+    del block
+
+    report = perf.to_dict()
+    if report["peak_rss_mb"] is not None:
+        assert report["peak_rss_mb"] >= report["start_rss_mb"] + 150
+        assert PerfReport().to_dict()["peak_rss_mb"] < report["peak_rss_mb"]
+
+    assert set(report["phases"]) == {"train"}
+    assert report["phases"]["train"] <= report["seconds"]
+    for engine in ("native", "lightning"):
+        stats = report["training"][engine]
+        assert stats["epochs"] == 3
+        assert stats["samples"] == 3 * 240
+        assert stats["samples_per_second"] > 0
+
+
+def test_stage1_store(iv_dataset_range, tmp_path):
+    hparams = {"hidden": [8], "learning_rate": 1e-3}
+    train = Subset(iv_dataset_range, range(800))
+    val = Subset(iv_dataset_range, range(800, 1000))
+    key = stage1_key(train, val, 0, hparams)
+    assert key == stage1_key(train, val, 0, dict(hparams))
+    assert key != stage1_key(train, val, 1, hparams)
+    assert key != stage1_key(train, val, 0, {**hparams, "hidden": [16]})
+    assert key != stage1_key(
+        Subset(iv_dataset_range, range(1, 801)), val, 0, hparams
+    )
+
+    store = Stage1Store(str(tmp_path / "store"))
+    n_trained = 0
+
+    def train_model(output_dir):
+        nonlocal n_trained
+        n_trained += 1
+        with open(os.path.join(output_dir, "model.txt"), "wt") as f:
+            f.write("weights")
+        return "trained", 0.5
+
+    def load_model(output_dir):
+        with open(os.path.join(output_dir, "model.txt"), "rt") as f:
+            return f.read()
+
+    for i in range(3):
+        output_dir = tmp_path / f"fit_{i}"
+        output_dir.mkdir()
+        model, val_loss = fetch_or_train(
+            store, key, str(output_dir), ["model.txt"],
+            train=lambda: train_model(str(output_dir)),
+            load=lambda: load_model(str(output_dir))
+        )
+        assert model == ("trained" if i == 0 else "weights")
+        assert val_loss == 0.5
+
+    assert n_trained == 1
@@ -1,15 +1,23 @@
-from typing import Tuple, Dict, Any, Optional, Iterable, List
+from typing import (Tuple, Dict, Any, Optional, Iterable, List, Sequence,
+                    Union, Iterator, Callable)
 import argparse
 import itertools
 import collections
+import hashlib
+import json
+import math
 import os
+import shutil
+import tempfile
 
 import pandas as pd
 import numpy as np
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import (Dataset, DataLoader, Subset, BatchSampler,
+                              RandomSampler, SequentialSampler)
+from torch.utils.data.dataloader import default_collate
 import torch
 
-from ..logging import warn
+from ..logging import warn, info
 
 try:
     from pytorch_genotypes.dataset import (BACKENDS, GeneticDatasetBackend,
@@ -26,13 +34,97 @@ IVDatasetBatch = Tuple[
     torch.Tensor   # Covariables
 ]
 
+BatchIndex = Union[Sequence[int], torch.Tensor]
+
+# Row filters in the disjunctive normal form used by pyarrow.
+RowFilter = List[Any]
+
+# A single outcome column or a list of columns for multiple outcomes.
+OutcomeColumns = Union[str, List[str]]
+
+
+def _as_column_list(cols: Optional[OutcomeColumns]) -> List[str]:
+    if cols is None:
+        return []
+
+    if isinstance(cols, str):
+        return [cols]
+
+    return list(cols)
+
+
+def _as_index_tensor(indices: BatchIndex) -> torch.Tensor:
+    if isinstance(indices, torch.Tensor):
+        return indices.to(torch.long)
+
+    return torch.as_tensor(indices, dtype=torch.long)
+
+
+def _as_index_list(indices: BatchIndex) -> List[int]:
+    if isinstance(indices, torch.Tensor):
+        return indices.tolist()
+
+    return list(indices)
+
+
+IV_DATASET_FIELDS = ("exposure", "outcome", "ivs", "covariables")
+
+# Storage dtypes for IVDataset fields. Batches are always float32.
+STORAGE_DTYPES = ("float32", "float16", "bfloat16", "int8", "uint8", "int16")
+
+
+def to_compute_dtype(tens: torch.Tensor) -> torch.Tensor:
+    """Upcasts reduced-precision or integer tensors to float32."""
+    if tens.dtype in (torch.float16, torch.bfloat16) or (
+        not tens.is_floating_point() and tens.dtype != torch.bool
+    ):
+        return tens.to(torch.float32)
+
+    return tens
+
+
+def _map_subset_indices(subset: Subset, indices: BatchIndex) -> BatchIndex:
+    parent_indices = subset.indices
+    if isinstance(parent_indices, torch.Tensor):
+        return parent_indices[_as_index_tensor(indices)]
+
+    return [parent_indices[i] for i in _as_index_list(indices)]
+
+
+def fetch_batch(dataset: Dataset, indices: BatchIndex) -> Any:
+    """Fetches multiple samples from a dataset as a single batch.
+
+    Subsets (e.g. from random_split) are resolved by mapping the requested
+    indices to the parent dataset so that the underlying tensors are indexed
+    only once. Datasets that don't implement get_batch fall back to collating
+    the individual samples.
+
+    """
+    # We look the method up on the type so that wrappers that forward
+    # attributes to another dataset using __getattr__ don't get fooled.
+    if getattr(type(dataset), "get_batch", None) is not None:
+        return dataset.get_batch(indices)  # type: ignore
+
+    if isinstance(dataset, Subset):
+        return fetch_batch(
+            dataset.dataset, _map_subset_indices(dataset, indices)
+        )
+
+    return default_collate([dataset[i] for i in _as_index_list(indices)])
+
 
 class IVDataset(Dataset):
     """Dataset class for IV analysis.
 
-    The batches contain exposure, outcome, IVs and covariables.
+    The batches contain exposure, outcome, IVs and covariables. The outcome
+    can be a (n, k) matrix of k outcomes measured on the same samples.
 
     """
+    # Set when the instruments were compressed (see compress_instruments).
+    instrument_compressor: Optional["InstrumentCompressor"] = None
+    # Column names of the outcomes, if known.
+    outcome_labels: Optional[List[str]] = None
+
     def __init__(
         self,
         exposure: torch.Tensor,
@@ -40,27 +132,23 @@ class IVDataset(Dataset):
         ivs: torch.Tensor,
         covariables: torch.Tensor = torch.Tensor(),
         covariable_labels: Optional[Iterable[str]] = None,
-        sampling_weights: Optional[torch.Tensor] = None
+        sampling_weights: Optional[torch.Tensor] = None,
+        storage_dtypes: Optional[Dict[str, Union[str, torch.dtype]]] = None,
+        outcome_labels: Optional[Iterable[str]] = None
     ):
+        """Dataset of tensors.
+
+        The storage_dtypes can be used to keep some fields (e.g. genotype
+        dosages or principal components) in a compact dtype such as int8 or
+        bfloat16. Batches are always upcast to float32.
+
+        """
         self.exposure = exposure.reshape(-1, 1)
-<<<<<<< HEAD
-<<<<<<< HEAD
-        self.outcome = outcome.reshape(-1, 1)
-=======
-        
-        # Auto-detect outcome dimension if not provided
-        if outcome_dim is None:
-            if outcome.dim() == 1:
-                outcome_dim = 1
-            else:
-                outcome_dim = outcome.size(-1)
-        
-        self.outcome = outcome.reshape(-1, outcome_dim)
-        self.outcome_dim = outcome_dim
->>>>>>> parent of 4d9e355 (Merge pull request #4 from MahboobehNorouzi95/my_feature_branch)
-=======
-        self.outcome = outcome.reshape(-1, 1)
->>>>>>> parent of 9a32a6f (Merge pull request #5 from pgx-ml-lab/mv_outcome)
+        if outcome.dim() == 2 and outcome.numel() > 0:
+            self.outcome = outcome
+        else:
+            self.outcome = outcome.reshape(-1, 1)
+
         self.ivs = ivs
         self.covariables = covariables
         self.sampling_weights = sampling_weights
@@ -70,33 +158,153 @@ class IVDataset(Dataset):
         else:
             self.covariable_labels = list(covariable_labels)
 
+        if outcome_labels is None:
+            self.outcome_labels = None
+        else:
+            self.outcome_labels = list(outcome_labels)
+            assert len(self.outcome_labels) == self.outcome.size(1)
+
         n = self.ivs.size(0)
         assert n != 0
         for tens in (exposure, outcome, covariables):
             assert tens.numel() == 0 or tens.size(0) == n
 
+        if storage_dtypes is not None:
+            for field, dtype in storage_dtypes.items():
+                self.set_storage_dtype(field, dtype)
+
+    def set_storage_dtype(
+        self,
+        field: str,
+        dtype: Union[str, torch.dtype]
+    ) -> None:
+        """Converts the tensor of a field to the provided storage dtype."""
+        if field not in IV_DATASET_FIELDS:
+            raise ValueError(
+                f"Unknown field '{field}'. Use one of {IV_DATASET_FIELDS}."
+            )
+
+        if isinstance(dtype, str):
+            if dtype not in STORAGE_DTYPES:
+                raise ValueError(
+                    f"Unsupported storage dtype '{dtype}'. Use one of "
+                    f"{STORAGE_DTYPES}."
+                )
+            dtype = getattr(torch, dtype)
+
+        tens = getattr(self, field)
+        if tens.numel() > 0 and not dtype.is_floating_point:
+            limits = torch.iinfo(dtype)
+            if not (
+                torch.all(tens == torch.round(tens)) and
+                tens.min() >= limits.min and tens.max() <= limits.max
+            ):
+                raise ValueError(
+                    f"Field '{field}' can't be stored as {dtype} without "
+                    f"loss of information."
+                )
+
+        setattr(self, field, tens.to(dtype))
+
     def __getitem__(self, index: int) -> IVDatasetBatch:
         if self.exposure.numel() > 0:
-            exposure = self.exposure[index]
+            exposure = to_compute_dtype(self.exposure[index])
         else:
             exposure = torch.Tensor()
 
         if self.outcome.numel() > 0:
-            outcome = self.outcome[index]
+            outcome = to_compute_dtype(self.outcome[index])
         else:
             outcome = torch.Tensor()
 
-        ivs = self.ivs[index]
-        covars = self.covariables[index]
+        ivs = to_compute_dtype(self.ivs[index])
+        covars = to_compute_dtype(self.covariables[index])
 
         return exposure, outcome, ivs, covars
 
+    def get_batch(self, indices: BatchIndex) -> IVDatasetBatch:
+        """Fetches a batch of samples using a single index per tensor.
+
+        This returns the same layout as collating the individual samples, but
+        avoids creating one tuple per row.
+
+        """
+        idx = _as_index_tensor(indices)
+
+        def take(tens: torch.Tensor) -> torch.Tensor:
+            if tens.numel() == 0:
+                # Collating empty tensors yields a (batch_size, 0) tensor.
+                return torch.empty((idx.numel(), 0))
+
+            return to_compute_dtype(tens[idx])
+
+        return (
+            take(self.exposure),
+            take(self.outcome),
+            take(self.ivs),
+            take(self.covariables)
+        )
+
+    def as_tensors(self) -> Optional[Tuple[torch.Tensor, ...]]:
+        """Returns the dataset as tensors that share their first dimension.
+
+        Empty fields are returned as (n, 0) tensors to match the batch layout.
+        The tensors are returned in their storage dtype.
+
+        """
+        n = len(self)
+
+        def expand(tens: torch.Tensor) -> torch.Tensor:
+            if tens.numel() == 0:
+                return torch.empty((n, 0))
+
+            return tens
+
+        return (
+            expand(self.exposure),
+            expand(self.outcome),
+            expand(self.ivs),
+            expand(self.covariables)
+        )
+
     def __len__(self) -> int:
         return self.ivs.size(0)
 
-    def to_dataframe(self) -> Tuple[pd.DataFrame, dict]:
+    def share_memory_(self) -> "IVDataset":
+        """Moves the tensors to shared memory.
+
+        Once shared, the dataset can be sent to other processes (e.g. using
+        torch.multiprocessing or a spawn context) without copying the data.
+
+        """
+        for name in ("exposure", "outcome", "ivs", "covariables",
+                     "sampling_weights"):
+            tens = getattr(self, name)
+            if tens is None or tens.is_shared():
+                continue
+
+            if tens.untyped_storage().nbytes() != (
+                tens.numel() * tens.element_size()
+            ):
+                # Don't share the unused part of a larger buffer.
+                tens = tens.clone()
+
+            setattr(self, name, tens.share_memory_())
+
+        return self
+
+    def to_dataframe(
+        self,
+        indices: Optional[BatchIndex] = None
+    ) -> Tuple[pd.DataFrame, dict]:
+        """Converts the dataset to a DataFrame.
+
+        If indices are provided, only these rows are included (in order).
+
+        """
         cols = collections.OrderedDict()
         stack = []
+        idx = None if indices is None else _as_index_tensor(indices)
 
         contents = [
             (self.exposure, "exposure"),
@@ -109,7 +317,13 @@ class IVDataset(Dataset):
             contents.append((self.sampling_weights, "sampling_weights"))
 
         def add(variable, name):
-            mat = variable.numpy()
+            if idx is not None:
+                variable = variable[idx]
+
+            mat = to_compute_dtype(variable).numpy()
+            if mat.ndim == 1:
+                mat = mat.reshape(-1, 1)
+
             assert mat.ndim == 2
             stack.append(mat)
             cols[name] = []
@@ -133,7 +347,7 @@ class IVDataset(Dataset):
         return df, cols
 
     def exposure_descriptive_statistics(self) -> Dict[str, Any]:
-        x = self.exposure.numpy()
+        x = to_compute_dtype(self.exposure).numpy()
 
         min = np.min(x).item()
         max = np.max(x).item()
@@ -172,7 +386,11 @@ class IVDataset(Dataset):
         self,
         output_directory: str
     ) -> Optional[torch.Tensor]:
-        """Saves the covars to disk and returns them."""
+        """Saves the covars to disk and returns them.
+
+        The covariables are saved in their storage dtype.
+
+        """
         output_filename = os.path.join(output_directory, "covariables.pt")
 
         if (
@@ -184,19 +402,27 @@ class IVDataset(Dataset):
 
         return None
 
+    def save_instrument_compressor(self, output_directory: str) -> None:
+        """Saves the instrument compression (if any) alongside the model."""
+        if self.instrument_compressor is not None:
+            self.instrument_compressor.save(
+                os.path.join(output_directory, "instrument_compressor.pt")
+            )
+
     @staticmethod
     def from_dataframe(
         dataframe: pd.DataFrame,
         exposure_col: Optional[str],
-        outcome_col: Optional[str],
+        outcome_col: Optional[OutcomeColumns],
         iv_cols: Iterable[str],
         covariable_cols: Iterable[str] = [],
         sampling_weights_col: Optional[str] = None,
     ) -> "IVDataset":
         # We'll do complete case analysis if the user provides a df with NAs.
+        outcome_cols = _as_column_list(outcome_col)
 
         keep_cols = [col for col in itertools.chain(
-            [exposure_col, outcome_col], iv_cols, covariable_cols,
+            [exposure_col], outcome_cols, iv_cols, covariable_cols,
             [sampling_weights_col]
         ) if col is not None]
 
@@ -216,8 +442,8 @@ class IVDataset(Dataset):
         else:
             exposure = torch.Tensor()
 
-        if outcome_col is not None:
-            outcome = torch.from_numpy(dataframe[outcome_col].values).float()
+        if outcome_cols:
+            outcome = torch.from_numpy(dataframe[outcome_cols].values).float()
         else:
             outcome = torch.Tensor()
 
@@ -233,14 +459,84 @@ class IVDataset(Dataset):
 
         return IVDataset(
             exposure, outcome, ivs, covars, covariable_labels=covariable_cols,
-            sampling_weights=sampling_weights
+            sampling_weights=sampling_weights,
+            outcome_labels=outcome_cols or None
         )
 
+    @staticmethod
+    def from_file(
+        filename: str,
+        exposure_col: Optional[str],
+        outcome_col: Optional[OutcomeColumns],
+        iv_cols: Iterable[str],
+        covariable_cols: Iterable[str] = [],
+        sampling_weights_col: Optional[str] = None,
+        sep: str = "\t",
+        cache_dir: Optional[str] = None,
+        storage_dtypes: Optional[Dict[str, str]] = None,
+        row_filter: Optional[RowFilter] = None
+    ) -> "IVDataset":
+        """Reads a dataset from a delimited text file or a Parquet, Feather
+        or Arrow IPC file (detected from the file extension).
+
+        For the columnar formats, only the requested columns are read and the
+        optional row_filter (e.g. [["age", ">=", 40]]) is applied while
+        scanning the file.
+
+        If a cache directory is provided (or set using the ML_MR_CACHE_DIR
+        environment variable), the parsed columns are stored as binary arrays
+        and subsequent loads memory-map them instead of parsing the file
+        again. The cache is rebuilt if the contents of the file change.
+
+        A list of outcome columns creates a multi-outcome dataset.
+
+        """
+        iv_cols = list(iv_cols)
+        covariable_cols = list(covariable_cols)
+
+        if cache_dir is None:
+            cache_dir = os.environ.get("ML_MR_CACHE_DIR")
+
+        def read() -> IVDataset:
+            return _read_dataset_file(
+                filename, exposure_col, outcome_col, iv_cols,
+                covariable_cols, sampling_weights_col, sep, row_filter
+            )
+
+        if cache_dir is None:
+            dataset = read()
+        else:
+            columns = {
+                "exposure": exposure_col,
+                "outcome": outcome_col,
+                "instruments": iv_cols,
+                "covariables": covariable_cols,
+                "sampling_weights": sampling_weights_col,
+                "sep": sep
+            }
+            if row_filter:
+                columns["row_filter"] = _as_filter_tuples(row_filter)
+
+            cached = _load_dataset_cache(cache_dir, filename, columns)
+            if cached is not None:
+                dataset = cached
+            else:
+                dataset = read()
+                _save_dataset_cache(cache_dir, filename, columns, dataset)
+
+        if storage_dtypes:
+            for field, dtype in storage_dtypes.items():
+                dataset.set_storage_dtype(field, dtype)
+
+        return dataset
+
     @staticmethod
     def from_json_configuration(configuration) -> "IVDataset":
         allowed_keys = {
             "filename", "sep", "exposure", "outcome", "instruments",
-            "covariables", "sampling_weights"
+            "covariables", "sampling_weights", "cache_dir",
+            "compress_instruments", "compress_instruments_dim",
+            "storage_dtypes", "row_filter"
         }
 
         bad_keys = set(configuration.keys()) - allowed_keys
@@ -249,42 +545,77 @@ class IVDataset(Dataset):
                 f"Invalid dataset configuration parameter(s): {bad_keys}"
             )
 
-        data = pd.read_csv(
+        dataset = IVDataset.from_file(
             configuration["filename"],
-            sep=configuration.get("sep", "\t")
-        )
-
-        return IVDataset.from_dataframe(
-            data,
             exposure_col=configuration["exposure"],
             outcome_col=configuration["outcome"],
             iv_cols=configuration["instruments"],
             covariable_cols=configuration.get("covariables", []),
-            sampling_weights_col=configuration.get("sampling_weights", None)
+            sampling_weights_col=configuration.get("sampling_weights", None),
+            sep=configuration.get("sep", "\t"),
+            cache_dir=configuration.get("cache_dir", None),
+            storage_dtypes=configuration.get("storage_dtypes", None),
+            row_filter=configuration.get("row_filter", None)
         )
 
+        method = configuration.get("compress_instruments")
+        if method is not None:
+            dataset = compress_instruments(
+                dataset, method,
+                n_components=configuration.get(
+                    "compress_instruments_dim", 20
+                )
+            )
+
+        return dataset
+
     @staticmethod
     def from_argparse_namespace(args: argparse.Namespace) -> "IVDataset":
-        data = pd.read_csv(
-            args.data, sep=args.sep
-        )
-        return IVDataset.from_dataframe(
-            data,
+        dataset = IVDataset.from_file(
+            args.data,
             exposure_col=args.exposure,
             outcome_col=args.outcome,
             iv_cols=args.instruments,
             covariable_cols=args.covariables,
-            sampling_weights_col=args.resample_weights_col
+            sampling_weights_col=args.resample_weights_col,
+            sep=args.sep,
+            cache_dir=getattr(args, "cache_dir", None),
+            storage_dtypes=_parse_storage_dtypes(
+                getattr(args, "storage_dtypes", None)
+            ),
+            row_filter=_parse_row_filter(getattr(args, "row_filter", None))
         )
 
+        return _compress_instruments_from_args(dataset, args)
+
     @classmethod
-    def add_dataset_arguments(cls, parser: argparse.ArgumentParser):
+    def add_dataset_arguments(
+        cls,
+        parser: argparse.ArgumentParser,
+        multiple_outcomes: bool = False
+    ):
         """Adds commonly used arguments to load a dataset to an argument
         parser.
 
+        With multiple_outcomes, --outcome accepts a list of columns for the
+        estimators that can fit several outcomes at once.
+
         """
         parser.add_argument(
-            "--data", "-d", required=True, help="Path to a data file."
+            "--data", "-d", required=True,
+            help="Path to a data file. Delimited text files as well as "
+            "Parquet (.parquet, .pq), Feather (.feather) and Arrow IPC "
+            "(.arrow, .ipc) files are supported."
+        )
+
+        parser.add_argument(
+            "--row-filter",
+            nargs="*",
+            default=None,
+            metavar="'COLUMN OP VALUE'",
+            help="Only keep the rows matching all the conditions (e.g. "
+            "'age >= 40'). Applied while scanning Parquet, Feather and Arrow "
+            "files.",
         )
 
         parser.add_argument(
@@ -321,14 +652,26 @@ class IVDataset(Dataset):
             type=str,
         )
 
-        parser.add_argument(
-            "--outcome",
-            "-y",
-            help="The outcome (Y). This should be a column name in the data "
-            "file.",
-            required=True,
-            type=str,
-        )
+        if multiple_outcomes:
+            parser.add_argument(
+                "--outcome",
+                "-y",
+                help="The outcome (Y). This should be a column name in the "
+                "data file. Multiple columns can be provided to fit several "
+                "outcomes jointly.",
+                required=True,
+                nargs="+",
+                type=str,
+            )
+        else:
+            parser.add_argument(
+                "--outcome",
+                "-y",
+                help="The outcome (Y). This should be a column name in the "
+                "data file.",
+                required=True,
+                type=str,
+            )
 
         parser.add_argument(
             "--resample-weights-col",
@@ -337,19 +680,1190 @@ class IVDataset(Dataset):
             type=str
         )
 
+        parser.add_argument(
+            "--cache-dir",
+            help="Directory used to cache the parsed data file as binary "
+            "arrays. This speeds up repeated loads of the same data file. "
+            "Defaults to the ML_MR_CACHE_DIR environment variable if set.",
+            default=None,
+            type=str
+        )
+
+        parser.add_argument(
+            "--storage-dtypes",
+            nargs="*",
+            default=None,
+            metavar="FIELD=DTYPE",
+            help="Compact storage dtype for dataset fields (exposure, "
+            "outcome, ivs, covariables), e.g. 'ivs=int8 "
+            "covariables=bfloat16'. Batches are still float32. "
+            f"Supported dtypes: {', '.join(STORAGE_DTYPES)}.",
+        )
+
+        parser.add_argument(
+            "--compress-instruments",
+            choices=INSTRUMENT_COMPRESSION_METHODS,
+            default=None,
+            help="Replace the instruments by a low dimensional summary before "
+            "fitting. 'pca' uses a randomized PCA projection and 'score' a "
+            "ridge-weighted score predicting the exposure. Useful when there "
+            "are thousands of (genetic) instruments.",
+        )
+
+        parser.add_argument(
+            "--compress-instruments-dim",
+            type=int,
+            default=20,
+            help="Number of principal components kept by "
+            "--compress-instruments pca.",
+        )
+
+
+# Number of rows parsed at a time when reading delimited files.
+_READ_CHUNK_SIZE = 100_000
+
+
+def _read_delimited_columns(
+    filename: str,
+    sep: str,
+    fields: Dict[str, List[str]]
+) -> Dict[str, torch.Tensor]:
+    """Reads groups of columns from a delimited file into float32 tensors.
+
+    Only the requested columns are parsed, directly as float32 and in chunks.
+    Rows with missing values in any of the requested columns are dropped
+    (complete case analysis). The file is read once, the chunks are written
+    into tensors that grow geometrically (see _collect_complete_cases).
+
+    """
+    usecols = list(dict.fromkeys(itertools.chain(*fields.values())))
+
+    reader = pd.read_csv(
+        filename,
+        sep=sep,
+        usecols=usecols,
+        dtype={col: np.float32 for col in usecols},
+        chunksize=_READ_CHUNK_SIZE
+    )
+
+    return _collect_complete_cases(reader, fields)
+
+
+COLUMNAR_FORMATS = {
+    ".parquet": "parquet",
+    ".pq": "parquet",
+    ".feather": "feather",
+    ".arrow": "ipc",
+    ".ipc": "ipc",
+}
+
+
+def _columnar_format(filename: str) -> Optional[str]:
+    return COLUMNAR_FORMATS.get(os.path.splitext(filename)[1].lower())
+
+
+def _read_columnar_columns(
+    filename: str,
+    fields: Dict[str, List[str]],
+    row_filter: Optional[RowFilter] = None
+) -> Dict[str, torch.Tensor]:
+    """Reads groups of columns from a Parquet, Feather or Arrow IPC file.
+
+    Only the requested columns are read and the optional row filter is
+    applied while scanning the file. The filter uses the disjunctive normal
+    form of pyarrow and pandas.read_parquet, e.g. [["age", ">=", 40]].
+    Missing values are handled as for delimited files.
+
+    """
+    try:
+        import pyarrow.dataset as pa_dataset
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError(
+            "pyarrow is needed to read Parquet, Feather or Arrow files."
+        )
+
+    usecols = list(dict.fromkeys(itertools.chain(*fields.values())))
+    source = pa_dataset.dataset(filename, format=_columnar_format(filename))
+
+    expression = None
+    if row_filter:
+        expression = pq.filters_to_expression(_as_filter_tuples(row_filter))
+
+    scanner = source.scanner(
+        columns=usecols, filter=expression, batch_size=_READ_CHUNK_SIZE
+    )
+    n_max = scanner.count_rows()
+
+    chunks = (
+        batch.to_pandas().astype(np.float32)
+        for batch in scanner.to_batches()
+    )
+
+    return _collect_complete_cases(chunks, fields, n_max)
+
+
+def _as_filter_tuples(row_filter: RowFilter) -> List[Any]:
+    # JSON configurations give lists, but pyarrow expects tuples.
+    def is_predicate(elem):
+        return len(elem) == 3 and isinstance(elem[0], str)
+
+    if all(is_predicate(elem) for elem in row_filter):
+        return [tuple(elem) for elem in row_filter]
+
+    return [[tuple(pred) for pred in conj] for conj in row_filter]
+
+
+def _parse_row_filter(specs: Optional[List[str]]) -> Optional[RowFilter]:
+    """Parses "column op value" strings into a conjunctive row filter."""
+    if not specs:
+        return None
+
+    row_filter = []
+    for spec in specs:
+        parts = spec.split(maxsplit=2)
+        if len(parts) != 3:
+            raise ValueError(
+                f"Invalid row filter '{spec}'. Use 'column op value'."
+            )
+
+        col, op, value = parts
+        try:
+            row_filter.append((col, op, float(value)))
+        except ValueError:
+            row_filter.append((col, op, value))
+
+    return row_filter
+
+
+def _read_dataset_file(
+    filename: str,
+    exposure_col: Optional[str],
+    outcome_col: Optional[OutcomeColumns],
+    iv_cols: List[str],
+    covariable_cols: List[str],
+    sampling_weights_col: Optional[str],
+    sep: str,
+    row_filter: Optional[RowFilter]
+) -> IVDataset:
+    outcome_cols = _as_column_list(outcome_col)
+    fields = {
+        "exposure": [exposure_col] if exposure_col else [],
+        "outcome": outcome_cols,
+        "ivs": iv_cols,
+        "covariables": covariable_cols,
+        "sampling_weights": (
+            [sampling_weights_col] if sampling_weights_col else []
+        )
+    }
+
+    if _columnar_format(filename) is not None:
+        tensors = _read_columnar_columns(filename, fields, row_filter)
+    elif row_filter:
+        raise ValueError(
+            "Row filters are only supported for Parquet, Feather and Arrow "
+            "IPC files."
+        )
+    else:
+        tensors = _read_delimited_columns(filename, sep, fields)
+
+    return IVDataset(
+        tensors["exposure"].reshape(-1) if exposure_col else torch.Tensor(),
+        tensors["outcome"] if outcome_cols else torch.Tensor(),
+        tensors["ivs"],
+        tensors["covariables"],
+        covariable_labels=covariable_cols,
+        sampling_weights=(
+            tensors["sampling_weights"].reshape(-1)
+            if sampling_weights_col else None
+        ),
+        outcome_labels=outcome_cols or None
+    )
+
+
+def _collect_complete_cases(
+    chunks: Iterable[pd.DataFrame],
+    fields: Dict[str, List[str]],
+    n_max: Optional[int] = None
+) -> Dict[str, torch.Tensor]:
+    """Writes the complete rows of float32 chunks into tensors per field.
+
+    The tensors are allocated for n_max rows if this upper bound on the
+    number of rows is known. Otherwise, they grow by half of their size when
+    they are full and are trimmed at the end, so the peak memory usage stays
+    within about 2.5 times the size of the returned tensors.
+
+    """
+    capacity = 0 if n_max is None else n_max
+    out = {
+        name: torch.empty((capacity, len(cols)), dtype=torch.float32)
+        for name, cols in fields.items()
+    }
+
+    n = 0
+    n_dropped = 0
+    for chunk in chunks:
+        complete = chunk.notna().all(axis=1).to_numpy()
+        n_complete = int(complete.sum())
+        n_dropped += len(chunk) - n_complete
+
+        if n + n_complete > capacity:
+            capacity = max(capacity + capacity // 2, n + n_complete)
+            for name, tens in out.items():
+                grown = torch.empty(
+                    (capacity, tens.size(1)), dtype=tens.dtype
+                )
+                grown[:n] = tens[:n]
+                out[name] = grown
+
+        for name, cols in fields.items():
+            if not cols:
+                continue
+
+            values = chunk[cols].to_numpy(dtype=np.float32)[complete]
+            out[name][n:(n + n_complete)] = torch.from_numpy(values)
+
+        n += n_complete
+
+    if n_dropped > 0:
+        warn(
+            f"Doing complete case analysis. Dropped {n_dropped} rows with "
+            f"missing values from the input data."
+        )
+
+    if n_max is None and n < capacity:
+        # Copies to release the unused rows.
+        return {name: tens[:n].clone() for name, tens in out.items()}
+
+    # Views over the filled rows.
+    return {name: tens[:n] for name, tens in out.items()}
+
+
+_CACHE_FIELDS = [
+    "exposure", "outcome", "ivs", "covariables", "sampling_weights"
+]
+
+
+def _file_digest(filename: str) -> str:
+    h = hashlib.blake2b(digest_size=20)
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+def _dataset_cache_path(
+    cache_dir: str,
+    filename: str,
+    columns: Dict[str, Any]
+) -> str:
+    key = json.dumps(
+        {"filename": os.path.abspath(filename), "columns": columns},
+        sort_keys=True
+    )
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=20).hexdigest()
+    return os.path.join(cache_dir, digest)
+
+
+def _load_dataset_cache(
+    cache_dir: str,
+    filename: str,
+    columns: Dict[str, Any]
+) -> Optional[IVDataset]:
+    path = _dataset_cache_path(cache_dir, filename, columns)
+    meta_filename = os.path.join(path, "meta.json")
+
+    try:
+        with open(meta_filename, "rt") as f:
+            meta = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+    # Validate the cache against the source file. We only hash the contents
+    # if the file was touched since the cache was created.
+    stat = os.stat(filename)
+    source = meta["source"]
+    if stat.st_size != source["size"] or (
+        stat.st_mtime_ns != source["mtime_ns"] and
+        _file_digest(filename) != source["digest"]
+    ):
+        info(f"Data file '{filename}' changed, rebuilding the cache.")
+        return None
+
+    tensors = {}
+    for field in _CACHE_FIELDS:
+        array_filename = os.path.join(path, f"{field}.npy")
+        if os.path.isfile(array_filename):
+            # Copy-on-write mapping so that the tensors are writable without
+            # ever modifying the cache.
+            tensors[field] = torch.from_numpy(
+                np.load(array_filename, mmap_mode="c")
+            )
+
+    info(f"Loaded cached dataset from '{path}'.")
+    return IVDataset(
+        tensors.get("exposure", torch.Tensor()),
+        tensors.get("outcome", torch.Tensor()),
+        tensors["ivs"],
+        tensors["covariables"],
+        covariable_labels=meta["covariable_labels"],
+        sampling_weights=tensors.get("sampling_weights"),
+        outcome_labels=meta.get("outcome_labels")
+    )
+
+
+def _save_dataset_cache(
+    cache_dir: str,
+    filename: str,
+    columns: Dict[str, Any],
+    dataset: IVDataset
+) -> None:
+    path = _dataset_cache_path(cache_dir, filename, columns)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # Write to a temporary directory and rename it so that concurrent
+    # readers (e.g. sweep workers) never see a partial cache.
+    tmp_path = tempfile.mkdtemp(dir=cache_dir, prefix=".tmp_")
+    try:
+        for field in _CACHE_FIELDS:
+            tens = getattr(dataset, field)
+            if tens is None or (
+                field in ("exposure", "outcome") and tens.numel() == 0
+            ):
+                continue
+
+            np.save(
+                os.path.join(tmp_path, f"{field}.npy"),
+                tens.to(torch.float32).numpy()
+            )
+
+        stat = os.stat(filename)
+        meta = {
+            "source": {
+                "filename": os.path.abspath(filename),
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "digest": _file_digest(filename)
+            },
+            "columns": columns,
+            "covariable_labels": dataset.covariable_labels,
+            "outcome_labels": dataset.outcome_labels,
+        }
+        with open(os.path.join(tmp_path, "meta.json"), "wt") as f:
+            json.dump(meta, f)
+
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Another process created the cache concurrently.
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    except Exception:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+
+INSTRUMENT_COMPRESSION_METHODS = ("pca", "score")
+
+
+def _iter_blocks(
+    dataset: Dataset,
+    block_size: int
+) -> Iterator[Tuple[torch.Tensor, ...]]:
+    n = len(dataset)  # type: ignore
+    for start in range(0, n, block_size):
+        end = min(start + block_size, n)
+        yield fetch_batch(dataset, torch.arange(start, end))
+
+
+class InstrumentCompressor(object):
+    """Linear compression of the instruments.
+
+    The instruments are centered (missing values are set to the mean) and
+    projected using a (n_instruments x k) matrix. The projection is fitted
+    by streaming over the dataset in blocks so that the full instrument
+    matrix is never held in memory at once.
+
+    """
+    # Fold of every row of the fitted dataset and (n_folds, p, 1) projections
+    # fitted without each fold, for the cross-fitted scores. Not saved.
+    cross_fit: Optional[Tuple[torch.Tensor, torch.Tensor]] = None
+
+    def __init__(
+        self,
+        method: str,
+        mean: torch.Tensor,
+        projection: torch.Tensor
+    ):
+        self.method = method
+        self.mean = mean
+        self.projection = projection
+
+    def n_components(self) -> int:
+        return self.projection.size(1)
+
+    def transform(
+        self,
+        ivs: torch.Tensor,
+        rows: Optional[torch.Tensor] = None
+    ) -> torch.Tensor:
+        """Compresses the instruments.
+
+        If rows are the indices of the instruments in the dataset used to
+        fit a cross-fitted score, every row is projected using the fit that
+        excluded its fold.
+
+        """
+        z = torch.nan_to_num(ivs.to(torch.float32) - self.mean, nan=0.0)
+        if rows is None or self.cross_fit is None:
+            return z @ self.projection
+
+        folds, projections = self.cross_fit
+        return torch.einsum("np,npk->nk", z, projections[folds[rows]])
+
+    def save(self, filename: str) -> None:
+        torch.save({
+            "method": self.method,
+            "mean": self.mean,
+            "projection": self.projection
+        }, filename)
+
+    @classmethod
+    def load(cls, filename: str) -> "InstrumentCompressor":
+        return cls(**torch.load(filename))
+
+    @classmethod
+    def fit(
+        cls,
+        dataset: Dataset,
+        method: str = "pca",
+        n_components: int = 20,
+        block_size: int = 10_000,
+        n_power_iterations: int = 2,
+        oversampling: int = 10,
+        alpha: float = 1.0,
+        n_folds: int = 5,
+        seed: int = 0,
+        tol: float = 1e-6,
+        max_iter: int = 500
+    ) -> "InstrumentCompressor":
+        """Fits a randomized PCA projection or a ridge-weighted score.
+
+        The score is the ridge regression of the exposure on the instruments
+        (as in weighted allele scores) and is a single variable. Because the
+        score uses the exposure, the scores of the rows of the dataset are
+        cross-fitted over n_folds random folds (see cross_fit), so that the
+        validation rows of the estimators don't leak into their own first
+        stage features. The projection fitted on all the rows is used for
+        new data. The PCA doesn't use the exposure.
+
+        The ridge regressions are solved by conjugate gradient with one pass
+        over the dataset per iteration (up to max_iter, until the relative
+        residual is below tol), so the memory doesn't grow with the square
+        of the number of instruments.
+
+        """
+        if method not in INSTRUMENT_COMPRESSION_METHODS:
+            raise ValueError(
+                f"Unknown instrument compression method '{method}'. Use one "
+                f"of {INSTRUMENT_COMPRESSION_METHODS}."
+            )
+
+        # First pass to get the means ignoring missing values.
+        z_sum = None
+        z_count = None
+        for _, _, ivs, _ in _iter_blocks(dataset, block_size):
+            ivs = ivs.to(torch.float64)
+            missing = torch.isnan(ivs)
+            block_sum = torch.where(missing, 0, ivs).sum(dim=0)
+            block_count = (~missing).sum(dim=0)
+            if z_sum is None:
+                z_sum, z_count = block_sum, block_count
+            else:
+                z_sum += block_sum
+                z_count += block_count
+
+        assert z_sum is not None and z_count is not None
+        mean = (z_sum / z_count.clamp(min=1)).to(torch.float32)
+        n = len(dataset)  # type: ignore
+        p = mean.numel()
+
+        def centered_blocks():
+            for x, _, ivs, _ in _iter_blocks(dataset, block_size):
+                z = torch.nan_to_num(
+                    ivs.to(torch.float32) - mean, nan=0.0
+                )
+                yield x, z
+
+        if method == "score":
+            return cls._fit_score(
+                mean, centered_blocks, n, alpha, n_folds, seed, tol, max_iter
+            )
+
+        # Randomized SVD of the centered instrument matrix.
+        k = min(n_components, p)
+        n_cols = min(k + oversampling, p)
+
+        def multiply(omega: torch.Tensor) -> torch.Tensor:
+            # Z @ omega
+            return torch.vstack([z @ omega for _, z in centered_blocks()])
+
+        def multiply_t(q: torch.Tensor) -> torch.Tensor:
+            # Z.T @ q
+            out = torch.zeros((p, q.size(1)))
+            start = 0
+            for _, z in centered_blocks():
+                end = start + z.size(0)
+                out += z.T @ q[start:end]
+                start = end
+
+            return out
+
+        q, _ = torch.linalg.qr(multiply(torch.randn(p, n_cols)))
+        for _ in range(n_power_iterations):
+            w, _ = torch.linalg.qr(multiply_t(q))
+            q, _ = torch.linalg.qr(multiply(w))
+
+        b_t = multiply_t(q)  # (p x l), B = Q.T @ Z
+        _, _, v_t = torch.linalg.svd(b_t.T, full_matrices=False)
+
+        return cls(method, mean, v_t[:k].T.contiguous())
+
+    @classmethod
+    def _fit_score(
+        cls,
+        mean: torch.Tensor,
+        blocks: Callable[[], Iterator[Tuple[torch.Tensor, torch.Tensor]]],
+        n: int,
+        alpha: float,
+        n_folds: int,
+        seed: int,
+        tol: float,
+        max_iter: int
+    ) -> "InstrumentCompressor":
+        p = mean.numel()
+        n_folds = max(n_folds, 1)
+        folds = torch.randint(
+            n_folds, (n, ), generator=torch.Generator().manual_seed(seed)
+        )
+
+        # The first system uses all the rows, the others leave out a fold.
+        keep = torch.ones((1, n_folds), dtype=torch.bool)
+        if n_folds > 1:
+            keep = torch.vstack([keep, ~torch.eye(n_folds, dtype=torch.bool)])
+
+        keep64 = keep.to(torch.float64)
+
+        # Per fold sums for the right hand sides and the diagonal of the
+        # gram matrices (Jacobi preconditioner).
+        zx = torch.zeros((n_folds, p), dtype=torch.float64)
+        z_sum = torch.zeros((n_folds, p), dtype=torch.float64)
+        z_sq = torch.zeros((n_folds, p), dtype=torch.float64)
+        x_sum = torch.zeros(n_folds, dtype=torch.float64)
+        start = 0
+        for x, z in blocks():
+            if x.numel() == 0:
+                raise ValueError(
+                    "The exposure is needed to fit an instrument score."
+                )
+
+            end = start + z.size(0)
+            one_hot = torch.nn.functional.one_hot(
+                folds[start:end], n_folds
+            ).to(torch.float64)
+            z64 = z.to(torch.float64)
+            x64 = x.to(torch.float64).reshape(-1)
+            zx += one_hot.T @ (z64 * x64.reshape(-1, 1))
+            z_sum += one_hot.T @ z64
+            z_sq += one_hot.T @ z64 ** 2
+            x_sum += one_hot.T @ x64
+            start = end
+
+        counts = torch.bincount(folds, minlength=n_folds).to(torch.float64)
+        x_mean = (keep64 @ x_sum) / (keep64 @ counts).clamp(min=1)
+        rhs = (keep64 @ zx - x_mean.reshape(-1, 1) * (keep64 @ z_sum)).T
+        precond = (keep64 @ z_sq).T + alpha
+
+        def multiply(b: torch.Tensor) -> torch.Tensor:
+            # (Z_keep.T @ Z_keep + alpha * I) @ b for every system (column).
+            out = alpha * b
+            start = 0
+            for _, z in blocks():
+                end = start + z.size(0)
+                z64 = z.to(torch.float64)
+                u = (z64 @ b) * keep64[:, folds[start:end]].T
+                out += z64.T @ u
+                start = end
+
+            return out
+
+        # Preconditioned conjugate gradient on all the systems at once.
+        betas = torch.zeros_like(rhs)
+        resid = rhs.clone()
+        prec_resid = resid / precond
+        direction = prec_resid.clone()
+        rho = (resid * prec_resid).sum(dim=0)
+        threshold = tol * torch.linalg.norm(rhs, dim=0)
+        active = torch.linalg.norm(resid, dim=0) > threshold
+        n_iter = 0
+        while active.any() and n_iter < max_iter:
+            a_dir = multiply(direction)
+            step = torch.where(
+                active, rho / (direction * a_dir).sum(dim=0), 0.0
+            )
+            betas += step * direction
+            resid -= step * a_dir
+            active &= torch.linalg.norm(resid, dim=0) > threshold
+
+            prec_resid = resid / precond
+            rho_next = (resid * prec_resid).sum(dim=0)
+            direction = prec_resid + torch.where(
+                active, rho_next / rho, 0.0
+            ) * direction
+            rho = rho_next
+            n_iter += 1
+
+        if active.any():
+            warn(
+                f"The instrument score did not converge in {max_iter} "
+                f"iterations."
+            )
+
+        projections = betas.T.reshape(-1, p, 1).to(torch.float32)
+        compressor = cls("score", mean, projections[0])
+        if n_folds > 1:
+            compressor.cross_fit = (folds, projections[1:].contiguous())
+
+        return compressor
+
+
+def compress_instruments(
+    dataset: Dataset,
+    method: str = "pca",
+    n_components: int = 20,
+    block_size: int = 10_000,
+    **kwargs
+) -> IVDataset:
+    """Returns an in-memory dataset where the instruments are compressed.
+
+    The fitted InstrumentCompressor is attached to the returned dataset and is
+    saved with the estimators (see IVDataset.save_instrument_compressor).
+    Instrument scores of the rows of the dataset are cross-fitted (see
+    InstrumentCompressor.fit).
+
+    """
+    compressor = InstrumentCompressor.fit(
+        dataset, method, n_components, block_size, **kwargs
+    )
+    info(
+        f"Compressed {compressor.mean.numel()} instruments to "
+        f"{compressor.n_components()} variable(s) using '{method}'."
+    )
+
+    fields: Dict[str, List[torch.Tensor]] = collections.defaultdict(list)
+    start = 0
+    for x, y, ivs, covars in _iter_blocks(dataset, block_size):
+        rows = torch.arange(start, start + ivs.size(0))
+        fields["exposure"].append(x)
+        fields["outcome"].append(y)
+        fields["ivs"].append(compressor.transform(ivs, rows))
+        fields["covariables"].append(covars)
+        start += ivs.size(0)
+
+    # Other fields keep their storage dtype.
+    storage_dtypes = {
+        field: getattr(dataset, field).dtype
+        for field in ("exposure", "outcome", "covariables")
+        if isinstance(getattr(dataset, field, None), torch.Tensor)
+    }
+
+    compressed = IVDataset(
+        exposure=torch.vstack(fields["exposure"]),
+        outcome=torch.vstack(fields["outcome"]),
+        ivs=torch.vstack(fields["ivs"]),
+        covariables=torch.vstack(fields["covariables"]),
+        covariable_labels=getattr(dataset, "covariable_labels", None),
+        sampling_weights=getattr(dataset, "sampling_weights", None),
+        storage_dtypes=storage_dtypes,  # type: ignore
+        outcome_labels=getattr(dataset, "outcome_labels", None)
+    )
+    compressed.instrument_compressor = compressor
+
+    return compressed
+
+
+def _parse_storage_dtypes(
+    specs: Optional[List[str]]
+) -> Optional[Dict[str, str]]:
+    if not specs:
+        return None
+
+    dtypes = {}
+    for spec in specs:
+        field, sep, dtype = spec.partition("=")
+        if not sep:
+            raise ValueError(
+                f"Invalid storage dtype '{spec}'. Use FIELD=DTYPE."
+            )
+        dtypes[field] = dtype
+
+    return dtypes
+
+
+def _compress_instruments_from_args(
+    dataset: IVDataset,
+    args: argparse.Namespace
+) -> IVDataset:
+    method = getattr(args, "compress_instruments", None)
+    if method is None:
+        return dataset
+
+    return compress_instruments(
+        dataset, method, n_components=args.compress_instruments_dim
+    )
+
+
+class _BatchFetcher(Dataset):
+    """Adapter that is indexed by a list of indices and returns a batch."""
+    def __init__(self, dataset: Dataset):
+        self.dataset = dataset
+
+    def __getitem__(self, indices: BatchIndex) -> Any:
+        return fetch_batch(self.dataset, indices)
+
+    def __len__(self) -> int:
+        return len(self.dataset)  # type: ignore
+
+
+class BatchedDataLoader(DataLoader):
+    """DataLoader that fetches whole batches at once.
+
+    A batch sampler is used to generate the indices of every batch, and the
+    batch is read from the dataset using fetch_batch. For IVDataset, subsets
+    and resampled datasets this means that every batch is a single tensor
+    index operation instead of collating batch_size individual samples.
+
+    """
+    def __init__(
+        self,
+        dataset: Dataset,
+        batch_size: int,
+        shuffle: bool = False,
+        drop_last: bool = False,
+        num_workers: int = 0
+    ):
+        sampler = (
+            RandomSampler(dataset) if shuffle  # type: ignore
+            else SequentialSampler(dataset)  # type: ignore
+        )
+
+        super().__init__(
+            _BatchFetcher(dataset),
+            sampler=BatchSampler(sampler, batch_size, drop_last),
+            batch_size=None,
+            num_workers=num_workers
+        )
+
 
 class FullBatchDataLoader(DataLoader):
     def __init__(self, dataset: Dataset):
         super().__init__(dataset, batch_size=len(dataset))  # type: ignore
 
         # Cache the whole dataset.
-        dl = DataLoader(dataset, batch_size=len(dataset))  # type: ignore
-        self.payload = next(iter(dl))
+        self.payload = fetch_batch(
+            dataset, torch.arange(len(dataset))  # type: ignore
+        )
 
     def __iter__(self):
         yield self.payload
 
 
+def dataset_tensors(
+    dataset: Dataset
+) -> Optional[Tuple[Tuple[torch.Tensor, ...], Optional[torch.Tensor]]]:
+    """Resolves a dataset into in-memory tensors and a row index.
+
+    Subsets (including resampled datasets) are not materialized, instead their
+    indices are composed into a single index tensor over the rows of the
+    underlying tensors. The index is None if all rows are used in order.
+
+    Returns None if the dataset can't be represented as tensors.
+
+    """
+    if isinstance(dataset, SampleWeightedDataset):
+        resolved = dataset_tensors(dataset.dataset)
+        if resolved is None or resolved[1] is not None:
+            # The weights are stored per row of the underlying tensors, so
+            # we only support weighting a dataset that is not a view.
+            return None
+
+        tensors, _ = resolved
+        weights = torch.zeros(
+            (tensors[0].size(0), *dataset.weights.shape[1:]),
+            dtype=torch.float32
+        )
+        weights[dataset.indices] = dataset.weights
+        return tensors + (weights, ), dataset.indices
+
+    if isinstance(dataset, Subset):
+        resolved = dataset_tensors(dataset.dataset)
+        if resolved is None:
+            return None
+
+        tensors, parent_index = resolved
+        index = _as_index_tensor(dataset.indices)
+        if parent_index is not None:
+            index = parent_index[index]
+
+        return tensors, index
+
+    if isinstance(dataset, SupervisedLearningWrapper):
+        resolved = dataset_tensors(dataset.dataset)
+        if resolved is None:
+            return None
+
+        (x, _, ivs, covars, *weights), index = resolved
+        exog = torch.hstack([to_compute_dtype(ivs), to_compute_dtype(covars)])
+        return (exog, x, *weights), index
+
+    as_tensors = getattr(type(dataset), "as_tensors", None)
+    if as_tensors is None:
+        return None
+
+    tensors = as_tensors(dataset)
+    if tensors is None:
+        return None
+
+    return tensors, None
+
+
+class TensorBatchLoader(object):
+    """Batch loader that iterates directly over in-memory tensors.
+
+    A single random permutation of the rows is drawn at the start of every
+    epoch and batches are read using index_select. If there is no shuffling
+    and the dataset is not a subset, the batches are contiguous views of the
+    underlying tensors. Use dataset_tensors to check if a dataset is
+    supported.
+
+    """
+    def __init__(
+        self,
+        dataset: Dataset,
+        batch_size: int,
+        shuffle: bool = False,
+        drop_last: bool = False,
+        pin_memory: bool = False
+    ):
+        resolved = dataset_tensors(dataset)
+        if resolved is None:
+            raise ValueError(
+                f"Can't represent dataset of type '{type(dataset).__name__}' "
+                f"as in-memory tensors."
+            )
+
+        self.tensors, self.index = resolved
+        self.n = (
+            self.tensors[0].size(0) if self.index is None
+            else self.index.numel()
+        )
+
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+
+        # When the loader yields the same single batch every epoch (e.g. full
+        # batch validation), we only gather it once.
+        self._payload: Optional[Tuple[torch.Tensor, ...]] = None
+        if not shuffle and batch_size >= self.n:
+            self._payload = self._take(0, self.n, self.index)
+
+    def __len__(self) -> int:
+        if self.drop_last:
+            return self.n // self.batch_size
+
+        return math.ceil(self.n / self.batch_size)
+
+    def _take(
+        self,
+        start: int,
+        end: int,
+        order: Optional[torch.Tensor]
+    ) -> Tuple[torch.Tensor, ...]:
+        if order is None:
+            batch = tuple(tens[start:end] for tens in self.tensors)
+        else:
+            idx = order[start:end]
+            batch = tuple(tens.index_select(0, idx) for tens in self.tensors)
+
+        # Fields kept in a compact storage dtype are upcast per batch.
+        batch = tuple(to_compute_dtype(tens) for tens in batch)
+
+        if self.pin_memory:
+            batch = tuple(tens.pin_memory() for tens in batch)
+
+        return batch
+
+    def __iter__(self) -> Iterator[Tuple[torch.Tensor, ...]]:
+        if self._payload is not None:
+            if len(self) > 0:
+                yield self._payload
+            return
+
+        if self.shuffle:
+            order: Optional[torch.Tensor] = torch.randperm(self.n)
+            if self.index is not None:
+                order = self.index[order]
+        else:
+            order = self.index
+
+        for i in range(len(self)):
+            start = i * self.batch_size
+            end = min(start + self.batch_size, self.n)
+            yield self._take(start, end, order)
+
+
+class DosageBlockStore(object):
+    """Compact cache of genotype dosages read in blocks of samples.
+
+    Dosages (in [0, 2]) are stored as uint8 using 127 steps per allele and
+    missing values are encoded as 255. Allele counts from hard calls are
+    represented exactly and other dosages are rounded to the nearest step
+    (an error of at most 1 / 254, about 0.004). The store can be kept in
+    memory or in a memory-mapped file, and dosages are only expanded to
+    floats when a batch is requested.
+
+    A memory-mapped store is reused by later runs if it was created with the
+    same key (see IVDatasetWithGenotypes). The blocks that were filled are
+    kept in a bitmap next to the file (<filename>.filled.npy) and the key in
+    <filename>.json.
+
+    """
+    MISSING = 255
+    SCALE = 127
+
+    def __init__(
+        self,
+        n_samples: int,
+        n_variants: int,
+        block_size: int = 1024,
+        filename: Optional[str] = None,
+        key: Optional[str] = None
+    ):
+        self.n_samples = n_samples
+        self.n_variants = n_variants
+        self.block_size = block_size
+        self.filename = filename
+
+        shape = (n_samples, n_variants)
+        n_blocks = math.ceil(n_samples / block_size)
+        if filename is None:
+            self.codes = np.empty(shape, dtype=np.uint8)
+            self.loaded = np.zeros(n_blocks, dtype=bool)
+        else:
+            self._open(filename, key, shape, n_blocks)
+
+    def _open(
+        self,
+        filename: str,
+        key: Optional[str],
+        shape: Tuple[int, int],
+        n_blocks: int
+    ) -> None:
+        meta_filename = f"{filename}.json"
+        loaded_filename = f"{filename}.filled.npy"
+        meta = {
+            "key": key,
+            "shape": list(shape),
+            "block_size": self.block_size,
+            "scale": self.SCALE,
+        }
+
+        try:
+            with open(meta_filename, "rt") as f:
+                previous = json.load(f)
+        except (FileNotFoundError, ValueError):
+            previous = None
+
+        reuse = (
+            key is not None and previous == meta and
+            os.path.isfile(filename) and os.path.isfile(loaded_filename)
+        )
+
+        if reuse:
+            self.codes = np.lib.format.open_memmap(filename, mode="r+")
+            self.loaded = np.lib.format.open_memmap(loaded_filename, mode="r+")
+            info(
+                f"Reusing {int(self.loaded.sum())} / {n_blocks} cached "
+                f"dosage blocks from '{filename}'."
+            )
+            return
+
+        # The metadata is written last so that an interrupted creation is
+        # never reused.
+        if os.path.isfile(meta_filename):
+            os.remove(meta_filename)
+
+        self.codes = np.lib.format.open_memmap(
+            filename, mode="w+", dtype=np.uint8, shape=shape
+        )
+        self.loaded = np.lib.format.open_memmap(
+            loaded_filename, mode="w+", dtype=bool, shape=(n_blocks, )
+        )
+        self.loaded[:] = False
+        self.loaded.flush()
+
+        if key is not None:
+            with open(meta_filename, "wt") as f:
+                json.dump(meta, f)
+
+    @classmethod
+    def encode(cls, dosage: torch.Tensor) -> np.ndarray:
+        dosage = dosage.to(torch.float32)
+        codes = torch.round(dosage.clamp(0, 2) * cls.SCALE)
+        codes[torch.isnan(dosage)] = cls.MISSING
+        return codes.to(torch.uint8).numpy()
+
+    @classmethod
+    def decode(cls, codes: np.ndarray) -> torch.Tensor:
+        codes_tens = torch.from_numpy(codes)
+        dosage = codes_tens.to(torch.float32) / cls.SCALE
+        dosage[codes_tens == cls.MISSING] = float("nan")
+        return dosage
+
+    def missing_blocks(self, indices: torch.Tensor) -> List[int]:
+        blocks = torch.unique(indices // self.block_size).numpy()
+        return [int(b) for b in blocks if not self.loaded[b]]
+
+    def block_range(self, block: int) -> Tuple[int, int]:
+        start = block * self.block_size
+        return start, min(start + self.block_size, self.n_samples)
+
+    def set_block(self, block: int, dosage: torch.Tensor) -> None:
+        start, end = self.block_range(block)
+        self.codes[start:end] = self.encode(dosage)
+
+        if isinstance(self.loaded, np.memmap):
+            # The block is only marked as filled once its codes are written.
+            self.codes.flush()  # type: ignore
+            self.loaded[block] = True
+            self.loaded.flush()
+        else:
+            self.loaded[block] = True
+
+    def take(self, indices: torch.Tensor) -> torch.Tensor:
+        return self.decode(self.codes[indices.numpy()])
+
+
+class GenotypeBlockReader(object):
+    """Reads the dosages of ranges of samples of a pytorch genotypes dataset.
+
+    The rows of a PhenotypeGeneticDataset map to the rows of its backend
+    through dataset.idx["geno"]. A range of rows is read with a single
+    backend call indexed by the array of backend rows, which the array based
+    backends support. Backends that can't be indexed this way are read one
+    sample at a time through the dataset.
+
+    The exogenous variables of the samples are mapped the same way, through
+    dataset.idx["exog"], so that they stay paired with the genotypes.
+
+    """
+    def __init__(self, genetic_dataset: "PhenotypeGeneticDataset"):
+        self.genetic_dataset = genetic_dataset
+        self.n_variants = genetic_dataset[0].dosage.numel()
+
+        self.backend = getattr(genetic_dataset, "backend", None)
+        idx = getattr(genetic_dataset, "idx", None)
+        if self.backend is None or idx is None:
+            self.backend_rows = None
+        else:
+            self.backend_rows = np.asarray(idx["geno"], dtype=np.int64)
+
+        self.exog_rows: Optional[torch.Tensor] = None
+        if idx is not None and "exog" in idx:
+            self.exog_rows = torch.as_tensor(
+                np.asarray(idx["exog"], dtype=np.int64)
+            )
+
+    def read_exogenous(self, rows: torch.Tensor) -> torch.Tensor:
+        """Returns the exogenous variables of the rows of the dataset.
+
+        These are the same as the exogenous variables of the samples. Without
+        a row mapping, the samples are read one at a time.
+
+        """
+        if self.exog_rows is not None:
+            return self.genetic_dataset.exog[self.exog_rows[rows]]
+
+        return torch.vstack([
+            torch.as_tensor(
+                self.genetic_dataset[int(i)].exogenous
+            ).reshape(1, -1)
+            for i in rows
+        ])
+
+    def all_exogenous(self) -> torch.Tensor:
+        """Exogenous variables of all the rows of the dataset."""
+        if self.exog_rows is not None:
+            return self.genetic_dataset.exog[self.exog_rows]
+
+        return self.genetic_dataset.exog
+
+    def _read_backend(self, rows: np.ndarray) -> Optional[torch.Tensor]:
+        try:
+            dosage = torch.as_tensor(self.backend[rows])  # type: ignore
+        except (TypeError, IndexError, KeyError, ValueError):
+            return None
+
+        if tuple(dosage.shape) != (len(rows), self.n_variants):
+            return None
+
+        return dosage
+
+    def read(self, start: int, end: int) -> torch.Tensor:
+        """Returns the (end - start, n_variants) dosages of the rows."""
+        if self.backend_rows is not None:
+            dosage = self._read_backend(self.backend_rows[start:end])
+            if dosage is not None:
+                return dosage
+
+            info("The genotypes backend can't read blocks of samples, "
+                 "reading one sample at a time.")
+            self.backend_rows = None
+
+        return torch.vstack([
+            self.genetic_dataset[i].dosage.reshape(1, -1)
+            for i in range(start, end)
+        ])
+
+    def cache_key(self, backend_filename: str) -> Optional[str]:
+        """Identifies the dosage matrix for a persistent DosageBlockStore.
+
+        The key covers the backend file (which fixes the variants) and the
+        backend rows of the samples in the order of the dataset. It is None
+        if the sample mapping is unknown.
+
+        """
+        if self.backend_rows is None:
+            return None
+
+        stat = os.stat(backend_filename)
+        h = hashlib.blake2b(digest_size=20)
+        h.update(json.dumps({
+            "backend": os.path.abspath(backend_filename),
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "n_variants": self.n_variants,
+        }, sort_keys=True).encode("utf-8"))
+        h.update(self.backend_rows.tobytes())
+        return h.hexdigest()
+
+
 class IVDatasetWithGenotypes(IVDataset):
     def __init__(
         self,
@@ -357,11 +1871,19 @@ class IVDatasetWithGenotypes(IVDataset):
         exposure_col: str,
         outcome_col: str,
         iv_cols: Iterable[str],
-        covariable_cols: Iterable[str]
+        covariable_cols: Iterable[str],
+        dosage_cache_filename: Optional[str] = None,
+        dosage_block_size: int = 1024,
+        dosage_cache_key: Optional[str] = None
     ):
         """Dataset that also includes genotypes read using pytorch genotypes.
 
-        TODO: This is not tested yet.
+        Genotypes are read from the backend in blocks of samples the first
+        time they are needed (see GenotypeBlockReader) and kept in a compact
+        DosageBlockStore (in memory or memory-mapped if a filename is
+        provided). The memory-mapped store is reused by later runs with the
+        same dosage_cache_key.
+
         Weighted resampling is not supported.
 
         """
@@ -390,8 +1912,10 @@ class IVDatasetWithGenotypes(IVDataset):
                 assert self.outcome_index is None
                 self.outcome_index = idx
 
-        self.iv_idx_tens = torch.tensor(iv_indices)
-        self.covariable_idx_tens = torch.tensor(covariable_indices)
+        self.iv_idx_tens = torch.tensor(iv_indices, dtype=torch.long)
+        self.covariable_idx_tens = torch.tensor(
+            covariable_indices, dtype=torch.long
+        )
 
         if self.exposure_index is None:
             warn(f"Exposure '{exposure_col}' not found in genetic dataset "
@@ -401,43 +1925,72 @@ class IVDatasetWithGenotypes(IVDataset):
             warn(f"Outcome '{outcome_col}' not found in genetic dataset "
                  f"(will not be accessible).")
 
+        self.reader = GenotypeBlockReader(genetic_dataset)
+        self.dosages = DosageBlockStore(
+            len(genetic_dataset), self.reader.n_variants,
+            block_size=dosage_block_size,
+            filename=dosage_cache_filename,
+            key=dosage_cache_key
+        )
+
+    def _read_dosage_block(self, block: int) -> torch.Tensor:
+        return self.reader.read(*self.dosages.block_range(block))
+
+    def _get_dosages(self, indices: torch.Tensor) -> torch.Tensor:
+        for block in self.dosages.missing_blocks(indices):
+            self.dosages.set_block(block, self._read_dosage_block(block))
+
+        return self.dosages.take(indices)
+
     def __getitem__(self, index: int) -> IVDatasetBatch:
-        cur = self.genetic_dataset[index]
-        if self.exposure_index is not None:
-            exposure = cur.exogenous[[self.exposure_index]]
-        else:
-            exposure = torch.Tensor()
+        exposure, outcome, instruments, covars = self.get_batch([index])
 
-        if self.outcome_index is not None:
-            outcome = cur.exogenous[[self.outcome_index]]
-        else:
-            outcome = torch.Tensor()
+        return (
+            exposure[0] if exposure.numel() > 0 else torch.Tensor(),
+            outcome[0] if outcome.numel() > 0 else torch.Tensor(),
+            instruments[0],
+            covars[0] if covars.numel() > 0 else torch.Tensor()
+        )
+
+    def get_batch(self, indices: BatchIndex) -> IVDatasetBatch:
+        idx = _as_index_tensor(indices)
+        exog = self.reader.read_exogenous(idx).to(torch.float32)
 
-        instruments = cur.dosage
-        covars = torch.Tensor()
+        def take_exog(col: Optional[int]) -> torch.Tensor:
+            if col is None:
+                return torch.empty((idx.numel(), 0))
 
-        if self.covariable_idx_tens.numel() > 0:
-            covars = cur.exogenous[self.covariable_idx_tens]
+            return exog[:, [col]]
 
+        instruments = self._get_dosages(idx)
         if self.iv_idx_tens.numel() > 0:
             instruments = torch.hstack(
-                (instruments, cur.exogenous[:, self.iv_idx_tens])
+                (instruments, exog[:, self.iv_idx_tens])
             )
 
-        return exposure, outcome, instruments, covars
+        return (
+            take_exog(self.exposure_index),
+            take_exog(self.outcome_index),
+            instruments,
+            exog[:, self.covariable_idx_tens]
+        )
+
+    def as_tensors(self) -> Optional[Tuple[torch.Tensor, ...]]:
+        # Genotypes are read from the backend and not held in memory.
+        return None
 
     def __len__(self) -> int:
         return len(self.genetic_dataset)
 
     @property
     def covariables(self):
-        covars = self.genetic_dataset.exog[:, self.covariable_idx_tens]\
+        covars = self.reader.all_exogenous()[:, self.covariable_idx_tens]\
             .to(torch.float32)
         return covars
 
     @property
     def exposure(self):
-        return self.genetic_dataset.exog[:, [self.exposure_index]]
+        return self.reader.all_exogenous()[:, [self.exposure_index]]
 
     @staticmethod
     def from_argparse_namespace(args: argparse.Namespace) -> IVDataset:
@@ -450,6 +2003,13 @@ class IVDatasetWithGenotypes(IVDataset):
                 "Resampling weights not implemented for genetic datasets."
             )
 
+        outcome_cols = _as_column_list(args.outcome)
+        if len(outcome_cols) != 1:
+            raise NotImplementedError(
+                "Multiple outcomes not implemented for genetic datasets."
+            )
+        outcome_col = outcome_cols[0]
+
         # Read genotype data.
         backend_class = BACKENDS.get(
             args.genotypes_backend_type, GeneticDatasetBackend
@@ -468,21 +2028,36 @@ class IVDatasetWithGenotypes(IVDataset):
             phenotypes_sample_id_column=args.sample_id_col,
             exogenous_columns=itertools.chain(
                 args.instruments, args.covariables,
-                [args.exposure, args.outcome]
+                [args.exposure, outcome_col]
             ),
         )
 
-        return IVDatasetWithGenotypes(
-            genetic_dataset=dataset,
-            exposure_col=args.exposure,
-            outcome_col=args.outcome,
-            iv_cols=args.instruments,
-            covariable_cols=args.covariables
+        dosage_cache_key = None
+        if args.genotypes_dosage_cache is not None:
+            dosage_cache_key = GenotypeBlockReader(dataset).cache_key(
+                args.genotypes_backend
+            )
+
+        return _compress_instruments_from_args(
+            IVDatasetWithGenotypes(
+                genetic_dataset=dataset,
+                exposure_col=args.exposure,
+                outcome_col=outcome_col,
+                iv_cols=args.instruments,
+                covariable_cols=args.covariables,
+                dosage_cache_filename=args.genotypes_dosage_cache,
+                dosage_cache_key=dosage_cache_key
+            ),
+            args
         )
 
     @classmethod
-    def add_dataset_arguments(cls, parser: argparse.ArgumentParser):
-        super().add_dataset_arguments(parser)
+    def add_dataset_arguments(
+        cls,
+        parser: argparse.ArgumentParser,
+        multiple_outcomes: bool = False
+    ):
+        super().add_dataset_arguments(parser, multiple_outcomes)
 
         parser.add_argument(
             "--genotypes-backend",
@@ -506,6 +2081,20 @@ class IVDatasetWithGenotypes(IVDataset):
             type=str,
         )
 
+        parser.add_argument(
+            "--genotypes-dosage-cache",
+            help=(
+                "Optional .npy file used to memory-map the compact dosage "
+                "cache instead of holding it in memory. It is reused by "
+                "later runs with the same genotypes backend and samples. "
+                "Dosages are stored with 127 steps per allele, so imputed "
+                "dosages are rounded (error of at most 0.004), while hard "
+                "calls are exact."
+            ),
+            default=None,
+            type=str,
+        )
+
         parser.add_argument(
             "--sample-id-col",
             default="sample_id",
@@ -514,6 +2103,69 @@ class IVDatasetWithGenotypes(IVDataset):
         )
 
 
+class SampleWeightedDataset(Subset):
+    """View of a dataset where every sample has a loss weight.
+
+    The weight is appended as the last element of the samples and batches.
+    This is used to represent bootstrap samples using the number of times
+    every row was drawn instead of duplicating the rows.
+
+    The weights can also be a matrix with one column per bootstrap replicate
+    in which case every sample has a vector of weights.
+
+    """
+    def __init__(
+        self,
+        dataset: Dataset,
+        indices: torch.Tensor,
+        weights: torch.Tensor
+    ):
+        assert indices.numel() == weights.size(0)
+        super().__init__(dataset, indices)  # type: ignore
+        weights = weights.to(torch.float32)
+        if weights.dim() != 2 or weights.size(1) == 1:
+            weights = weights.reshape(-1)
+
+        self.weights = weights
+
+    def __getattr__(self, k):
+        # Defer to the dataset for everything except the indexing.
+        if k in ("dataset", "indices", "weights"):
+            raise AttributeError(k)
+
+        return getattr(self.dataset, k)
+
+    def __getitem__(self, idx):
+        return (*self.dataset[self.indices[idx]], self.weights[idx])
+
+    def __getitems__(self, indices):
+        return [self[idx] for idx in indices]
+
+    def get_batch(self, indices: BatchIndex) -> Tuple[torch.Tensor, ...]:
+        idx = _as_index_tensor(indices)
+        batch = fetch_batch(self.dataset, self.indices[idx])
+        return (*batch, self.weights[idx])
+
+    def to_dataframe(self) -> Tuple[pd.DataFrame, dict]:
+        """Converts the dataset to a DataFrame with the sample weights.
+
+        Replicate weights are written as one sample_weight_{i} column per
+        replicate.
+
+        """
+        df, cols = self.dataset.to_dataframe(  # type: ignore
+            indices=self.indices
+        )
+        weights = self.weights.numpy()
+        if weights.ndim == 1:
+            df["sample_weight"] = weights
+        else:
+            for i in range(weights.shape[1]):
+                df[f"sample_weight_{i}"] = weights[:, i]
+
+        return df, cols
+
+
 class SupervisedLearningWrapper(Dataset):
     """Wraps an IVDataset for supervised learning.
 
@@ -526,9 +2178,14 @@ class SupervisedLearningWrapper(Dataset):
     def n_exog(self):
         return self.dataset.n_exog()
 
-    def __getitem__(self, idx: int) -> Tuple[torch.Tensor, torch.Tensor]:
-        x, _, ivs, covars = self.dataset[idx]
-        return (torch.hstack([ivs, covars]), x)
+    def __getitem__(self, idx: int) -> Tuple[torch.Tensor, ...]:
+        # Sample weights (if any) are passed through as the last element.
+        x, _, ivs, covars, *weights = self.dataset[idx]
+        return (torch.hstack([ivs, covars]), x, *weights)
+
+    def get_batch(self, indices: BatchIndex) -> Tuple[torch.Tensor, ...]:
+        x, _, ivs, covars, *weights = fetch_batch(self.dataset, indices)
+        return (torch.hstack([ivs, covars]), x, *weights)
 
     def __len__(self):
         return len(self.dataset)
@@ -16,14 +16,18 @@ def ridge_regression(
     n_samples, n_features = x.shape
     assert y.shape[0] == n_samples
 
-    L = x.T @ x + alpha * torch.eye(n_features, device=device)
-    try:
-        L_chol = torch.linalg.cholesky(L)
-    except Exception as e:
-        print(e)
-        raise RuntimeError()
+    # The solve is always done in float32, also under mixed precision.
+    with torch.autocast(x.device.type, enabled=False):
+        x, y = x.float(), y.float()
 
-    betas = torch.cholesky_solve(x.T @ y, L_chol)
+        L = x.T @ x + alpha * torch.eye(n_features, device=device)
+        try:
+            L_chol = torch.linalg.cholesky(L)
+        except Exception as e:
+            print(e)
+            raise RuntimeError()
+
+        betas = torch.cholesky_solve(x.T @ y, L_chol)
 
     return betas
 
@@ -35,4 +39,5 @@ def ridge_fit_predict(
     device: Optional[torch.device] = None
 ) -> Tuple[torch.Tensor, torch.Tensor]:
     betas = ridge_regression(x, y, alpha, device)
-    return betas, x @ betas
+    with torch.autocast(x.device.type, enabled=False):
+        return betas, x.float() @ betas
@@ -87,19 +87,26 @@ class MixtureDensityNetwork(DensityModel):
         )
 
     def model_nll(self, x, y):
-        # Get the predicted parameters.
-        pi, mu, sigma = self.forward_parameters(x)
-
-        log_component_prob = self.gaussian_log_likelihood(y, mu, sigma)
-        log_mix_prob = torch.log(
-            F.gumbel_softmax(
-                pi,
-                tau=self.hparams.softmax_temperature,
-                dim=-1
-            ) + EPS
+        # Get the predicted parameters. The likelihood is evaluated in
+        # float32, also under mixed precision.
+        pi, mu, sigma = (
+            param.float() for param in self.forward_parameters(x)
         )
 
-        ll = torch.logsumexp(log_component_prob + log_mix_prob, dim=-1)
+        with torch.autocast(x.device.type, enabled=False):
+            log_component_prob = self.gaussian_log_likelihood(
+                y.float(), mu, sigma
+            )
+            log_mix_prob = torch.log(
+                F.gumbel_softmax(
+                    pi,
+                    tau=self.hparams.softmax_temperature,
+                    dim=-1
+                ) + EPS
+            )
+
+            ll = torch.logsumexp(log_component_prob + log_mix_prob, dim=-1)
+
         return -torch.mean(ll)
 
     @staticmethod
@@ -3,6 +3,8 @@ Internal utilities to construct neural networks.
 """
 
 import argparse
+import hashlib
+import os
 from typing import Optional, Iterable, List, Callable, Dict, Any, Tuple, Union
 
 import pytorch_lightning as pl
@@ -11,8 +13,10 @@ import torch.nn as nn
 from torch.utils.data import DataLoader
 import torch.nn.functional as F
 
+from ..logging import info
 from .quantiles import quantile_loss
 from .linear import ridge_regression
+from .training import OPTIMIZERS
 from ..utils.data import IVDataset, SupervisedLearningWrapper
 
 
@@ -46,6 +50,222 @@ def build_mlp(
     return layers
 
 
+def _batchnorm_affine(
+    bn: nn.BatchNorm1d
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Scale and shift equivalent to a BatchNorm layer in eval mode."""
+    assert bn.running_mean is not None and bn.running_var is not None
+    scale = torch.rsqrt(bn.running_var + bn.eps)
+    shift = -bn.running_mean * scale
+    if bn.weight is not None:
+        scale = scale * bn.weight
+        shift = shift * bn.weight + bn.bias
+
+    return scale, shift
+
+
+def fold_batchnorm(mlp: nn.Sequential) -> nn.Sequential:
+    """Returns an equivalent stack for inference without the BatchNorm layers.
+
+    The layers from build_mlp normalize after the activation, so the BatchNorm
+    affine transformation is folded into the following Linear layer (or into
+    the previous one if it directly precedes the BatchNorm). Layers that can't
+    be folded are kept as is. The result is only equivalent to the input in
+    eval mode.
+
+    """
+    layers: List[nn.Module] = []
+    pending: Optional[nn.BatchNorm1d] = None
+
+    with torch.no_grad():
+        for layer in mlp:
+            can_fold = (
+                isinstance(layer, nn.BatchNorm1d) and
+                layer.track_running_stats and
+                layer.running_mean is not None
+            )
+
+            if can_fold and layers and isinstance(layers[-1], nn.Linear):
+                scale, shift = _batchnorm_affine(layer)  # type: ignore
+                prev = layers[-1]
+                bias = (
+                    prev.bias if prev.bias is not None
+                    else torch.zeros(prev.out_features)
+                )
+                layers[-1] = _make_linear(
+                    prev.weight * scale.reshape(-1, 1), bias * scale + shift
+                )
+                continue
+
+            if pending is not None and isinstance(layer, nn.Linear):
+                scale, shift = _batchnorm_affine(pending)
+                bias = (
+                    layer.bias if layer.bias is not None
+                    else torch.zeros(layer.out_features)
+                )
+                layers.append(_make_linear(
+                    layer.weight * scale, bias + layer.weight @ shift
+                ))
+                pending = None
+                continue
+
+            if pending is not None:
+                layers.append(pending)
+                pending = None
+
+            if can_fold:
+                pending = layer  # type: ignore
+            else:
+                layers.append(layer)
+
+    if pending is not None:
+        layers.append(pending)
+
+    return nn.Sequential(*layers).eval()
+
+
+def _make_linear(weight: torch.Tensor, bias: torch.Tensor) -> nn.Linear:
+    linear = nn.Linear(weight.size(1), weight.size(0))
+    linear.weight = nn.Parameter(weight.detach().clone(), requires_grad=False)
+    linear.bias = nn.Parameter(bias.detach().clone(), requires_grad=False)
+    return linear
+
+
+def _file_digest(filename: str) -> str:
+    sha = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+
+def compile_mlp(
+    mlp: nn.Sequential,
+    cache_filename: Optional[str] = None,
+    checkpoint_filename: Optional[str] = None
+) -> nn.Module:
+    """Folds the BatchNorm layers and compiles the stack with TorchScript.
+
+    The compiled module is only meant for inference. If a cache filename is
+    given, the compiled module is saved there along with a digest of the
+    checkpoint it was derived from and the cache is reused as long as the
+    checkpoint doesn't change.
+
+    """
+    digest = (
+        _file_digest(checkpoint_filename)
+        if checkpoint_filename is not None and
+        os.path.isfile(checkpoint_filename)
+        else None
+    )
+
+    if cache_filename is not None and digest is not None and \
+            os.path.isfile(cache_filename):
+        extra_files = {"checkpoint_digest": ""}
+        try:
+            compiled = torch.jit.load(
+                cache_filename, map_location="cpu", _extra_files=extra_files
+            )
+        except RuntimeError:
+            # e.g. saved by a different version of torch.
+            compiled = None
+
+        cached_digest = extra_files["checkpoint_digest"]
+        if isinstance(cached_digest, bytes):
+            cached_digest = cached_digest.decode()
+
+        if compiled is not None and cached_digest == digest:
+            return compiled
+
+        info(f"Ignoring stale compiled network '{cache_filename}'.")
+
+    compiled = torch.jit.freeze(
+        torch.jit.script(fold_batchnorm(mlp).to("cpu"))
+    )
+
+    if cache_filename is not None and digest is not None:
+        try:
+            torch.jit.save(
+                compiled, cache_filename,
+                _extra_files={"checkpoint_digest": digest}
+            )
+        except OSError as e:
+            info(f"Could not cache compiled network: {e}.")
+
+    return compiled
+
+
+class Bfloat16Autocast(nn.Module):
+    """Evaluates a module with bfloat16 autocast and returns float32.
+
+    This is only meant for inference (see
+    MREstimator.enable_mixed_precision).
+
+    """
+    def __init__(self, module: nn.Module):
+        super().__init__()
+        self.module = module
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        with torch.autocast(x.device.type, dtype=torch.bfloat16):
+            return self.module(x).float()
+
+
+def split_sample_weights(
+    batch: Tuple[torch.Tensor, ...],
+    n_fields: int
+) -> Tuple[Tuple[torch.Tensor, ...], Optional[torch.Tensor]]:
+    """Separates the sample weights from the batch if they are present.
+
+    Weighted datasets (e.g. bootstrap samples) append the weights after
+    the usual fields.
+
+    """
+    if len(batch) == n_fields:
+        return tuple(batch), None
+
+    assert len(batch) == n_fields + 1
+    return tuple(batch[:n_fields]), batch[n_fields]
+
+
+def weighted_mean(
+    losses: torch.Tensor,
+    weights: Optional[torch.Tensor]
+) -> torch.Tensor:
+    """Averages unreduced losses using one weight per sample."""
+    if weights is None:
+        return losses.mean()
+
+    losses = losses.reshape(losses.size(0), -1).mean(dim=1)
+    weights = weights.reshape(-1).to(losses.dtype)
+    return (losses * weights).sum() / weights.sum()
+
+
+def weighted_loss(
+    loss: Callable[..., torch.Tensor],
+    weights: Optional[torch.Tensor],
+    *args
+) -> torch.Tensor:
+    """Evaluates the loss using sample weights if they are provided.
+
+    The loss function needs to support reduction="none" to be weighted.
+
+    """
+    # Losses are always evaluated in float32, also under mixed precision.
+    args = tuple(
+        arg.float()
+        if isinstance(arg, torch.Tensor) and arg.is_floating_point()
+        else arg
+        for arg in args
+    )
+    with torch.autocast(args[0].device.type, enabled=False):
+        if weights is None:
+            return loss(*args)
+
+        return weighted_mean(loss(*args, reduction="none"), weights)
+
+
 class DensityModel(pl.LightningModule):
     """Mixin for models that allow sampling.
 
@@ -146,10 +366,10 @@ class MLP(pl.LightningModule):
         batch_index,
         log_prefix: str = "train"
     ) -> torch.Tensor:
-        x, y = batch
+        (x, y), weights = split_sample_weights(batch, 2)
 
         y_hat = self.forward(x)
-        loss = self.loss(y_hat, y)
+        loss = weighted_loss(self.loss, weights, y_hat, y)
 
         self.log(f"{log_prefix}_loss", loss)
 
@@ -210,6 +430,7 @@ class MLP(pl.LightningModule):
         group.add_argument(
             f"--{prefix}optimizer",
             type=str,
+            choices=OPTIMIZERS,
             default=defaults.get("optimizer", "adam")
         )
 
@@ -285,10 +506,10 @@ class GaussianNet(MLP, DensityModel):
         batch_index,
         log_prefix: str = "train"
     ) -> torch.Tensor:
-        x, y = batch
+        (x, y), weights = split_sample_weights(batch, 2)
 
         mu, sigma2 = self.forward_parameters(x)
-        loss = self.loss(mu, y, sigma2)  # type: ignore
+        loss = weighted_loss(self.loss, weights, mu, y, sigma2)
 
         self.log(f"{log_prefix}_loss", loss)
 
@@ -307,8 +528,15 @@ class OutcomeMLPBase(MLP):
         sqr: bool = False,
         add_input_layer_batchnorm: bool = False,
         add_hidden_layer_batchnorm: bool = False,
-        activations: Iterable[nn.Module] = [nn.GELU()]
+        activations: Iterable[nn.Module] = [nn.GELU()],
+        n_outcomes: int = 1
     ):
+        """Outcome network of two-stage estimators.
+
+        With n_outcomes > 1, the hidden layers are shared by the outcomes and
+        the output layer has one unit (head) per outcome.
+
+        """
         if sqr:
             loss: Callable = quantile_loss
         elif binary_outcome:
@@ -319,7 +547,7 @@ class OutcomeMLPBase(MLP):
         super().__init__(
             input_size=input_size if not sqr else input_size + 1,
             hidden=hidden,
-            out=1,
+            out=n_outcomes,
             add_input_layer_batchnorm=add_input_layer_batchnorm,
             add_hidden_layer_batchnorm=add_hidden_layer_batchnorm,
             activations=activations,
@@ -332,7 +560,7 @@ class OutcomeMLPBase(MLP):
         self.save_hyperparameters(ignore=["exposure_network"])
 
     def _step(self, batch, batch_index, log_prefix):
-        _, y, ivs, covars = batch
+        (_, y, ivs, covars), weights = split_sample_weights(batch, 4)
 
         if self.hparams.sqr:
             taus = torch.rand(ivs.size(0), 1, device=self.device)
@@ -342,9 +570,9 @@ class OutcomeMLPBase(MLP):
         y_hat = self.forward(ivs, covars, taus)
 
         if self.hparams.sqr:
-            loss = self.loss(y_hat, y, taus)
+            loss = weighted_loss(self.loss, weights, y_hat, y, taus)
         else:
-            loss = self.loss(y_hat, y)
+            loss = weighted_loss(self.loss, weights, y_hat, y)
 
         self.log(f"outcome_{log_prefix}_loss", loss)
 
@@ -0,0 +1,194 @@
+"""
+Timing and throughput statistics of the fits.
+
+The report is saved in meta.json under the "perf" key so that bottlenecks
+can be found across many runs (e.g. sweeps) without profiling them again.
+"""
+
+import os
+import sys
+import threading
+import time
+import weakref
+from typing import Dict, Optional
+
+import pytorch_lightning as pl
+
+
+# Interval between two samples of the resident set size, in seconds.
+_RSS_SAMPLING_INTERVAL = 0.05
+
+
+def peak_rss_mb() -> Optional[float]:
+    """Peak resident set size of the current process in MB.
+
+    This is the peak over the lifetime of the process, so it includes the
+    previous fits of long running processes such as the sweep workers.
+
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        # Reported in bytes instead of kilobytes.
+        rss /= 1024
+
+    return rss / 1024
+
+
+def current_rss_mb() -> Optional[float]:
+    """Current resident set size of the process in MB (Linux only)."""
+    try:
+        with open("/proc/self/statm", "rt") as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+
+
+class RssSampler(object):
+    """Polls the resident set size in a background thread to find its peak.
+
+    Unlike peak_rss_mb, the peak only covers the time since the sampler was
+    started.
+
+    """
+    def __init__(self, interval: float = _RSS_SAMPLING_INTERVAL):
+        self.start_mb = current_rss_mb()
+        self.peak_mb = self.start_mb
+        self._stop = threading.Event()
+
+        if self.start_mb is not None:
+            threading.Thread(
+                target=self._run, args=(interval, ), daemon=True
+            ).start()
+
+    def _run(self, interval: float) -> None:
+        while not self._stop.wait(interval):
+            self.sample()
+
+    def sample(self) -> Optional[float]:
+        """Records the current RSS and returns the peak."""
+        rss = current_rss_mb()
+        if rss is not None and (self.peak_mb is None or rss > self.peak_mb):
+            self.peak_mb = rss
+
+        return self.peak_mb
+
+    def stop(self) -> None:
+        self._stop.set()
+
+
+class TrainingStats(object):
+    """Throughput of the training loop of one network.
+
+    The data wait is the time spent between the end of a training batch and
+    the start of the next one, which is mostly spent fetching the batch.
+
+    """
+    def __init__(self):
+        self.epochs = 0
+        self.samples = 0
+        self.seconds = 0.0
+        self.data_wait_seconds = 0.0
+
+    def to_dict(self) -> Dict[str, float]:
+        return {
+            "epochs": self.epochs,
+            "samples": self.samples,
+            "seconds": round(self.seconds, 3),
+            "samples_per_second": round(
+                self.samples / self.seconds if self.seconds > 0 else 0.0, 1
+            ),
+            "data_wait_seconds": round(self.data_wait_seconds, 3),
+        }
+
+
+class ThroughputCallback(pl.Callback):
+    """Collects TrainingStats when training with pytorch lightning."""
+    def __init__(self, stats: TrainingStats):
+        self.stats = stats
+        self._epoch_start = 0.0
+        self._batch_end = 0.0
+
+    def on_train_epoch_start(self, trainer, pl_module):
+        self._epoch_start = self._batch_end = time.perf_counter()
+
+    def on_train_batch_start(self, trainer, pl_module, batch, batch_idx):
+        self.stats.data_wait_seconds += time.perf_counter() - self._batch_end
+        self.stats.samples += batch[0].size(0)
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch,
+                           batch_idx):
+        self._batch_end = time.perf_counter()
+
+    def on_train_epoch_end(self, trainer, pl_module):
+        self.stats.epochs += 1
+        self.stats.seconds += time.perf_counter() - self._epoch_start
+
+
+class PerfReport(object):
+    """Wall time of the phases of a fit and training throughput.
+
+    Phases are sequential: begin ends the current phase and starts the next
+    one. The time of phases that are entered more than once is summed.
+
+    The peak memory is sampled from the creation of the report, so it is the
+    peak of this fit even if the process ran other fits before.
+
+    """
+    def __init__(self):
+        self.phases: Dict[str, float] = {}
+        self.training: Dict[str, TrainingStats] = {}
+        self._start = time.perf_counter()
+        self._current: Optional[str] = None
+        self._current_start = 0.0
+
+        self.rss = RssSampler()
+        weakref.finalize(self, self.rss.stop)
+
+    def begin(self, name: str) -> None:
+        self.end()
+        self._current = name
+        self._current_start = time.perf_counter()
+
+    def end(self) -> None:
+        if self._current is not None:
+            self.phases[self._current] = (
+                self.phases.get(self._current, 0.0) +
+                time.perf_counter() - self._current_start
+            )
+            self._current = None
+
+    def training_stats(self, name: str) -> TrainingStats:
+        """Returns the statistics for the training of a network."""
+        if name not in self.training:
+            self.training[name] = TrainingStats()
+
+        return self.training[name]
+
+    def to_dict(self) -> dict:
+        """Ends the current phase and returns the report for meta.json."""
+        self.end()
+        return {
+            "seconds": round(time.perf_counter() - self._start, 3),
+            "phases": {
+                name: round(seconds, 3)
+                for name, seconds in self.phases.items()
+            },
+            "training": {
+                name: stats.to_dict()
+                for name, stats in self.training.items()
+            },
+            "start_rss_mb": _round(self.rss.start_mb),
+            "peak_rss_mb": _round(self.rss.sample()),
+            "process_peak_rss_mb": _round(peak_rss_mb()),
+        }
+
+
+def _round(value: Optional[float]) -> Optional[float]:
+    return None if value is None else round(value, 1)
@@ -7,13 +7,20 @@ simultaneous quantile regression (see Tagasovska & Lopez-Paz NeurIPS 2019).
 """
 
 
+from typing import Tuple
+
+import numpy as np
 import torch
 
 
+QUADRATURE_METHODS = ("midpoint", "gauss-legendre", "rqmc")
+
+
 def quantile_loss(
     input: torch.Tensor,
     target: torch.Tensor,
-    tau: torch.Tensor
+    tau: torch.Tensor,
+    reduction: str = "mean"
 ) -> torch.Tensor:
     """Implementation of the quantile loss.
 
@@ -22,7 +29,16 @@ def quantile_loss(
     """
     diff = target - input
     mask = (diff.ge(0).float() - tau).detach()
-    return (mask * diff).mean()
+    loss = mask * diff
+
+    if reduction == "mean":
+        return loss.mean()
+    elif reduction == "sum":
+        return loss.sum()
+    elif reduction == "none":
+        return loss
+    else:
+        raise ValueError(f"Unknown reduction: '{reduction}'.")
 
 
 class QuantileLossMulti(object):
@@ -48,3 +64,70 @@ class QuantileLossMulti(object):
             return loss
         else:
             raise ValueError("Unknown reduction: '{reduction}'.")
+
+
+def quadrature(
+    method: str,
+    n_nodes: int,
+    seed: int = 0
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Nodes and weights to integrate a function of the quantile level.
+
+    The integral over (0, 1) is approximated by the sum of the weights times
+    the function at the nodes. The methods are:
+
+    - midpoint: the (2k - 1) / (2n) grid with equal weights.
+    - gauss-legendre: Gauss-Legendre nodes mapped to (0, 1).
+    - rqmc: scrambled Sobol points with equal weights (randomized quasi
+      Monte Carlo). The seed sets the scrambling and powers of two are the
+      best numbers of nodes.
+
+    """
+    if n_nodes < 1:
+        raise ValueError("Need at least one quadrature node.")
+
+    if method == "midpoint":
+        nodes = (2 * torch.arange(1, n_nodes + 1) - 1) / (2 * n_nodes)
+        weights = torch.full((n_nodes, ), 1 / n_nodes)
+
+    elif method == "gauss-legendre":
+        x, w = np.polynomial.legendre.leggauss(n_nodes)
+        nodes = torch.from_numpy((x + 1) / 2)
+        weights = torch.from_numpy(w / 2)
+
+    elif method == "rqmc":
+        engine = torch.quasirandom.SobolEngine(1, scramble=True, seed=seed)
+        nodes = torch.sort(engine.draw(n_nodes).reshape(-1)).values
+        weights = torch.full((n_nodes, ), 1 / n_nodes)
+
+    else:
+        raise ValueError(
+            f"Unknown quadrature '{method}'. Available methods: "
+            f"{', '.join(QUADRATURE_METHODS)}."
+        )
+
+    return nodes.to(torch.float32), weights.to(torch.float32)
+
+
+def integrated_quantile_loss(
+    input: torch.Tensor,
+    target: torch.Tensor,
+    taus: torch.Tensor,
+    tau_weights: torch.Tensor,
+    reduction: str = "mean"
+) -> torch.Tensor:
+    """Quantile loss of (n, n_taus) predictions integrated over the levels.
+
+    The losses at every level are combined using the quadrature weights.
+
+    """
+    loss = quantile_loss(input, target, taus, reduction="none") @ tau_weights
+
+    if reduction == "mean":
+        return loss.mean()
+    elif reduction == "sum":
+        return loss.sum()
+    elif reduction == "none":
+        return loss
+    else:
+        raise ValueError(f"Unknown reduction: '{reduction}'.")
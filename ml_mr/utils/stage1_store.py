@@ -0,0 +1,226 @@
+"""
+Store of trained first stage (exposure) models that are shared between fits.
+
+Fits of two-stage estimators that only differ in their second stage (e.g.
+sweeps over the outcome network hyperparameters) would otherwise train the
+same exposure model every time. The store keeps the exposure checkpoints
+under a key computed from the rows used to train the first stage, the seed of
+the train / validation split and the exposure hyperparameters.
+
+The store is a directory that can be shared by concurrent processes. It is
+set using the --stage1-store argument or the ML_MR_STAGE1_STORE environment
+variable.
+"""
+
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from typing import (Any, Callable, Dict, Iterator, List, Optional, Tuple,
+                    TypeVar)
+
+import torch
+from torch.utils.data import Dataset
+
+from ..logging import info
+from .data import fetch_batch
+
+
+STAGE1_STORE_ENV_VAR = "ML_MR_STAGE1_STORE"
+
+# Number of rows hashed at a time.
+_HASH_BLOCK_SIZE = 100_000
+
+T = TypeVar("T")
+
+
+def _hash_stage1_rows(h: "hashlib._Hash", dataset: Dataset) -> None:
+    """Hashes the exposure, instruments, covariables and sample weights.
+
+    The outcome is not used by the first stage so it is left out of the hash.
+
+    """
+    n = len(dataset)  # type: ignore
+    h.update(f"n={n};".encode("utf-8"))
+    for start in range(0, n, _HASH_BLOCK_SIZE):
+        x, _, ivs, covars, *weights = fetch_batch(
+            dataset, torch.arange(start, min(start + _HASH_BLOCK_SIZE, n))
+        )
+        for tens in (x, ivs, covars, *weights):
+            tens = tens.to(torch.float32).contiguous()
+            h.update(str(tuple(tens.shape)).encode("utf-8"))
+            h.update(tens.numpy().tobytes())
+
+
+def stage1_key(
+    train_dataset: Dataset,
+    val_dataset: Dataset,
+    split_seed: Optional[int],
+    hyperparameters: Dict[str, Any]
+) -> str:
+    """Computes the key of a first stage model.
+
+    The rows are hashed in the order of the split, so the key changes if the
+    split or the rows change. The hyperparameters need to be JSON
+    serializable.
+
+    """
+    h = hashlib.blake2b(digest_size=20)
+    h.update(json.dumps(
+        {"split_seed": split_seed, "hyperparameters": hyperparameters},
+        sort_keys=True
+    ).encode("utf-8"))
+
+    for dataset in (train_dataset, val_dataset):
+        _hash_stage1_rows(h, dataset)
+
+    return h.hexdigest()
+
+
+class Stage1Store(object):
+    """Directory of exposure model checkpoints indexed by stage1_key."""
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+
+    @classmethod
+    def from_option(cls, root: Optional[str]) -> Optional["Stage1Store"]:
+        """Opens the store if it is configured (see STAGE1_STORE_ENV_VAR)."""
+        if root is None:
+            root = os.environ.get(STAGE1_STORE_ENV_VAR)
+
+        if not root:
+            return None
+
+        return cls(root)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    @contextlib.contextmanager
+    def lock(self, key: str) -> Iterator[None]:
+        """Holds an exclusive lock on an entry.
+
+        Processes that need the same first stage wait for the one training it
+        instead of training it again. Locking is only available on POSIX
+        systems.
+
+        """
+        os.makedirs(self.root, exist_ok=True)
+        try:
+            import fcntl
+        except ImportError:
+            yield
+            return
+
+        with open(os.path.join(self.root, f".{key}.lock"), "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def fetch(self, key: str, output_dir: str) -> Optional[dict]:
+        """Copies the files of an entry to output_dir.
+
+        Returns the metadata of the entry or None if it is not in the store.
+
+        """
+        path = self._path(key)
+        try:
+            with open(os.path.join(path, "meta.json"), "rt") as f:
+                meta = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        for filename in meta["files"]:
+            shutil.copyfile(
+                os.path.join(path, filename),
+                os.path.join(output_dir, filename)
+            )
+
+        info(f"Reusing the first stage model from '{path}'.")
+        return meta
+
+    def save(
+        self,
+        key: str,
+        output_dir: str,
+        filenames: List[str],
+        meta: Dict[str, Any]
+    ) -> None:
+        """Adds the files of a trained first stage from output_dir."""
+        os.makedirs(self.root, exist_ok=True)
+
+        # The entry is written to a temporary directory and renamed so that
+        # other processes never see a partial entry.
+        tmp_path = tempfile.mkdtemp(dir=self.root, prefix=".tmp_")
+        try:
+            for filename in filenames:
+                shutil.copyfile(
+                    os.path.join(output_dir, filename),
+                    os.path.join(tmp_path, filename)
+                )
+
+            with open(os.path.join(tmp_path, "meta.json"), "wt") as f:
+                json.dump({**meta, "files": filenames}, f)
+
+            try:
+                os.rename(tmp_path, self._path(key))
+            except OSError:
+                # Another process added the entry concurrently.
+                shutil.rmtree(tmp_path, ignore_errors=True)
+
+        except Exception:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+
+
+def fetch_or_train(
+    store: Optional[Stage1Store],
+    key: Optional[str],
+    output_dir: str,
+    filenames: List[str],
+    train: Callable[[], Tuple[T, Optional[float]]],
+    load: Callable[[], T]
+) -> Tuple[T, Optional[float]]:
+    """Gets the first stage model from the store or trains it.
+
+    The train function returns the model and its validation loss and saves
+    the given files in output_dir. They are added to the store so that the
+    next fits can copy them and use load instead of training.
+
+    """
+    if store is None or key is None:
+        return train()
+
+    with store.lock(key):
+        meta = store.fetch(key, output_dir)
+        if meta is not None:
+            return load(), meta["exposure_val_loss"]
+
+        model, val_loss = train()
+        store.save(key, output_dir, filenames, {"exposure_val_loss": val_loss})
+
+    return model, val_loss
+
+
+def add_stage1_store_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--stage1-store",
+        default=None,
+        type=str,
+        help="Directory where trained exposure models are stored and reused "
+        "by fits with the same first stage data, split and hyperparameters. "
+        f"Defaults to the {STAGE1_STORE_ENV_VAR} environment variable if "
+        "set. Use with --split-seed, otherwise the splits differ.",
+    )
+
+    parser.add_argument(
+        "--split-seed",
+        default=None,
+        type=int,
+        help="Seed of the random train and validation split.",
+    )
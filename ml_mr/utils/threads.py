@@ -0,0 +1,164 @@
+"""
+Control over the number of CPU threads used by torch and the BLAS / OpenMP
+libraries.
+
+By default, every process lets torch use all the cores for intra-op
+parallelism. When several fits run in parallel (e.g. the sweep workers),
+this oversubscribes the machine, so we split the cores between them.
+"""
+
+import argparse
+import contextlib
+import os
+from typing import Iterator, List, Optional, Sequence
+
+import torch
+
+from ..logging import info, warn
+
+
+THREAD_ENV_VARS = (
+    "OMP_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+)
+
+
+def available_cpus() -> List[int]:
+    """Returns the CPUs the current process is allowed to run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+
+    return list(range(os.cpu_count() or 1))
+
+
+def parse_cpu_list(s: str) -> List[int]:
+    """Parses a list of CPUs such as "0-3,8,10-11"."""
+    cpus = []
+    for part in s.split(","):
+        part = part.strip()
+        if not part:
+            continue
+
+        if "-" in part:
+            start, stop = part.split("-")
+            cpus.extend(range(int(start), int(stop) + 1))
+        else:
+            cpus.append(int(part))
+
+    if not cpus:
+        raise ValueError(f"Empty CPU list '{s}'.")
+
+    return sorted(set(cpus))
+
+
+def default_threads_per_worker(
+    n_workers: int,
+    n_cpus: Optional[int] = None
+) -> int:
+    """Splits the available CPUs evenly between the workers."""
+    if n_cpus is None:
+        n_cpus = len(available_cpus())
+
+    return max(n_cpus // max(n_workers, 1), 1)
+
+
+def worker_cpus(
+    cpus: Sequence[int],
+    worker_index: int,
+    n_threads: int
+) -> List[int]:
+    """Returns the block of CPUs to pin a worker to.
+
+    The blocks wrap around if there are more threads than CPUs in total.
+
+    """
+    start = worker_index * n_threads
+    return sorted({cpus[(start + i) % len(cpus)] for i in range(n_threads)})
+
+
+def thread_env_vars(n_threads: int) -> dict:
+    return {var: str(n_threads) for var in THREAD_ENV_VARS}
+
+
+@contextlib.contextmanager
+def thread_environment(n_threads: int) -> Iterator[None]:
+    """Temporarily sets the thread count environment variables.
+
+    The native libraries read these variables when they are loaded, so this
+    is used around the creation of child processes.
+
+    """
+    previous = {var: os.environ.get(var) for var in THREAD_ENV_VARS}
+    os.environ.update(thread_env_vars(n_threads))
+    try:
+        yield
+    finally:
+        for var, value in previous.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+
+def set_thread_budget(
+    n_threads: int,
+    cpus: Optional[Sequence[int]] = None
+) -> None:
+    """Limits the current process to n_threads threads.
+
+    This sets the torch intra-op and inter-op thread counts and the
+    environment variables for the libraries loaded later. If cpus is given,
+    the process is also pinned to these CPUs.
+
+    """
+    if n_threads < 1:
+        raise ValueError("The number of threads should be at least 1.")
+
+    os.environ.update(thread_env_vars(n_threads))
+    torch.set_num_threads(n_threads)
+
+    try:
+        torch.set_num_interop_threads(n_threads)
+    except RuntimeError:
+        # It can only be set once, before any inter-op parallel work.
+        pass
+
+    if cpus is not None:
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cpus)
+        else:
+            warn("CPU affinity is not supported on this platform.")
+
+
+def add_thread_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=None,
+        help="Number of CPU threads used by torch and the numerical "
+             "libraries. Defaults to the length of --cpu-list or to all "
+             "the cores."
+    )
+
+    parser.add_argument(
+        "--cpu-list",
+        type=parse_cpu_list,
+        default=None,
+        help="Pin the process to these CPUs (e.g. '0-3,8').",
+    )
+
+
+def apply_thread_arguments(args: argparse.Namespace) -> None:
+    """Applies the thread budget from add_thread_arguments, if any."""
+    n_threads = args.threads
+    if n_threads is None and args.cpu_list is not None:
+        n_threads = len(args.cpu_list)
+
+    if n_threads is None:
+        return
+
+    info(f"Using {n_threads} CPU threads.")
+    set_thread_budget(n_threads, args.cpu_list)
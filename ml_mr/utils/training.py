@@ -2,51 +2,294 @@
 Utilities to simplify fitting neural networks.
 """
 
+import argparse
+import contextlib
+import math
 import os
-from typing import Union, Optional, Iterable
+import time
+from typing import (Dict, Union, Optional, Iterable, List, Sequence,
+                    Tuple, Type)
 
 import torch
 import torch.nn as nn
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 import pytorch_lightning as pl
 from pytorch_lightning.loggers import Logger
 from ..logging import info
 from . import parse_project_and_run_name
-from .data import Dataset, FullBatchDataLoader
+from .perf import ThroughputCallback, TrainingStats
+from .data import (Dataset, FullBatchDataLoader, BatchedDataLoader,
+                   SampleWeightedDataset, TensorBatchLoader, dataset_tensors)
 
 
-def resample_dataset(dataset: Dataset) -> Dataset:
+RESAMPLE_MODES = ("rows", "multinomial", "poisson")
+
+TRAINING_ENGINES = ("lightning", "native")
+
+OPTIMIZERS = ("adam", "lbfgs", "adam_lbfgs")
+
+# Every L-BFGS step runs many iterations over the full training set, so it
+# needs far fewer steps than adam needs epochs.
+LBFGS_MAX_STEPS = 50
+
+PRECISIONS = ("32", "bf16")
+
+# Defaults set from the command line (see apply_training_arguments). The
+# ML_MR_TRAINING_ENGINE and ML_MR_PRECISION environment variables are only
+# used when these are not set.
+_training_defaults: Dict[str, Optional[str]] = {
+    "engine": None,
+    "precision": None,
+}
+
+
+def bf16_supported(device: torch.device) -> bool:
+    """Checks if bfloat16 matmuls are fast on the device (e.g. AVX512-BF16 or
+    AMX on CPU)."""
+    if device.type == "cuda":
+        return torch.cuda.is_bf16_supported()
+
+    if device.type == "cpu":
+        return (
+            torch.backends.mkldnn.is_available() and
+            torch.ops.mkldnn._is_mkldnn_bf16_supported()
+        )
+
+    return False
+
+
+def resolve_precision(
+    precision: Optional[str] = None,
+    accelerator: Optional[str] = None
+) -> str:
+    """Returns "32" or "bf16" for the requested precision.
+
+    The precision defaults to the --precision command line option, then to
+    the ML_MR_PRECISION environment variable or "32". We fall back to
+    float32 if the device doesn't support bfloat16.
+
+    """
+    if precision is None:
+        precision = _training_defaults["precision"] or \
+            os.environ.get("ML_MR_PRECISION", "32")
+
+    if precision not in PRECISIONS:
+        raise ValueError(
+            f"Unknown precision '{precision}'. Use one of {PRECISIONS}."
+        )
+
+    if precision == "bf16" and not bf16_supported(_native_device(accelerator)):
+        info("The device doesn't support bfloat16, using float32.")
+        return "32"
+
+    return precision
+
+
+def autocast(precision: str, device: torch.device):
+    """Context manager for bfloat16 autocast if precision is "bf16"."""
+    if precision == "bf16":
+        return torch.autocast(device.type, dtype=torch.bfloat16)
+
+    return contextlib.nullcontext()
+
+
+class ResampledDataset(Subset):
+    """Bootstrap sample represented as indices into the original dataset."""
+    def __getattr__(self, k):
+        # Defer to dataset if unknown method, only change the behaviour of
+        # indexing.
+        if k in ("dataset", "indices"):
+            raise AttributeError(k)
+
+        return getattr(self.dataset, k)
+
+    def to_dataframe(self):
+        return self.dataset.to_dataframe(indices=self.indices)
+
+
+def split_generator(seed: Optional[int]) -> Optional[torch.Generator]:
+    """Random generator for random_split, None uses the global generator."""
+    if seed is None:
+        return None
+
+    return torch.Generator().manual_seed(seed)
+
+
+def resample_dataset(dataset: Dataset, mode: str = "rows") -> Dataset:
+    """Draws a bootstrap sample of the dataset.
+
+    The "rows" mode uses the drawn rows (with duplicates) as a view of the
+    dataset. The "multinomial" mode draws the same kind of sample, but
+    represents it as a weight on every distinct row and the "poisson" mode
+    draws every row's weight independently from a Poisson distribution.
+    The weighted modes avoid duplicating rows in every batch and the
+    weights are used in the losses.
+
+    """
+    if mode not in RESAMPLE_MODES:
+        raise ValueError(
+            f"Unknown resample mode '{mode}'. Use one of {RESAMPLE_MODES}."
+        )
+
     n = len(dataset)  # type: ignore
+    weights = _sampling_weights(dataset)
 
-    if getattr(dataset, "sampling_weights") is None:
-        weights = torch.ones(n)
+    if mode == "poisson":
+        rate = n * weights / weights.sum()
+        counts = torch.poisson(rate.to(torch.float64)).to(torch.float32)
     else:
-        info("Using attached sampling weights.")
-        weights = dataset.sampling_weights
+        bootstrap_idx = torch.multinomial(weights, n, replacement=True)
+        if mode == "rows":
+            return ResampledDataset(dataset, bootstrap_idx)  # type: ignore
+
+        counts = torch.bincount(bootstrap_idx, minlength=n).to(torch.float32)
 
-    bootstrap_idx = torch.multinomial(
-        weights, n, replacement=True
-    ).tolist()
+    idx = torch.nonzero(counts).reshape(-1)
+    return SampleWeightedDataset(dataset, idx, counts[idx])
 
-    class ResampledDataset(Dataset):
-        def __getattr__(self, k):
-            # Defer to dataset if unknown method, only change the behaviour of
-            # indexing.
-            return getattr(dataset, k)
 
-        def to_dataframe(self):
-            df, cols = dataset.to_dataframe()
-            df = df.iloc[bootstrap_idx, :].reset_index(drop=True)
-            return df, cols
+def resample_replicates(
+    dataset: Dataset,
+    n_replicates: int,
+    mode: str = "poisson"
+) -> SampleWeightedDataset:
+    """Draws the weights of many bootstrap samples of the dataset at once.
+
+    The weights are a matrix with one column per replicate (see
+    resample_dataset for the "multinomial" and "poisson" modes). Rows that
+    are not drawn in any replicate are left out.
+
+    """
+    if mode not in ("multinomial", "poisson"):
+        raise ValueError(
+            f"Bootstrap replicates use weights, the resample mode must be "
+            f"'multinomial' or 'poisson' (got '{mode}')."
+        )
+
+    n = len(dataset)  # type: ignore
+    weights = _sampling_weights(dataset)
+
+    if mode == "poisson":
+        rate = (n * weights / weights.sum()).reshape(-1, 1)
+        counts = torch.poisson(
+            rate.to(torch.float64).expand(n, n_replicates)
+        ).to(torch.float32)
+    else:
+        bootstrap_idx = torch.multinomial(
+            weights.expand(n_replicates, n), n, replacement=True
+        )
+        counts = torch.zeros(n_replicates, n).scatter_add_(
+            1, bootstrap_idx, torch.ones(n_replicates, n)
+        ).T
+
+    idx = torch.nonzero(counts.sum(dim=1)).reshape(-1)
+    return SampleWeightedDataset(dataset, idx, counts[idx])
+
+
+def _sampling_weights(dataset: Dataset) -> torch.Tensor:
+    if getattr(dataset, "sampling_weights", None) is None:
+        return torch.ones(len(dataset))  # type: ignore
+
+    info("Using attached sampling weights.")
+    return dataset.sampling_weights.reshape(-1)  # type: ignore
+
+
+def load_checkpoint(
+    model_class: Type[pl.LightningModule],
+    filename: str,
+    **kwargs
+) -> pl.LightningModule:
+    """Loads a model from a checkpoint on the CPU.
+
+    The hyperparameters in the checkpoints hold objects such as activation
+    modules, so they are unpickled with weights_only=False. Only load
+    checkpoints from a trusted source. The keyword arguments are passed to
+    load_from_checkpoint.
+
+    """
+    return model_class.load_from_checkpoint(  # type: ignore
+        filename, map_location=torch.device("cpu"), weights_only=False,
+        **kwargs
+    )
+
+
+def load_compatible_weights(
+    model: nn.Module,
+    filename: str,
+    ignore_prefixes: Tuple[str, ...] = ()
+) -> int:
+    """Initializes a model with the weights of a previously saved checkpoint.
+
+    Only the tensors with the same name and shape as in the model are loaded,
+    the other ones keep their current values. Names starting with one of the
+    ignored prefixes are never loaded (e.g. the frozen exposure network of an
+    outcome model).
+
+    Returns the number of loaded tensors.
+
+    """
+    checkpoint = torch.load(
+        filename, map_location=torch.device("cpu"), weights_only=False
+    )
+    state_dict = checkpoint.get("state_dict", checkpoint)
+
+    own_state = {
+        k: v for k, v in model.state_dict().items()
+        if not k.startswith(ignore_prefixes)
+    }
+    compatible = {
+        k: v for k, v in state_dict.items()
+        if k in own_state and v.shape == own_state[k].shape
+    }
+
+    skipped = sorted(set(own_state.keys()) - set(compatible.keys()))
+    if skipped:
+        info(f"Weights not initialized from '{filename}': {skipped}.")
+
+    model.load_state_dict(compatible, strict=False)
+    return len(compatible)
+
+
+def add_init_from_arguments(parser) -> None:
+    parser.add_argument(
+        "--init-from",
+        default=None,
+        type=str,
+        help="Directory of a previous fit of the same estimator. Its network "
+        "weights are used as the starting point when the shapes match.",
+    )
+
+    parser.add_argument(
+        "--init-freeze-stage1",
+        action="store_true",
+        help="Reuse the first stage model from --init-from without training "
+        "it.",
+    )
+
+
+def add_training_arguments(parser) -> None:
+    parser.add_argument(
+        "--training-engine",
+        default=None,
+        choices=TRAINING_ENGINES,
+        help="Train the networks with pytorch lightning or with a plain "
+        "torch loop. Defaults to the ML_MR_TRAINING_ENGINE environment "
+        "variable or 'lightning'.",
+    )
 
-        def __len__(self):
-            return n
+    parser.add_argument(
+        "--precision",
+        default=None,
+        choices=PRECISIONS,
+        help="Use 'bf16' to autocast the forward passes to bfloat16. "
+        "Defaults to the ML_MR_PRECISION environment variable or '32'.",
+    )
 
-        def __getitem__(self, idx):
-            bs_idx = bootstrap_idx[idx]
-            return dataset[bs_idx]
 
-    return ResampledDataset()
+def apply_training_arguments(args: argparse.Namespace) -> None:
+    """Uses the options from add_training_arguments in train_model."""
+    _training_defaults["engine"] = args.training_engine
+    _training_defaults["precision"] = args.precision
 
 
 def train_model(
@@ -61,32 +304,129 @@ def train_model(
     accelerator: Optional[str] = None,
     wandb_project: Optional[str] = None,
     early_stopping_patience: int = 20,
-    use_full_batch_validation: bool = True
+    use_full_batch_validation: bool = True,
+    engine: Optional[str] = None,
+    optimizer: str = "adam",
+    precision: Optional[str] = None,
+    stats: Optional[TrainingStats] = None,
+    default_root_dir: Optional[str] = None,
+    lbfgs_max_steps: int = LBFGS_MAX_STEPS
 ) -> float:
-    if not checkpoint_filename.endswith(".ckpt"):
-        checkpoint_filename += ".ckpt"
+    """Fits the model and returns the best value of the monitored metric.
 
-    train_dataloader = DataLoader(
-        train_dataset,
-        batch_size=batch_size,
-        shuffle=True,
-        num_workers=0,
-    )
+    The engine is either "lightning" (pl.Trainer) or "native" (a plain torch
+    loop with the same early stopping and checkpointing behaviour, see
+    fit_native). It defaults to the --training-engine command line option,
+    then to the ML_MR_TRAINING_ENGINE environment variable or "lightning".
 
-    if use_full_batch_validation:
-        val_dataloader = FullBatchDataLoader(val_dataset)
-    else:
-        val_dataloader = DataLoader(
-            val_dataset, batch_size=len(val_dataset),  # type: ignore
-            num_workers=0
+    The weights of the best epoch are kept in memory during training. At the
+    end, they are loaded into the model, which can be used directly, and
+    they are written to the checkpoint file once.
+
+    The optimizer is "adam" (the model's configure_optimizers), "lbfgs" for
+    full-batch L-BFGS (see fit_lbfgs) or "adam_lbfgs" to polish the
+    solution found with adam using L-BFGS. L-BFGS runs at most
+    lbfgs_max_steps steps instead of max_epochs, with the same early stopping
+    patience.
+
+    With precision="bf16", the forward passes of adam training and validation
+    are autocast to bfloat16 while the losses stay in float32. It defaults to
+    the ML_MR_PRECISION environment variable (see resolve_precision). L-BFGS
+    always uses float32 because of its line search.
+
+    If stats is given, the number of epochs, the throughput and the time
+    spent waiting for batches are added to it.
+
+    The pytorch lightning logs are written to default_root_dir (the current
+    directory by default).
+
+    """
+    if stats is None:
+        stats = TrainingStats()
+
+    if engine is None:
+        engine = _training_defaults["engine"] or \
+            os.environ.get("ML_MR_TRAINING_ENGINE", "lightning")
+
+    if engine not in TRAINING_ENGINES:
+        raise ValueError(
+            f"Unknown training engine '{engine}'. Use one of "
+            f"{TRAINING_ENGINES}."
+        )
+
+    if optimizer not in OPTIMIZERS:
+        raise ValueError(
+            f"Unknown optimizer '{optimizer}'. Use one of {OPTIMIZERS}."
         )
 
+    precision = resolve_precision(precision, accelerator)
+
+    if not checkpoint_filename.endswith(".ckpt"):
+        checkpoint_filename += ".ckpt"
+
     # Remove checkpoint if exists.
     full_filename = os.path.join(output_dir, checkpoint_filename)
     if os.path.isfile(full_filename):
         info(f"Removing file '{full_filename}'.")
         os.remove(full_filename)
 
+    use_lbfgs = optimizer in ("lbfgs", "adam_lbfgs")
+    if use_lbfgs and not getattr(model, "automatic_optimization", True):
+        info("Models with manual optimization can't be trained with L-BFGS.")
+        use_lbfgs = False
+
+    if use_lbfgs and wandb_project is not None:
+        info("L-BFGS doesn't support wandb logging, using adam.")
+        use_lbfgs = False
+
+    lbfgs_kwargs = dict(
+        model=model,
+        train_dataset=train_dataset,
+        val_dataset=val_dataset,
+        monitored_metric=monitored_metric,
+        checkpoint_path=full_filename,
+        max_steps=lbfgs_max_steps,
+        accelerator=accelerator,
+        early_stopping_patience=early_stopping_patience,
+        stats=stats
+    )
+
+    if use_lbfgs and optimizer == "lbfgs":
+        return fit_lbfgs(**lbfgs_kwargs)  # type: ignore
+
+    train_dataloader, val_dataloader = _make_dataloaders(
+        train_dataset,
+        val_dataset,
+        batch_size=batch_size,
+        accelerator=accelerator,
+        use_full_batch_validation=use_full_batch_validation
+    )
+
+    if engine == "native":
+        if not getattr(model, "automatic_optimization", True):
+            info("Models with manual optimization are trained using "
+                 "pytorch lightning.")
+        elif wandb_project is not None:
+            info("The native training engine doesn't support wandb logging, "
+                 "using pytorch lightning.")
+        else:
+            score = fit_native(
+                model,  # type: ignore
+                train_dataloader,
+                val_dataloader,
+                monitored_metric=monitored_metric,
+                checkpoint_path=full_filename,
+                max_epochs=max_epochs,
+                accelerator=accelerator,
+                early_stopping_patience=early_stopping_patience,
+                precision=precision,
+                stats=stats
+            )
+            if use_lbfgs:
+                return fit_lbfgs(**lbfgs_kwargs)  # type: ignore
+
+            return score
+
     logger: Union[bool, Iterable[Logger]] = True
     if wandb_project is not None:
         from pytorch_lightning.loggers.wandb import WandbLogger
@@ -95,15 +435,7 @@ def train_model(
             WandbLogger(name=run_name, project=project)
         ]
 
-    # .ckpt added by pl, so we remove it.
-    checkpoint_filename = checkpoint_filename[:-5]
-
-    model_checkpoint = pl.callbacks.ModelCheckpoint(
-        filename=checkpoint_filename,
-        dirpath=output_dir,
-        save_top_k=1,
-        monitor=monitored_metric,
-    )
+    best_state = BestStateCallback(monitored_metric)
 
     trainer = pl.Trainer(
         log_every_n_steps=1,
@@ -113,14 +445,715 @@ def train_model(
             pl.callbacks.EarlyStopping(
                 monitor=monitored_metric, patience=early_stopping_patience
             ),
-            model_checkpoint,
+            best_state,
+            ThroughputCallback(stats),
         ],
         logger=logger,
-        enable_progress_bar=os.environ.get("ML_MR_QUIET", "0") != "1"
+        precision="bf16-mixed" if precision == "bf16" else "32-true",
+        enable_checkpointing=False,
+        enable_progress_bar=os.environ.get("ML_MR_QUIET", "0") != "1",
+        default_root_dir=default_root_dir
     )
     trainer.fit(model, train_dataloader, val_dataloader)  # type: ignore
 
     # Return the best score on the tracked metric.
-    score = model_checkpoint.best_model_score
-    assert isinstance(score, torch.Tensor)
-    return score.item()
+    score = best_state.restore(model, full_filename)  # type: ignore
+    if use_lbfgs:
+        return fit_lbfgs(**lbfgs_kwargs)  # type: ignore
+
+    return score
+
+
+class BestStateCallback(pl.Callback):
+    """Keeps a copy of the weights from the epoch with the best metric.
+
+    This replaces the ModelCheckpoint callback to avoid writing a checkpoint
+    every time the metric improves. Use restore at the end of training to
+    load the best weights and save them.
+
+    """
+    def __init__(self, monitor: str):
+        super().__init__()
+        self.monitor = monitor
+        self.best_score: Optional[float] = None
+        self.best_state: Optional[Dict[str, torch.Tensor]] = None
+        self.best_epoch = 0
+        self.best_global_step = 0
+
+    def update(
+        self,
+        model: nn.Module,
+        score: float,
+        epoch: int,
+        global_step: int
+    ) -> bool:
+        """Records the weights if the score improved and returns if it did."""
+        if not math.isfinite(score):
+            return False
+
+        if self.best_score is not None and score >= self.best_score:
+            return False
+
+        self.best_score = score
+        self.best_state = {
+            k: v.detach().clone() for k, v in model.state_dict().items()
+        }
+        self.best_epoch = epoch
+        self.best_global_step = global_step
+        return True
+
+    def on_validation_end(self, trainer, pl_module):
+        if trainer.sanity_checking:
+            return
+
+        score = trainer.callback_metrics.get(self.monitor)
+        if score is None:
+            return
+
+        self.update(
+            pl_module, float(score), trainer.current_epoch,
+            trainer.global_step
+        )
+
+    def restore(
+        self,
+        model: pl.LightningModule,
+        checkpoint_filename: Optional[str] = None
+    ) -> float:
+        """Loads the best weights into the model and saves the checkpoint.
+
+        Returns the best score.
+
+        """
+        if self.best_state is None or self.best_score is None:
+            raise RuntimeError(f"No finite value of '{self.monitor}'.")
+
+        model.load_state_dict(self.best_state)
+        if checkpoint_filename is not None:
+            save_lightning_checkpoint(
+                model, checkpoint_filename, self.best_epoch,
+                self.best_global_step
+            )
+
+        return self.best_score
+
+
+def _make_dataloaders(
+    train_dataset: Dataset,
+    val_dataset: Dataset,
+    batch_size: int,
+    accelerator: Optional[str] = None,
+    use_full_batch_validation: bool = True
+) -> Tuple[Iterable, Iterable]:
+    train_dataloader: Iterable
+    val_dataloader: Iterable
+    if (
+        dataset_tensors(train_dataset) is not None and
+        dataset_tensors(val_dataset) is not None
+    ):
+        # Everything is in memory, so we iterate directly over the tensors.
+        pin_memory = accelerator not in (None, "cpu")
+        train_dataloader = TensorBatchLoader(
+            train_dataset,
+            batch_size=batch_size,
+            shuffle=True,
+            pin_memory=pin_memory
+        )
+        val_dataloader = TensorBatchLoader(
+            val_dataset,
+            batch_size=len(val_dataset),  # type: ignore
+            pin_memory=pin_memory
+        )
+
+    else:
+        train_dataloader = BatchedDataLoader(
+            train_dataset,
+            batch_size=batch_size,
+            shuffle=True,
+            num_workers=0,
+        )
+
+        if use_full_batch_validation:
+            val_dataloader = FullBatchDataLoader(val_dataset)
+        else:
+            val_dataloader = BatchedDataLoader(
+                val_dataset, batch_size=len(val_dataset),  # type: ignore
+                num_workers=0
+            )
+
+    return train_dataloader, val_dataloader
+
+
+class _MetricRecorder(object):
+    """Replaces LightningModule.log to collect epoch metrics without a
+    Trainer.
+
+    Metrics are averaged over the batches of the epoch, weighted by the batch
+    size, like the epoch-level aggregation of pytorch lightning.
+
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.sums: Dict[str, float] = {}
+        self.counts: Dict[str, int] = {}
+        self.batch_size = 1
+
+    def __call__(self, name, value, *args, **kwargs):
+        if isinstance(value, torch.Tensor):
+            value = value.detach()
+
+        self.sums[name] = self.sums.get(name, 0) + value * self.batch_size
+        self.counts[name] = self.counts.get(name, 0) + self.batch_size
+
+    def compute(self) -> Dict[str, float]:
+        return {
+            name: float(total / self.counts[name])
+            for name, total in self.sums.items()
+        }
+
+
+def _native_device(accelerator: Optional[str]) -> torch.device:
+    if accelerator in (None, "cpu"):
+        return torch.device("cpu")
+
+    if accelerator in ("gpu", "cuda") or (
+        accelerator == "auto" and torch.cuda.is_available()
+    ):
+        return torch.device("cuda")
+
+    if accelerator == "auto":
+        return torch.device("cpu")
+
+    return torch.device(accelerator)
+
+
+def _batch_to(batch, device: torch.device):
+    return tuple(tens.to(device, non_blocking=True) for tens in batch)
+
+
+def save_lightning_checkpoint(
+    model: pl.LightningModule,
+    filename: str,
+    epoch: int = 0,
+    global_step: int = 0
+) -> None:
+    """Saves a checkpoint that can be read by load_from_checkpoint."""
+    checkpoint = {
+        "epoch": epoch,
+        "global_step": global_step,
+        "pytorch-lightning_version": pl.__version__,
+        "state_dict": model.state_dict(),
+        "hyper_parameters": dict(model.hparams),
+    }
+    model.on_save_checkpoint(checkpoint)
+    torch.save(checkpoint, filename)
+
+
+def fit_native(
+    model: pl.LightningModule,
+    train_dataloader: Iterable,
+    val_dataloader: Iterable,
+    monitored_metric: str,
+    checkpoint_path: str,
+    max_epochs: int,
+    accelerator: Optional[str] = None,
+    early_stopping_patience: int = 20,
+    precision: str = "32",
+    stats: Optional[TrainingStats] = None
+) -> float:
+    """Trains a LightningModule with a plain torch loop.
+
+    This runs the model's training_step and validation_step methods with the
+    optimizer from configure_optimizers. As with the callbacks used with the
+    Trainer, the validation metric is checked after every epoch, the weights
+    are copied when it improves and training stops when it hasn't improved
+    for early_stopping_patience epochs. The model is left with the best
+    weights, which are also saved to the checkpoint.
+
+    """
+    device = _native_device(accelerator)
+    model.to(device)
+
+    optimizer = model.configure_optimizers()
+    scheduler = None
+    if isinstance(optimizer, dict):
+        scheduler = optimizer.get("lr_scheduler")
+        optimizer = optimizer["optimizer"]
+    elif isinstance(optimizer, (list, tuple)):
+        if len(optimizer) == 2 and isinstance(optimizer[0], (list, tuple)):
+            optimizers, schedulers = optimizer
+            scheduler = schedulers[0] if schedulers else None
+            optimizer = optimizers[0]
+        else:
+            assert len(optimizer) == 1
+            optimizer = optimizer[0]
+
+    if isinstance(scheduler, dict):
+        scheduler = scheduler["scheduler"]
+
+    recorder = _MetricRecorder()
+    model.log = recorder  # type: ignore
+
+    # Like the Trainer, we keep the modes of the modules at the start of the
+    # fit for training (e.g. frozen exposure networks stay in eval mode).
+    training_modes = [(module, module.training) for module in model.modules()]
+
+    if stats is None:
+        stats = TrainingStats()
+
+    best_state = BestStateCallback(monitored_metric)
+    n_bad_epochs = 0
+    global_step = 0
+    try:
+        model.on_fit_start()
+
+        for epoch in range(max_epochs):
+            for module, mode in training_modes:
+                module.train(mode)
+
+            epoch_start = batch_end = time.perf_counter()
+            for batch_index, batch in enumerate(train_dataloader):
+                stats.data_wait_seconds += time.perf_counter() - batch_end
+                stats.samples += batch[0].size(0)
+                batch = _batch_to(batch, device)
+                with autocast(precision, device):
+                    loss = model.training_step(batch, batch_index)
+
+                if isinstance(loss, dict):
+                    loss = loss["loss"]
+
+                optimizer.zero_grad(set_to_none=True)
+                loss.backward()
+                optimizer.step()
+                global_step += 1
+                batch_end = time.perf_counter()
+
+            stats.epochs += 1
+            stats.seconds += time.perf_counter() - epoch_start
+
+            if scheduler is not None:
+                scheduler.step()
+
+            model.eval()
+            recorder.reset()
+            with torch.no_grad(), autocast(precision, device):
+                for batch_index, batch in enumerate(val_dataloader):
+                    batch = _batch_to(batch, device)
+                    recorder.batch_size = batch[0].size(0)
+                    model.validation_step(batch, batch_index)
+
+            metrics = recorder.compute()
+            recorder.reset()
+            if monitored_metric not in metrics:
+                raise RuntimeError(
+                    f"Monitored metric '{monitored_metric}' was not logged "
+                    f"during validation. Available: {list(metrics.keys())}."
+                )
+
+            score = metrics[monitored_metric]
+            if not math.isfinite(score):
+                info(f"Stopping because {monitored_metric} is {score}.")
+                break
+
+            if best_state.update(model, score, epoch, global_step):
+                n_bad_epochs = 0
+            else:
+                n_bad_epochs += 1
+                if n_bad_epochs >= early_stopping_patience:
+                    break
+
+        model.on_fit_end()
+
+    finally:
+        del model.log  # Restore the LightningModule method.
+        model.eval()
+
+    return best_state.restore(model, checkpoint_path)
+
+
+def fit_lbfgs(
+    model: pl.LightningModule,
+    train_dataset: Dataset,
+    val_dataset: Dataset,
+    monitored_metric: str,
+    checkpoint_path: str,
+    max_steps: int,
+    accelerator: Optional[str] = None,
+    early_stopping_patience: int = 5,
+    max_iter: int = 20,
+    history_size: int = 100,
+    stats: Optional[TrainingStats] = None
+) -> float:
+    """Trains a LightningModule with full-batch L-BFGS.
+
+    The training and validation sets are each fetched as a single batch and
+    every step of the optimizer runs up to max_iter L-BFGS iterations with a
+    strong Wolfe line search over the full training set. The weight_decay
+    hyperparameter, if any, is added to the loss as the same L2 penalty as
+    with Adam.
+
+    The weights at the start are kept as a candidate, so this can be used to
+    polish a model trained with another optimizer. Validation, early stopping
+    and checkpointing otherwise work as in fit_native, with one L-BFGS step
+    per epoch. Training also stops when L-BFGS converges.
+
+    """
+    device = _native_device(accelerator)
+    model.to(device)
+
+    train_batch = _batch_to(
+        next(iter(FullBatchDataLoader(train_dataset))), device
+    )
+    val_batch = _batch_to(next(iter(FullBatchDataLoader(val_dataset))), device)
+
+    params = [p for p in model.parameters() if p.requires_grad]
+    weight_decay = float(model.hparams.get("weight_decay") or 0)
+    optimizer = torch.optim.LBFGS(
+        params,
+        lr=1,
+        max_iter=max_iter,
+        history_size=history_size,
+        line_search_fn="strong_wolfe"
+    )
+
+    def closure():
+        optimizer.zero_grad(set_to_none=True)
+        loss = model.training_step(train_batch, 0)
+        if isinstance(loss, dict):
+            loss = loss["loss"]
+
+        if weight_decay > 0:
+            loss = loss + 0.5 * weight_decay * sum(
+                torch.sum(p ** 2) for p in params
+            )
+
+        loss.backward()
+        return loss
+
+    recorder = _MetricRecorder()
+    model.log = recorder  # type: ignore
+
+    def validate() -> float:
+        model.eval()
+        recorder.reset()
+        with torch.no_grad():
+            model.validation_step(val_batch, 0)
+
+        metrics = recorder.compute()
+        recorder.reset()
+        if monitored_metric not in metrics:
+            raise RuntimeError(
+                f"Monitored metric '{monitored_metric}' was not logged "
+                f"during validation. Available: {list(metrics.keys())}."
+            )
+
+        return metrics[monitored_metric]
+
+    training_modes = [(module, module.training) for module in model.modules()]
+
+    best_state = BestStateCallback(monitored_metric)
+    n_bad_epochs = 0
+    n_iter = func_evals = 0
+    try:
+        model.on_fit_start()
+        best_state.update(model, validate(), 0, 0)
+
+        for epoch in range(max_steps):
+            for module, mode in training_modes:
+                module.train(mode)
+
+            step_start = time.perf_counter()
+            optimizer.step(closure)
+
+            # The number of iterations is below max_iter when L-BFGS stopped
+            # because of its tolerances.
+            prev_n_iter, prev_func_evals = n_iter, func_evals
+            n_iter = optimizer.state[params[0]]["n_iter"]
+            func_evals = optimizer.state[params[0]]["func_evals"]
+            converged = n_iter - prev_n_iter < max_iter
+
+            if stats is not None:
+                # Every evaluation of the closure is a pass over the data.
+                stats.epochs += 1
+                stats.samples += (
+                    train_batch[0].size(0) * (func_evals - prev_func_evals)
+                )
+                stats.seconds += time.perf_counter() - step_start
+
+            score = validate()
+            if not math.isfinite(score):
+                info(f"Stopping because {monitored_metric} is {score}.")
+                break
+
+            if best_state.update(model, score, epoch, n_iter):
+                n_bad_epochs = 0
+            else:
+                n_bad_epochs += 1
+                if n_bad_epochs >= early_stopping_patience:
+                    break
+
+            if converged:
+                break
+
+        model.on_fit_end()
+
+    finally:
+        del model.log  # Restore the LightningModule method.
+        model.eval()
+
+    return best_state.restore(model, checkpoint_path)
+
+
+def train_replicates(
+    train_dataset: Dataset,
+    val_dataset: Dataset,
+    models: List[pl.LightningModule],
+    monitored_metric: str,
+    batch_size: int,
+    max_epochs: int,
+    accelerator: Optional[str] = None,
+    early_stopping_patience: int = 20,
+    replicated_fields: Sequence[int] = (-1, )
+) -> List[float]:
+    """Fits bootstrap replicates of a model together (see fit_replicates).
+
+    The datasets need one column of sample weights per model, as drawn by
+    resample_replicates. Every model is left with the parameters of its best
+    epoch and the best value of the monitored metric is returned for every
+    replicate.
+
+    """
+    train_dataloader, val_dataloader = _make_dataloaders(
+        train_dataset,
+        val_dataset,
+        batch_size=batch_size,
+        accelerator=accelerator
+    )
+
+    return fit_replicates(
+        models,
+        train_dataloader,
+        val_dataloader,
+        monitored_metric=monitored_metric,
+        max_epochs=max_epochs,
+        accelerator=accelerator,
+        early_stopping_patience=early_stopping_patience,
+        replicated_fields=replicated_fields
+    )
+
+
+class _ReplicateStep(nn.Module):
+    """Calls a step method of a model and returns its loss or a logged metric.
+
+    This is used with functional_call to evaluate the steps using the
+    parameters of a single replicate.
+
+    """
+    def __init__(self, model: pl.LightningModule):
+        super().__init__()
+        self.model = model
+        self.logged: Dict[str, torch.Tensor] = {}
+
+    def record(self, name, value, *args, **kwargs):
+        self.logged[name] = value
+
+    def forward(self, step_name: str, metric: Optional[str], batch):
+        self.logged = {}
+        loss = getattr(self.model, step_name)(batch, 0)
+        if metric is None:
+            return loss["loss"] if isinstance(loss, dict) else loss
+
+        return self.logged[metric]
+
+
+def _stacked_optimizer(
+    model: pl.LightningModule,
+    params: Dict[str, torch.Tensor]
+) -> torch.optim.Optimizer:
+    optimizer = model.configure_optimizers()
+    if not isinstance(optimizer, torch.optim.Optimizer):
+        raise ValueError(
+            "Replicates can only be trained together if configure_optimizers "
+            "returns a single optimizer."
+        )
+
+    # Same optimizer and parameter groups, but over the stacked parameters.
+    # The updates of Adam and SGD are elementwise, so the replicates are
+    # optimized independently.
+    names = {id(p): name for name, p in model.named_parameters()}
+    groups = []
+    for group in optimizer.param_groups:
+        stacked = [params[names[id(p)]] for p in group["params"]]
+        stacked = [p for p in stacked if p.requires_grad]
+        if stacked:
+            groups.append({**group, "params": stacked})
+
+    return type(optimizer)(groups)
+
+
+def fit_replicates(
+    models: List[pl.LightningModule],
+    train_dataloader: Iterable,
+    val_dataloader: Iterable,
+    monitored_metric: str,
+    max_epochs: int,
+    accelerator: Optional[str] = None,
+    early_stopping_patience: int = 20,
+    replicated_fields: Sequence[int] = (-1, )
+) -> List[float]:
+    """Trains bootstrap replicates of the same architecture at once.
+
+    The parameters of the models are stacked and their steps are vectorized
+    using torch.func.vmap, so every batch is read once and used by all
+    replicates. The last element of the batches has one sample weight per
+    replicate. Other fields of the batches can also hold one value per
+    replicate along their second dimension (e.g. inputs computed by a
+    different first stage for every replicate), their indices are given by
+    replicated_fields. Each replicate has its own early stopping state and
+    keeps the parameters from its best epoch, these are loaded back into the
+    models. Stopped replicates are removed from the stacked parameters and
+    optimizer state, so they are no longer trained.
+
+    """
+    from torch.func import functional_call, stack_module_state, vmap
+
+    device = _native_device(accelerator)
+    for model in models:
+        model.to(device)
+        model.on_fit_start()
+
+    base = models[0]
+    n_replicates = len(models)
+    params, buffers = stack_module_state(models)  # type: ignore
+    optimizer = _stacked_optimizer(base, params)
+
+    step_module = _ReplicateStep(base)
+    state = (
+        {f"model.{k}": v for k, v in params.items()},
+        {f"model.{k}": v for k, v in buffers.items()},
+    )
+
+    # Replicates that are still trained, in the order of the stacked state.
+    rows = torch.arange(n_replicates, device=device)
+
+    def drop_stopped(keep: torch.Tensor) -> None:
+        nonlocal params, buffers, optimizer, state, rows
+        old_params = [p for g in optimizer.param_groups for p in g["params"]]
+        params = {
+            k: v.detach()[keep].clone().requires_grad_(v.requires_grad)
+            for k, v in params.items()
+        }
+        buffers = {k: v[keep].clone() for k, v in buffers.items()}
+        old_state = optimizer.state
+        optimizer = _stacked_optimizer(base, params)
+        new_params = [p for g in optimizer.param_groups for p in g["params"]]
+        for old, new in zip(old_params, new_params):
+            optimizer.state[new] = {
+                k: v[keep] if torch.is_tensor(v) and v.dim() > 0 else v
+                for k, v in old_state[old].items()
+            }
+
+        state = (
+            {f"model.{k}": v for k, v in params.items()},
+            {f"model.{k}": v for k, v in buffers.items()},
+        )
+        rows = rows[keep]
+
+    # Some models share layers between containers (e.g. MLP.representation
+    # and MLP.mlp). The stacked state only has one name per tensor and
+    # setting it on the shared layer is enough, so we don't let
+    # functional_call tie (and then incorrectly restore) the aliases.
+    def run_step(step_name, metric, batch):
+        in_dims = [None] * len(batch)
+        for i in replicated_fields:
+            in_dims[i] = 1
+
+        if rows.numel() < n_replicates:
+            batch = tuple(
+                field if dim is None else field[:, rows]
+                for field, dim in zip(batch, in_dims)
+            )
+
+        return vmap(
+            lambda state, batch: functional_call(
+                step_module, state, (step_name, metric, batch),
+                tie_weights=False
+            ),
+            in_dims=(0, tuple(in_dims)),
+            randomness="different"
+        )(state, batch)
+
+    best_state = {
+        k: v.detach().clone() for k, v in {**params, **buffers}.items()
+    }
+    best_scores = torch.full((n_replicates, ), math.inf, device=device)
+    n_bad_epochs = torch.zeros(n_replicates, dtype=torch.long, device=device)
+
+    base.log = step_module.record  # type: ignore
+    training_modes = [(module, module.training) for module in base.modules()]
+    try:
+        for epoch in range(max_epochs):
+            for module, mode in training_modes:
+                module.train(mode)
+
+            for batch in train_dataloader:
+                losses = run_step(
+                    "training_step", None, _batch_to(batch, device)
+                )
+                optimizer.zero_grad(set_to_none=True)
+                losses.sum().backward()
+                optimizer.step()
+
+            base.eval()
+            total = torch.zeros(rows.numel(), device=device)
+            n = 0
+            with torch.no_grad():
+                for batch in val_dataloader:
+                    batch = _batch_to(batch, device)
+                    total += run_step(
+                        "validation_step", monitored_metric, batch
+                    ) * batch[0].size(0)
+                    n += batch[0].size(0)
+
+            scores = total / n
+            improved = scores < best_scores[rows]
+            for k, v in best_state.items():
+                source = params.get(k, buffers.get(k))
+                v[rows[improved]] = source.detach()[improved]
+
+            best_scores[rows[improved]] = scores[improved]
+            n_bad_epochs[rows] = torch.where(
+                improved, 0, n_bad_epochs[rows] + 1
+            )
+            keep = torch.isfinite(scores)
+            keep &= n_bad_epochs[rows] < early_stopping_patience
+            if not keep.any():
+                break
+
+            if not keep.all():
+                drop_stopped(keep)
+
+        info(f"Trained {n_replicates} replicates for {epoch + 1} epochs.")
+
+    finally:
+        del base.log  # Restore the LightningModule method.
+
+    failed = torch.nonzero(~torch.isfinite(best_scores)).reshape(-1)
+    if failed.numel() > 0:
+        raise RuntimeError(
+            f"No finite value of '{monitored_metric}' for replicates "
+            f"{failed.tolist()}."
+        )
+
+    with torch.no_grad():
+        for b, model in enumerate(models):
+            for k, tens in [
+                *model.named_parameters(), *model.named_buffers()
+            ]:
+                tens.copy_(best_state[k][b])
+
+            model.eval()
+
+    return best_scores.tolist()